@@ -1,5 +1,7 @@
 from typing import Dict, Any, Optional
 import asyncio
+import hashlib
+import json
 from datetime import datetime
 import uuid
 
@@ -43,6 +45,9 @@ class AgentService:
         # 推理状态持久化 - 只在开始新会话时初始化
         self.reasoning_state = None
 
+        # 关卡storyboard转换结果：内容哈希 -> storyboard条目，每轮对话不再重复转换已生成的关卡
+        self._storyboard_cache: Dict[str, Dict[str, Any]] = {}
+
         print(f"AgentService初始化完成，使用模型: {model_name}，启用智能推理")
 
     def start_conversation(self) -> Dict[str, Any]:
@@ -75,9 +80,11 @@ class AgentService:
             "next_action": "await_user_input"
         }
 
-    async def process_request(self, user_input: str) -> Dict[str, Any]:
-        """处理用户请求 - 使用状态持久化"""
+    async def process_request(self, user_input: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """处理用户请求 - 使用状态持久化
+        idempotency_key 相同的重复请求、以及该需求正在生成时的重复请求不再运行推理，直接返回已有的生成任务"""
 
+        requirement_id = None
         try:
             # 确保推理状态已初始化
             if self.reasoning_state is None:
@@ -86,14 +93,36 @@ class AgentService:
                     user_id=self.user_id,
                     collected_info=self.collected_info
                 )
+            requirement_id = self.reasoning_state["requirement_id"]
+            generation_jobs = self.reasoning_graph.generation_jobs
+
+            # 普通的信息收集轮次不查询生成任务：只有带幂等键或会话已可以进入生成时才检查
+            ready_for_generation = bool(self.reasoning_state.get("ready_for_generation"))
+            existing_job = None
+            if idempotency_key or ready_for_generation:
+                existing_job = await generation_jobs.existing(requirement_id, idempotency_key,
+                                                              check_active=ready_for_generation)
+            if existing_job:
+                return self._format_generation_job_response(existing_job, requirement_id)
             
             # 使用持久化状态处理请求
             reasoning_result = await self.reasoning_graph.process_reasoning_request_with_state(
                 reasoning_state=self.reasoning_state,
-                user_input=user_input
+                user_input=user_input,
+                idempotency_key=idempotency_key
             )
             
             print(f"DEBUG: 推理结果: {reasoning_result}")
+
+            if not reasoning_result.get("success"):
+                await generation_jobs.abort(requirement_id, reasoning_result.get("error", "推理处理失败"))
+
+            generation_job = {}
+            if reasoning_result.get("success"):
+                generation_job = reasoning_result["final_state"].get("generation_job") or {}
+                if generation_job and (generation_job.get("attached") or not generation_job.get("success")):
+                    # 其他请求正在生成该需求：不更新会话状态，返回该任务
+                    return self._format_generation_job_response(generation_job, requirement_id)
             
             # 更新持久化的状态
             if reasoning_result.get("success"):
@@ -106,11 +135,16 @@ class AgentService:
                     print("检测到内容生成完成，准备重置AgentService状态")
                     self._reset_after_completion()
             
-            # 格式化并返回结果
-            return self._format_reasoning_response(reasoning_result, user_input)
+            # 格式化并返回结果（生成完成时在其中保存 story_{requirement_id}）
+            response = self._format_reasoning_response(reasoning_result, user_input)
+            if generation_job:
+                await self._finish_generation_job(generation_job["job_id"], reasoning_result["final_state"], response)
+            return response
 
         except Exception as e:
             print(f"处理请求时出错: {e}")
+            if requirement_id:
+                await self.reasoning_graph.generation_jobs.abort(requirement_id, str(e))
             return {
                 "error": f"处理请求时出现错误: {str(e)}",
                 "action": "retry",
@@ -186,13 +220,14 @@ class AgentService:
         if level_generation_status == "completed":
             # 关卡生成完成，保存storyboard数据到数据库
             requirement_id = final_state.get("requirement_id", self.session_id)
-            self._save_storyboard_to_database(requirement_id, storyboards_data, story_framework, final_state)
+            saved = self._save_storyboard_to_database(requirement_id, storyboards_data, story_framework, final_state)
             
             return {
                 "response": assistant_message,
                 "ready_for_stage2": True,
                 "stage": "all_levels_complete",
                 "requirement_id": requirement_id,
+                "story_id": f"story_{requirement_id}" if saved else None,
                 "final_requirements": final_state.get("final_requirements", {}),
                 "collected_info": final_state.get("collected_info", {}),
                 "analysis_report": analysis_report,
@@ -246,6 +281,46 @@ class AgentService:
                 "timestamp": self._get_timestamp()
             }
 
+    def _format_generation_job_response(self, job: Dict[str, Any], requirement_id: str) -> Dict[str, Any]:
+        """重复请求的返回：已有的生成任务，客户端通过 /generation_jobs/{job_id}/events 获取进度和结果"""
+        if not job.get("success"):
+            return {
+                "error": job.get("error", "该需求正在生成中"),
+                "action": "retry",
+                "timestamp": self._get_timestamp()
+            }
+
+        finished = job.get("status") in ("completed", "failed")
+        return {
+            "response": "该需求的生成已经结束" if finished else "该需求已经在生成中，可以通过生成任务的进度流查看进度",
+            "ready_for_stage2": job.get("status") == "completed",
+            "stage": "generation_attached",
+            "requirement_id": job.get("requirement_id") or requirement_id,
+            "generation_job": {
+                "job_id": job["job_id"],
+                "status": job.get("status"),
+                "result": job.get("result")
+            },
+            "action": "follow_generation_job",
+            "timestamp": self._get_timestamp()
+        }
+
+    async def _finish_generation_job(self, job_id: str, final_state: Dict[str, Any], response: Dict[str, Any]) -> None:
+        """本次运行持有的生成任务：保存 story_{requirement_id} 后结束任务并释放需求锁"""
+        generation_jobs = self.reasoning_graph.generation_jobs
+        response["generation_job_id"] = job_id
+        if response.get("story_id"):
+            await generation_jobs.publish(job_id, "saved", {"story_id": response["story_id"]})
+            await generation_jobs.finish(job_id, "completed", result={
+                "story_id": response["story_id"],
+                "requirement_id": response.get("requirement_id"),
+                "level_count": len(final_state.get("level_details") or {})
+            })
+        elif final_state.get("level_generation_status") == "completed":
+            await generation_jobs.finish(job_id, "failed", error="故事板保存失败")
+        else:
+            await generation_jobs.finish(job_id, "failed", error="故事框架未通过审核或关卡生成失败")
+
     def get_session_status(self) -> Dict[str, Any]:
         """获取当前会话状态"""
         if self.reasoning_state is None:
@@ -298,6 +373,7 @@ class AgentService:
 
             # 重置推理状态
             self.reasoning_state = None
+            self._storyboard_cache = {}
 
             print(f"AgentService状态已重置: {old_session_id} -> {self.session_id}")
 
@@ -327,8 +403,8 @@ class AgentService:
             # 生成story_id（基于requirement_id）
             story_id = f"story_{requirement_id}"
             
-            # 保存到数据库
-            result = self.db_client.save_story(
+            # 保存到数据库（每个关卡单独一条记录，前端可以先加载故事头和第一关）
+            result = self.db_client.save_story_with_levels(
                 story_id=story_id,
                 requirement_id=requirement_id,
                 story_data=story_data
@@ -349,94 +425,32 @@ class AgentService:
         """将level_details转换为前端期望的storyboards格式"""
         
         try:
-            import json
-            
             storyboards = []
             
             # 从final_state获取基础信息
-            story_framework = final_state.get("story_framework", "")
             collected_info = final_state.get("collected_info", {})
+            teaching_goal = collected_info.get("teaching_goals", ["未指定"])[0] if collected_info.get("teaching_goals") else "未指定"
             
             # 提取故事标题（从story_framework中解析或使用默认）
             story_title = "RPG教育游戏"  # 可以后续从story_framework解析
             
+            storyboard_cache = {}
             for level in range(1, 7):
                 level_key = f"level_{level}"
                 if level_key not in level_details:
                     continue
                     
                 level_data = level_details[level_key]
-                
-                # 解析场景数据JSON
-                scene_json = {}
-                if "scenes_script" in level_data and level_data["scenes_status"] == "completed":
-                    try:
-                        scenes_content = level_data["scenes_script"]
-                        # 提取JSON部分（去除markdown格式）
-                        if "```json" in scenes_content:
-                            json_start = scenes_content.find("```json") + 7
-                            json_end = scenes_content.find("```", json_start)
-                            if json_end != -1:
-                                json_str = scenes_content[json_start:json_end].strip()
-                                scene_json = json.loads(json_str)
-                    except Exception as e:
-                        print(f"⚠️ 第{level}关卡场景JSON解析失败: {e}")
-                
-                # 解析角色数据JSON
-                character_json = {}
-                if "characters_dialogue" in level_data and level_data["characters_status"] == "completed":
-                    try:
-                        characters_content = level_data["characters_dialogue"]
-                        # 提取JSON部分（去除markdown格式）
-                        if "```json" in characters_content:
-                            json_start = characters_content.find("```json") + 7
-                            json_end = characters_content.find("```", json_start)
-                            if json_end != -1:
-                                json_str = characters_content[json_start:json_end].strip()
-                                character_json = json.loads(json_str)
-                    except Exception as e:
-                        print(f"⚠️ 第{level}关卡角色JSON解析失败: {e}")
-                
-                # 现在scene_json包含完整数据（包括角色和对话）
-                storyboard_data = {}
-
-                # 从scene_json提取所有数据
-                if scene_json:
-                    storyboard_data["分镜基础信息"] = scene_json.get("分镜基础信息", {})
-                    storyboard_data["人物档案"] = scene_json.get("人物档案", {})
-                    storyboard_data["人物对话"] = scene_json.get("人物对话", [])
-                    storyboard_data["图片提示词"] = scene_json.get("图片生成提示词", {})
-                    storyboard_data["剧本"] = scene_json.get("剧本", {})
-
-                # 如果scene_json中没有角色数据，再尝试从character_json获取（向后兼容）
-                if character_json and not storyboard_data.get("人物档案"):
-                    storyboard_data["人物档案"] = character_json.get("人物档案", {})
-                    storyboard_data["人物对话"] = character_json.get("人物对话", [])
-                
-                # 生成stage_name（从分镜标题提取或使用默认）
-                stage_name = f"关卡{level}"
-                if storyboard_data.get("分镜基础信息", {}).get("分镜标题"):
-                    title = storyboard_data["分镜基础信息"]["分镜标题"]
-                    if "-" in title:
-                        stage_name = title.split("-", 1)[1].strip()
-                
-                # 构建单个storyboard
-                storyboard_item = {
-                    "stage_index": level,
-                    "stage_name": stage_name,
-                    "stage_id": level_key,
-                    "storyboard": storyboard_data,
-                    # 可选字段
-                    "teachingGoal": collected_info.get("teaching_goals", ["未指定"])[0] if collected_info.get("teaching_goals") else "未指定",
-                    "generation_status": {
-                        "storyboard": "success" if scene_json else "failed",
-                        "scene": "success" if scene_json else "failed",
-                        "dialogue": "success" if (scene_json and scene_json.get("人物对话")) else "failed"
-                    }
-                }
-                
+                cache_key = self._storyboard_cache_key(level_key, level_data, teaching_goal)
+                storyboard_item = self._storyboard_cache.get(cache_key)
+                if storyboard_item is None:
+                    storyboard_item = self._convert_level_to_storyboard(level, level_data, teaching_goal)
+                storyboard_cache[cache_key] = storyboard_item
                 storyboards.append(storyboard_item)
             
+            # 只保留当前关卡对应的转换结果
+            self._storyboard_cache = storyboard_cache
+            
             # 构建完整的返回数据
             return {
                 "story_id": self.session_id,
@@ -459,6 +473,77 @@ class AgentService:
                 "storyboards": []
             }
 
+    @staticmethod
+    def _storyboard_cache_key(level_key: str, level_data: Dict[str, Any], teaching_goal: str) -> str:
+        """关卡内容（LLM原始输出）、状态和教学目标相同时转换结果相同"""
+        content = level_data.get("scenes_script") or ""
+        content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        return f"{level_key}:{level_data.get('scenes_status')}:{content_hash}:{teaching_goal}"
+
+    def _convert_level_to_storyboard(self, level: int, level_data: Dict[str, Any], teaching_goal: str) -> Dict[str, Any]:
+        """转换单个关卡，直接使用生成关卡时已解析好的parsed_scene_data"""
+        scene_json = {}
+        if level_data.get("scenes_status") == "completed":
+            scene_json = level_data.get("parsed_scene_data") or {}
+            # 旧数据没有parsed_scene_data时才解析原始输出
+            if not scene_json and level_data.get("scenes_script"):
+                scene_json = self._parse_fenced_json(level_data["scenes_script"], f"第{level}关卡场景")
+        
+        # 现在scene_json包含完整数据（包括角色和对话）
+        storyboard_data = {}
+
+        # 从scene_json提取所有数据
+        if scene_json:
+            storyboard_data["分镜基础信息"] = scene_json.get("分镜基础信息", {})
+            storyboard_data["人物档案"] = scene_json.get("人物档案", {})
+            storyboard_data["人物对话"] = scene_json.get("人物对话", [])
+            storyboard_data["图片提示词"] = scene_json.get("图片生成提示词", {})
+            storyboard_data["剧本"] = scene_json.get("剧本", {})
+
+        # 如果scene_json中没有角色数据，再尝试从旧格式的characters_dialogue获取（向后兼容）
+        characters_content = level_data.get("characters_dialogue")
+        if (not storyboard_data.get("人物档案") and isinstance(characters_content, str)
+                and level_data.get("characters_status") == "completed"):
+            character_json = self._parse_fenced_json(characters_content, f"第{level}关卡角色")
+            if character_json:
+                storyboard_data["人物档案"] = character_json.get("人物档案", {})
+                storyboard_data["人物对话"] = character_json.get("人物对话", [])
+        
+        # 生成stage_name（从分镜标题提取或使用默认）
+        stage_name = f"关卡{level}"
+        if storyboard_data.get("分镜基础信息", {}).get("分镜标题"):
+            title = storyboard_data["分镜基础信息"]["分镜标题"]
+            if "-" in title:
+                stage_name = title.split("-", 1)[1].strip()
+        
+        # 构建单个storyboard
+        return {
+            "stage_index": level,
+            "stage_name": stage_name,
+            "stage_id": f"level_{level}",
+            "storyboard": storyboard_data,
+            # 可选字段
+            "teachingGoal": teaching_goal,
+            "generation_status": {
+                "storyboard": "success" if scene_json else "failed",
+                "scene": "success" if scene_json else "failed",
+                "dialogue": "success" if (scene_json and scene_json.get("人物对话")) else "failed"
+            }
+        }
+
+    @staticmethod
+    def _parse_fenced_json(content: str, label: str) -> Dict[str, Any]:
+        """解析markdown ```json代码块中的JSON（只用于没有解析结果的旧数据）"""
+        try:
+            if "```json" in content:
+                json_start = content.find("```json") + 7
+                json_end = content.find("```", json_start)
+                if json_end != -1:
+                    return json.loads(content[json_start:json_end].strip())
+        except Exception as e:
+            print(f"⚠️ {label}JSON解析失败: {e}")
+        return {}
+
 
 # 便利函数
 def create_agent_service(model_name: str = "gpt-4o-mini") -> AgentService:
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+详细度/适宜性评估结果复用
+按每个评估维度依赖的 collected_info 字段计算内容哈希，哈希和上次评估时相同的维度直接复用上次的评分：
+- 详细度评估：只重新评分字段有变化的维度
+- 适宜性检查：所有字段都没有变化时复用上次的检查结果
+记录保存在 ReasoningState["assessment_memo"] 中，随会话状态一起持久化
+"""
+
+import hashlib
+import json
+import threading
+from typing import Any, Dict, Iterable, List
+
+
+# 详细度评估维度 -> 依赖的字段（与详细度评估prompt中的维度说明一致）
+SUFFICIENCY_DIMENSION_FIELDS = {
+    "基础信息充足性": ["subject", "grade", "knowledge_points"],
+    "教学信息充足性": ["teaching_goals", "teaching_difficulties"],
+    "游戏设定充足性": ["game_style", "character_design", "world_setting"],
+    "情节设定充足性": ["plot_requirements", "interaction_requirements"]
+}
+
+# 适宜性检查综合考虑全部字段
+FITNESS_FIELDS = [field for fields in SUFFICIENCY_DIMENSION_FIELDS.values() for field in fields]
+
+
+def fields_hash(collected_info: Dict[str, Any], fields: Iterable[str]) -> str:
+    """指定字段的内容哈希（空字符串、空列表与None视为相同）"""
+    values = {field: (collected_info or {}).get(field) or None for field in fields}
+    payload = json.dumps(values, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def dirty_dimensions(collected_info: Dict[str, Any], sufficiency_memo: Dict[str, Any]) -> List[str]:
+    """字段内容与上次评估时不同（或从未评估过）的维度"""
+    return [
+        dimension for dimension, fields in SUFFICIENCY_DIMENSION_FIELDS.items()
+        if (sufficiency_memo.get(dimension) or {}).get("hash") != fields_hash(collected_info, fields)
+    ]
+
+
+class AssessmentMemoMetrics:
+    """评估复用统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "sufficiency_full": 0,        # 所有维度重新评估
+            "sufficiency_partial": 0,     # 只评估有变化的维度
+            "sufficiency_reused": 0,      # 完全复用，没有调用LLM
+            "dimensions_rescored": 0,
+            "dimensions_reused": 0,
+            "fitness_checked": 0,
+            "fitness_reused": 0
+        }
+
+    def record_sufficiency(self, rescored: int, reused: int) -> None:
+        with self._lock:
+            if not rescored:
+                self._stats["sufficiency_reused"] += 1
+            elif reused:
+                self._stats["sufficiency_partial"] += 1
+            else:
+                self._stats["sufficiency_full"] += 1
+            self._stats["dimensions_rescored"] += rescored
+            self._stats["dimensions_reused"] += reused
+
+    def record_fitness(self, reused: bool) -> None:
+        with self._lock:
+            self._stats["fitness_reused" if reused else "fitness_checked"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            dimensions = self._stats["dimensions_rescored"] + self._stats["dimensions_reused"]
+            fitness = self._stats["fitness_checked"] + self._stats["fitness_reused"]
+            return {
+                **self._stats,
+                "dimension_reuse_ratio": round(self._stats["dimensions_reused"] / dimensions, 4) if dimensions else 0.0,
+                "fitness_reuse_ratio": round(self._stats["fitness_reused"] / fitness, 4) if fitness else 0.0
+            }
+
+
+# 全局统计实例
+assessment_memo_metrics = AssessmentMemoMetrics()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+按token预算构建LLM上下文
+每个调用点有自己的预算：优先保留最新的用户输入和最近的对话，
+放不下的较早消息压缩成摘要行，超长文本按token截断，并统计节省的token数
+"""
+
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+# 各调用点的上下文token预算
+CONTEXT_BUDGETS = {
+    "sufficiency_assessment": 1500,
+    "sufficiency_questions": 1500,
+    "fitness_check": 1500,
+    "negotiate_response": 1200,
+    "finish_response": 1200,
+    "assessment_story_framework": 2500,
+    "assessment_analysis_report": 1500,
+    "assessment_level_details": 1800,
+    "assessment_level_fragment": 1500,
+    "default": 1500
+}
+
+# 为较早消息的摘要预留的预算比例
+SUMMARY_BUDGET_RATIO = 0.2
+# 摘要中每条消息保留的token数，剩余预算不足MIN_SUMMARY_TOKENS时不再追加摘要
+SUMMARY_TOKENS_PER_MESSAGE = 40
+MIN_SUMMARY_TOKENS = 12
+SUMMARY_HEADER = "【较早对话摘要】"
+TRUNCATION_MARKER = "…（已截断）"
+
+
+def _load_tokenizer() -> Optional[Tuple[Callable[[str], List[int]], Callable[[List[int]], str]]]:
+    """加载tiktoken分词器，不可用时返回None并退回到字符估算"""
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return encoding.encode, encoding.decode
+    except Exception as e:
+        print(f"tiktoken不可用，使用字符数估算token: {e}")
+        return None
+
+
+class TokenCounter:
+    """token计数与截断，优先使用tiktoken"""
+
+    def __init__(self):
+        self._tokenizer = _load_tokenizer()
+
+    def count(self, text: str) -> int:
+        """计算文本的token数"""
+        if not text:
+            return 0
+        if self._tokenizer:
+            return len(self._tokenizer[0](text))
+        # 估算：中日韩字符约1 token/字，其余约4字符/token
+        cjk = sum(1 for ch in text if '一' <= ch <= '鿿')
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """把文本截断到max_tokens以内，保留开头部分"""
+        if max_tokens <= 0 or not text:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+
+        marker_tokens = self.count(TRUNCATION_MARKER)
+        keep = max(max_tokens - marker_tokens, 1)
+        if self._tokenizer:
+            encode, decode = self._tokenizer
+            return decode(encode(text)[:keep]) + TRUNCATION_MARKER
+
+        # 估算模式下按比例截取字符
+        ratio = keep / self.count(text)
+        return text[:max(int(len(text) * ratio), 1)] + TRUNCATION_MARKER
+
+
+class ContextMetrics:
+    """按调用点统计原始token、实际发送token和节省的token"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def record(self, call_site: str, original_tokens: int, final_tokens: int,
+               truncated: int = 0, summarized: int = 0) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(call_site, {
+                "calls": 0,
+                "original_tokens": 0,
+                "final_tokens": 0,
+                "tokens_saved": 0,
+                "truncated_items": 0,
+                "summarized_items": 0
+            })
+            stats["calls"] += 1
+            stats["original_tokens"] += original_tokens
+            stats["final_tokens"] += final_tokens
+            stats["tokens_saved"] += max(original_tokens - final_tokens, 0)
+            stats["truncated_items"] += truncated
+            stats["summarized_items"] += summarized
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {call_site: dict(stats) for call_site, stats in self._stats.items()}
+
+
+# 全局统计实例
+context_metrics = ContextMetrics()
+
+
+class ContextBuilder:
+    """按调用点预算构建对话上下文和长文本段落"""
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, counter: Optional[TokenCounter] = None):
+        self.budgets = {**CONTEXT_BUDGETS, **(budgets or {})}
+        self.counter = counter or TokenCounter()
+
+    def budget_for(self, call_site: str) -> int:
+        """获取调用点的token预算"""
+        return self.budgets.get(call_site, self.budgets["default"])
+
+    def build_conversation_context(self, messages: List[Dict[str, Any]], call_site: str = "default",
+                                   max_messages: int = 10) -> str:
+        """构建对话上下文：按优先级装入预算，放不下的消息压缩成摘要"""
+        if not messages:
+            return "暂无对话记录"
+
+        budget = self.budget_for(call_site)
+        recent_messages = messages[-max_messages:]
+        lines = [f"{msg.get('role', 'unknown')}: {msg.get('content', '')}" for msg in recent_messages]
+        line_tokens = [self.counter.count(line) for line in lines]
+        original_tokens = sum(line_tokens)
+
+        if original_tokens <= budget:
+            context_metrics.record(call_site, original_tokens, original_tokens)
+            return "\n".join(lines)
+
+        # 优先级：最新的用户输入 > 越新的消息 > 越旧的消息
+        user_indexes = [i for i, msg in enumerate(recent_messages) if msg.get("role") == "user"]
+        latest_user = user_indexes[-1] if user_indexes else len(lines) - 1
+        priority = [latest_user] + [i for i in range(len(lines) - 1, -1, -1) if i != latest_user]
+
+        summary_budget = int(budget * SUMMARY_BUDGET_RATIO)
+        remaining = budget - summary_budget
+        kept: Dict[int, str] = {}
+        truncated = 0
+
+        for index in priority:
+            if line_tokens[index] <= remaining:
+                kept[index] = lines[index]
+                remaining -= line_tokens[index]
+            elif index == latest_user:
+                # 最新用户输入即使超长也必须保留，截断到剩余预算
+                kept[index] = self.counter.truncate(lines[index], remaining)
+                remaining = 0
+                truncated += 1
+
+        # 放不下的消息按时间顺序各保留开头一段，作为摘要
+        summarized = 0
+        summary_lines = []
+        summary_remaining = summary_budget + remaining - self.counter.count(SUMMARY_HEADER)
+        for index, line in enumerate(lines):
+            if index in kept:
+                continue
+            snippet_budget = min(SUMMARY_TOKENS_PER_MESSAGE, summary_remaining)
+            if snippet_budget < MIN_SUMMARY_TOKENS:
+                break
+            snippet = self.counter.truncate(line, snippet_budget)
+            summary_lines.append(f"- {snippet}")
+            summary_remaining -= self.counter.count(snippet) + 1
+            summarized += 1
+
+        parts = []
+        if summary_lines:
+            parts.append(SUMMARY_HEADER + "\n" + "\n".join(summary_lines))
+        parts.extend(kept[index] for index in sorted(kept))
+        context = "\n".join(parts)
+
+        context_metrics.record(call_site, original_tokens, self.counter.count(context), truncated, summarized)
+        return context
+
+    def fit_text(self, text: str, call_site: str) -> str:
+        """把单段长文本截断到调用点预算内"""
+        if not text:
+            return text
+        budget = self.budget_for(call_site)
+        original_tokens = self.counter.count(text)
+        if original_tokens <= budget:
+            context_metrics.record(call_site, original_tokens, original_tokens)
+            return text
+
+        fitted = self.counter.truncate(text, budget)
+        context_metrics.record(call_site, original_tokens, self.counter.count(fitted), truncated=1)
+        return fitted
+
+    def fit_sections(self, sections: List[str], call_site: str) -> List[str]:
+        """多个同等优先级的段落（如各关卡摘要）平分预算，短段落用不完的预算留给后面的段落"""
+        budget = self.budget_for(call_site)
+        section_tokens = [self.counter.count(section) for section in sections]
+        original_tokens = sum(section_tokens)
+        if original_tokens <= budget:
+            context_metrics.record(call_site, original_tokens, original_tokens)
+            return list(sections)
+
+        fitted = []
+        truncated = 0
+        remaining = budget
+        # 从短到长分配，保证短段落完整保留
+        order = sorted(range(len(sections)), key=lambda i: section_tokens[i])
+        allocations = {}
+        for position, index in enumerate(order):
+            share = remaining // (len(order) - position)
+            allocations[index] = min(section_tokens[index], share)
+            remaining -= allocations[index]
+
+        for index, section in enumerate(sections):
+            if section_tokens[index] <= allocations[index]:
+                fitted.append(section)
+            else:
+                fitted.append(self.counter.truncate(section, allocations[index]))
+                truncated += 1
+
+        context_metrics.record(call_site, original_tokens,
+                               sum(self.counter.count(section) for section in fitted), truncated=truncated)
+        return fitted
+
+
+# 便利函数
+def create_context_builder(budgets: Optional[Dict[str, int]] = None) -> ContextBuilder:
+    """创建上下文构建器实例"""
+    return ContextBuilder(budgets)
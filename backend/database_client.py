@@ -6,17 +6,40 @@
 替代 Redis 操作
 """
 
-import json
+import hashlib
 import os
 import psycopg2
 from datetime import datetime
-from typing import Dict, Any, Optional
-from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Optional, Tuple
+from psycopg2.extras import RealDictCursor, execute_values, register_default_json, register_default_jsonb
 from dotenv import load_dotenv
 
+import fast_json
+from story_cache import INVALIDATION_CHANNEL, story_cache
+from generation_jobs import GENERATION_JOB_CHANNEL
+from single_flight import story_read_flight
+from story_storage import (attach_storyboards, build_storyboard_row, compact_story_data, detach_storyboards,
+                           detached_storyboard_ids, expand_story_data, story_header, storyboard_item_from_row,
+                           storyboard_item_row_id)
+from story_compression import (DICTIONARY_DATA_TYPE, dictionary_row_id, is_compressed_projection, story_compressor,
+                               story_projection)
+
+GENERATION_JOB_DATA_TYPE = "generation_job"
+
+
+def requirement_lock_key(requirement_id: str) -> int:
+    """需求ID对应的advisory锁键（有符号64位整数）"""
+    digest = hashlib.sha1(f"generation:{requirement_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
 # 加载环境变量（从项目根目录）
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 
+# 读取json/jsonb列时使用快速反序列化（全局注册，对之后创建的所有连接生效）
+register_default_json(loads=fast_json.loads, globally=True)
+register_default_jsonb(loads=fast_json.loads, globally=True)
+
 class DatabaseClient:
     """数据库客户端，直接操作 PostgreSQL"""
     
@@ -24,10 +47,167 @@ class DatabaseClient:
         self.connection_string = os.getenv("DATABASE_URL")
         if not self.connection_string:
             raise ValueError("DATABASE_URL environment variable is required")
+        # 是否已经查询过最新的zstd字典（没有字典时不再每次查询）
+        self._story_dictionary_checked = False
     
     def get_connection(self):
         """获取数据库连接"""
         return psycopg2.connect(self.connection_string)
+
+    def _notify_story_changed(self, cursor, story_id: str) -> None:
+        """在写入事务中发送失效通知，提交后各worker的故事缓存删除该故事"""
+        cursor.execute("SELECT pg_notify(%s, %s)", [INVALIDATION_CHANNEL, story_id])
+
+    def ensure_story_compression_schema(self) -> Dict[str, Any]:
+        """压缩存储需要的bytea列（幂等）"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("ALTER TABLE edu_data ADD COLUMN IF NOT EXISTS data_zstd BYTEA")
+                    conn.commit()
+            return {'success': True}
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def ensure_generation_job_schema(self) -> Dict[str, Any]:
+        """查找正在执行的生成任务使用的部分表达式索引（幂等）：只索引 pending/running 的任务记录"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        CREATE INDEX IF NOT EXISTS edu_data_active_generation_job_idx
+                        ON edu_data ((data->>'requirement_id'))
+                        WHERE data_type = 'generation_job' AND data->>'status' IN ('pending', 'running')
+                    """)
+                    conn.commit()
+            return {'success': True}
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def _story_row_data(self, story_data: Dict[str, Any], story_id: Optional[str] = None) -> Tuple[str, Optional[bytes]]:
+        """故事记录的 (data列JSON, data_zstd列)：压缩时data列只保存投影
+        传入story_id时各关卡的storyboard已单独存储，故事记录中只保留关卡列表"""
+        compact = compact_story_data(story_data)
+        if story_id is not None:
+            compact = detach_storyboards(compact, story_id)
+        payload = fast_json.dumps_bytes(compact)
+        if story_compressor.enabled and story_compressor.should_compress(payload):
+            dict_id = self._active_story_dictionary()
+            blob = story_compressor.compress(payload, dict_id)
+            return fast_json.dumps(story_projection(compact, dict_id)), blob
+        return payload.decode('utf-8'), None
+
+    def _active_story_dictionary(self) -> Optional[int]:
+        """最新训练的zstd字典ID，没有字典时返回None（不使用字典压缩）"""
+        if story_compressor.active_dict_id is not None or self._story_dictionary_checked:
+            return story_compressor.active_dict_id
+        with self.get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT data, data_zstd FROM edu_data
+                    WHERE data_type = %s
+                    ORDER BY created_at DESC LIMIT 1
+                """, [DICTIONARY_DATA_TYPE])
+                result = cursor.fetchone()
+        if result:
+            story_compressor.load_dictionary(result['data']['dict_id'], result['data_zstd'], active=True)
+        self._story_dictionary_checked = True
+        return story_compressor.active_dict_id
+
+    def _load_story_data(self, cursor, story_id: str, data: Any, include_levels: bool = True) -> Any:
+        """data列是压缩投影时再读取data_zstd解压（列表等只用投影的查询不需要解压），
+        合并单独存储的关卡storyboard，然后还原紧凑格式；include_levels=False 时只返回故事头"""
+        if is_compressed_projection(data):
+            data = self._decompress_story(cursor, story_id, data)
+        if not include_levels:
+            return story_header(expand_story_data({key: value for key, value in data.items() if key != 'level_details'})
+                                if isinstance(data, dict) else data)
+
+        storyboard_ids = detached_storyboard_ids(data) if isinstance(data, dict) else []
+        if storyboard_ids:
+            cursor.execute("""
+                SELECT id, data FROM edu_data
+                WHERE id = ANY(%s) AND data_type = 'storyboard'
+            """, [storyboard_ids])
+            data = attach_storyboards(data, {row['id']: row['data'] for row in cursor.fetchall()})
+        return expand_story_data(data)
+
+    def _decompress_story(self, cursor, story_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """读取data_zstd并用投影中记录的字典解压（字典未加载时从数据库加载）"""
+        cursor.execute("SELECT data_zstd FROM edu_data WHERE id = %s", [story_id])
+        blob = cursor.fetchone()['data_zstd']
+        dict_id = data.get('zstd_dict_id')
+        if dict_id is not None and not story_compressor.has_dictionary(dict_id):
+            cursor.execute("SELECT data_zstd FROM edu_data WHERE id = %s", [dictionary_row_id(dict_id)])
+            dictionary = cursor.fetchone()
+            if not dictionary:
+                raise RuntimeError(f"zstd字典不存在: {dict_id}")
+            story_compressor.load_dictionary(dict_id, dictionary['data_zstd'])
+        return fast_json.loads(story_compressor.decompress(blob, dict_id))
+
+    def train_story_dictionary(self, sample_limit: int = 500) -> Dict[str, Any]:
+        """用数据库中的故事训练zstd字典并保存，之后写入的故事使用新字典压缩（已压缩的记录仍用原字典解压）"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT id, data FROM edu_data
+                        WHERE data_type = 'story'
+                        ORDER BY updated_at DESC LIMIT %s
+                    """, [sample_limit])
+                    rows = cursor.fetchall()
+                    stories = [self._load_story_data(cursor, row['id'], row['data']) for row in rows]
+
+            # 整个故事和单个关卡都作为样本，样本少时也能训练出常见键名和句式
+            samples = []
+            for story in stories:
+                compact = compact_story_data(story)
+                samples.append(fast_json.dumps_bytes(compact))
+                for storyboard in (compact.get('storyboards_data') or {}).get('storyboards') or []:
+                    samples.append(fast_json.dumps_bytes(storyboard))
+            dictionary = story_compressor.train_dictionary(samples)
+            dict_id = dictionary.dict_id()
+            dict_bytes = dictionary.as_bytes()
+
+            now = datetime.now()
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO edu_data (id, data_type, user_id, data, data_zstd, created_at, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (id) DO UPDATE SET
+                        data = EXCLUDED.data,
+                        data_zstd = EXCLUDED.data_zstd,
+                        updated_at = EXCLUDED.updated_at
+                    """, [
+                        dictionary_row_id(dict_id),
+                        DICTIONARY_DATA_TYPE,
+                        None,
+                        fast_json.dumps({'dict_id': dict_id, 'sample_count': len(samples), 'dict_size': len(dict_bytes)}),
+                        dict_bytes,
+                        now,
+                        now
+                    ])
+                    conn.commit()
+            story_compressor.load_dictionary(dict_id, dict_bytes, active=True)
+
+            return {
+                'success': True,
+                'dict_id': dict_id,
+                'sample_count': len(samples),
+                'dict_size': len(dict_bytes)
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
     
     def save_requirement(self, requirement_id: str, user_id: str, requirement_data: Dict[str, Any]) -> Dict[str, Any]:
         """保存需求数据"""
@@ -44,7 +224,7 @@ class DatabaseClient:
                         requirement_id,
                         'requirement',
                         user_id,
-                        json.dumps(requirement_data, ensure_ascii=False),
+                        fast_json.dumps(requirement_data),
                         datetime.now(),
                         datetime.now()
                     ])
@@ -129,24 +309,39 @@ class DatabaseClient:
         try:
             # 添加关联信息
             story_data['requirement_id'] = requirement_id
+            data, data_zstd = self._story_row_data(story_data)
             
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO edu_data (id, data_type, user_id, data, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (id) DO UPDATE SET
-                        data = EXCLUDED.data,
-                        updated_at = EXCLUDED.updated_at
-                    """, [
-                        story_id,
-                        'story',
-                        None,
-                        json.dumps(story_data, ensure_ascii=False),
-                        datetime.now(),
-                        datetime.now()
-                    ])
+                    if story_compressor.enabled:
+                        # 压缩模式下总是写data_zstd列，未压缩的小故事写NULL，清除旧的压缩数据
+                        cursor.execute("""
+                            INSERT INTO edu_data (id, data_type, user_id, data, data_zstd, created_at, updated_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (id) DO UPDATE SET
+                            data = EXCLUDED.data,
+                            data_zstd = EXCLUDED.data_zstd,
+                            updated_at = EXCLUDED.updated_at
+                        """, [story_id, 'story', None, data, data_zstd, datetime.now(), datetime.now()])
+                    else:
+                        cursor.execute("""
+                            INSERT INTO edu_data (id, data_type, user_id, data, created_at, updated_at)
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (id) DO UPDATE SET
+                            data = EXCLUDED.data,
+                            updated_at = EXCLUDED.updated_at
+                        """, [
+                            story_id,
+                            'story',
+                            None,
+                            data,
+                            datetime.now(),
+                            datetime.now()
+                        ])
+                    self._notify_story_changed(cursor, story_id)
                     conn.commit()
+            # 本进程立即失效，不等待通知
+            story_cache.invalidate(story_id)
             
             return {
                 'success': True,
@@ -160,20 +355,38 @@ class DatabaseClient:
             }
     
     def get_story(self, story_id: str) -> Dict[str, Any]:
-        """获取故事数据"""
+        """获取故事数据（优先读缓存，返回的data为共享对象，不要修改）
+        缓存未命中时并发读取同一故事只查询一次数据库"""
+        cached = story_cache.get(story_id)
+        if cached is not None:
+            return {
+                'success': True,
+                'data': cached['data'],
+                'updated_at': cached['updated_at']
+            }
+
+        # 键中包含缓存代数：读库期间有写入时，之后的请求重新查询，不会等到旧数据
+        generation = story_cache.generation()
+        return dict(story_read_flight.do(f"story:{story_id}:{generation}",
+                                         lambda: self._read_story(story_id, generation)))
+
+    def _read_story(self, story_id: str, generation: int) -> Dict[str, Any]:
         try:
             with self.get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                     cursor.execute("""
-                        SELECT data FROM edu_data 
+                        SELECT data, updated_at FROM edu_data 
                         WHERE id = %s AND data_type = 'story'
                     """, [story_id])
                     
                     result = cursor.fetchone()
                     if result:
+                        story_data = self._load_story_data(cursor, story_id, result['data'])
+                        story_cache.put(story_id, story_data, result['updated_at'], generation)
                         return {
                             'success': True,
-                            'data': result['data']
+                            'data': story_data,
+                            'updated_at': result['updated_at']
                         }
                     else:
                         return {
@@ -187,12 +400,26 @@ class DatabaseClient:
             }
 
     def get_latest_story(self) -> Dict[str, Any]:
-        """获取最新的故事数据"""
+        """获取最新的故事数据（优先读缓存，缓存未命中时并发请求只查询一次数据库）"""
+        latest_story_id = story_cache.get_latest_story_id()
+        cached = story_cache.get(latest_story_id) if latest_story_id else None
+        if cached is not None:
+            return {
+                'success': True,
+                'data': cached['data'],
+                'story_id': latest_story_id,
+                'updated_at': cached['updated_at']
+            }
+
+        generation = story_cache.generation()
+        return dict(story_read_flight.do(f"latest:{generation}", lambda: self._read_latest_story(generation)))
+
+    def _read_latest_story(self, generation: int) -> Dict[str, Any]:
         try:
             with self.get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                     cursor.execute("""
-                        SELECT data FROM edu_data
+                        SELECT id, data, updated_at FROM edu_data
                         WHERE data_type = 'story'
                         ORDER BY updated_at DESC, created_at DESC
                         LIMIT 1
@@ -200,9 +427,14 @@ class DatabaseClient:
 
                     result = cursor.fetchone()
                     if result:
+                        story_data = self._load_story_data(cursor, result['id'], result['data'])
+                        story_cache.put(result['id'], story_data, result['updated_at'], generation)
+                        story_cache.set_latest_story_id(result['id'], generation)
                         return {
                             'success': True,
-                            'data': result['data']
+                            'data': story_data,
+                            'story_id': result['id'],
+                            'updated_at': result['updated_at']
                         }
                     else:
                         return {
@@ -215,6 +447,52 @@ class DatabaseClient:
                 'error': str(e)
             }
 
+    def get_story_version(self, story_id: Optional[str] = None) -> Dict[str, Any]:
+        """只查询故事的版本信息（id和updated_at），不读取JSON数据，用于HTTP条件请求
+        story_id为空时查询最新的故事"""
+        cached_id = story_id or story_cache.get_latest_story_id()
+        cached = story_cache.get(cached_id) if cached_id else None
+        if cached is not None:
+            return {
+                'success': True,
+                'story_id': cached_id,
+                'updated_at': cached['updated_at']
+            }
+
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    if story_id:
+                        cursor.execute("""
+                            SELECT id, updated_at FROM edu_data
+                            WHERE id = %s AND data_type = 'story'
+                        """, [story_id])
+                    else:
+                        cursor.execute("""
+                            SELECT id, updated_at FROM edu_data
+                            WHERE data_type = 'story'
+                            ORDER BY updated_at DESC, created_at DESC
+                            LIMIT 1
+                        """)
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'success': True,
+                            'story_id': result['id'],
+                            'updated_at': result['updated_at']
+                        }
+                    else:
+                        return {
+                            'success': False,
+                            'error': 'Story not found'
+                        }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
     def get_all_stories(self) -> Dict[str, Any]:
         """获取所有故事数据"""
         try:
@@ -232,7 +510,8 @@ class DatabaseClient:
                     for row in results:
                         stories.append({
                             "id": row['id'],
-                            "data": row['data'],
+                            # 压缩的故事只返回投影（标题、学科、年级、关卡数），列表不需要解压
+                            "data": row['data'] if is_compressed_projection(row['data']) else expand_story_data(row['data']),
                             "created_at": row['created_at'].isoformat() if row['created_at'] else "",
                             "updated_at": row['updated_at'].isoformat() if row['updated_at'] else ""
                         })
@@ -248,11 +527,131 @@ class DatabaseClient:
                 'error': str(e)
             }
     
+    def get_story_header(self, story_id: str) -> Dict[str, Any]:
+        """获取故事头（报告、框架和关卡列表），不读取关卡内容"""
+        cached = story_cache.get(story_id)
+        if cached is not None:
+            return {
+                'success': True,
+                'data': story_header(cached['data']),
+                'updated_at': cached['updated_at']
+            }
+
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT data, updated_at FROM edu_data
+                        WHERE id = %s AND data_type = 'story'
+                    """, [story_id])
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'success': True,
+                            'data': self._load_story_data(cursor, story_id, result['data'], include_levels=False),
+                            'updated_at': result['updated_at']
+                        }
+                    else:
+                        return {
+                            'success': False,
+                            'error': 'Story not found'
+                        }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def _story_level_ids(self, story_id: str, start: int, end: int) -> Optional[List[str]]:
+        """stage_index 在 [start, end] 内的关卡记录ID（由故事头的关卡列表得到，不扫描关卡记录），故事不存在时返回None"""
+        header = self.get_story_header(story_id)
+        if not header.get('success'):
+            return None
+        items = (header['data'].get('storyboards_data') or {}).get('storyboards') or []
+        return [item.get('storyboard_id') or storyboard_item_row_id(story_id, item) for item in items
+                if isinstance(item.get('stage_index'), int) and start <= item['stage_index'] <= end]
+
+    def get_story_levels_version(self, story_id: str, start: int, end: int) -> Dict[str, Any]:
+        """关卡范围的版本号：故事记录和这些关卡记录中最新的updated_at（只按主键查询updated_at列）"""
+        try:
+            level_ids = self._story_level_ids(story_id, start, end)
+            if level_ids is None:
+                return {
+                    'success': False,
+                    'error': 'Story not found'
+                }
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT MAX(updated_at) AS updated_at FROM edu_data
+                        WHERE id = ANY(%s)
+                    """, [[story_id] + level_ids])
+                    result = cursor.fetchone()
+            if result and result['updated_at']:
+                return {
+                    'success': True,
+                    'story_id': story_id,
+                    'updated_at': result['updated_at']
+                }
+            return {
+                'success': False,
+                'error': 'Story not found'
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def get_story_levels(self, story_id: str, start: int, end: int) -> Dict[str, Any]:
+        """获取 stage_index 在 [start, end] 内的关卡（接口格式），按主键读取关卡记录；
+        没有关卡记录的旧故事从完整故事中截取"""
+        try:
+            level_ids = self._story_level_ids(story_id, start, end)
+            if level_ids is None:
+                return {
+                    'success': False,
+                    'error': 'Story not found'
+                }
+            rows = []
+            if level_ids:
+                with self.get_connection() as conn:
+                    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                        cursor.execute("""
+                            SELECT data FROM edu_data
+                            WHERE id = ANY(%s) AND data_type = 'storyboard'
+                        """, [level_ids])
+                        rows = cursor.fetchall()
+
+            if rows:
+                levels = sorted((storyboard_item_from_row(row['data']) for row in rows),
+                                key=lambda item: item.get('stage_index') or 0)
+            else:
+                story_result = self.get_story(story_id)
+                if not story_result.get('success'):
+                    return story_result
+                storyboards = (story_result['data'].get('storyboards_data') or {}).get('storyboards') or []
+                levels = [item for item in storyboards
+                          if isinstance(item.get('stage_index'), int) and start <= item['stage_index'] <= end]
+
+            return {
+                'success': True,
+                'data': levels,
+                'count': len(levels)
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
     def save_storyboard(self, storyboard_id: str, story_id: str, storyboard_data: Dict[str, Any]) -> Dict[str, Any]:
-        """保存分镜数据"""
+        """保存分镜数据，同一事务中更新故事记录的updated_at（故事的ETag/Last-Modified包含关卡的变化）"""
         try:
             # 添加关联信息
             storyboard_data['story_id'] = story_id
+            now = datetime.now()
             
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
@@ -266,11 +665,17 @@ class DatabaseClient:
                         storyboard_id,
                         'storyboard',
                         None,
-                        json.dumps(storyboard_data, ensure_ascii=False),
-                        datetime.now(),
-                        datetime.now()
+                        fast_json.dumps(storyboard_data),
+                        now,
+                        now
                     ])
+                    cursor.execute("""
+                        UPDATE edu_data SET updated_at = %s
+                        WHERE id = %s AND data_type = 'story'
+                    """, [now, story_id])
+                    self._notify_story_changed(cursor, story_id)
                     conn.commit()
+            story_cache.invalidate(story_id)
             
             return {
                 'success': True,
@@ -283,5 +688,290 @@ class DatabaseClient:
                 'error': str(e)
             }
 
+    def get_storyboard(self, storyboard_id: str) -> Dict[str, Any]:
+        """获取分镜数据"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT data, updated_at FROM edu_data
+                        WHERE id = %s AND data_type = 'storyboard'
+                    """, [storyboard_id])
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'success': True,
+                            'data': result['data'],
+                            'updated_at': result['updated_at']
+                        }
+                    else:
+                        return {
+                            'success': False,
+                            'error': 'Storyboard not found'
+                        }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def try_lock_requirement(self, requirement_id: str):
+        """尝试获取需求的advisory锁（会话级，所有worker之间互斥），成功时返回持有锁的连接，否则返回None
+        锁随连接释放：持有锁的worker退出时Postgres会自动释放"""
+        conn = self.get_connection()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [requirement_lock_key(requirement_id)])
+                acquired = cursor.fetchone()[0]
+        except Exception:
+            conn.close()
+            raise
+        if not acquired:
+            conn.close()
+            return None
+        return conn
+
+    def unlock_requirement(self, conn, requirement_id: str) -> None:
+        """释放 try_lock_requirement 获取的锁并关闭连接"""
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [requirement_lock_key(requirement_id)])
+        finally:
+            conn.close()
+
+    def create_generation_job(self, job_id: str, job_data: Dict[str, Any]) -> Dict[str, Any]:
+        """新建生成任务记录，已存在时不覆盖（created=False）"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO edu_data (id, data_type, user_id, data, created_at, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (id) DO NOTHING
+                        RETURNING id
+                    """, [
+                        job_id,
+                        GENERATION_JOB_DATA_TYPE,
+                        None,
+                        fast_json.dumps(job_data),
+                        datetime.now(),
+                        datetime.now()
+                    ])
+                    created = cursor.fetchone() is not None
+                    if created:
+                        cursor.execute("SELECT pg_notify(%s, %s)", [GENERATION_JOB_CHANNEL, job_id])
+                    conn.commit()
+            return {
+                'success': True,
+                'job_id': job_id,
+                'created': created
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def save_generation_job(self, job_id: str, job_data: Dict[str, Any]) -> Dict[str, Any]:
+        """更新生成任务记录（状态和进度），同一事务中通知各worker的进度流"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE edu_data SET data = %s, updated_at = %s
+                        WHERE id = %s AND data_type = %s
+                    """, [fast_json.dumps(job_data), datetime.now(), job_id, GENERATION_JOB_DATA_TYPE])
+                    cursor.execute("SELECT pg_notify(%s, %s)", [GENERATION_JOB_CHANNEL, job_id])
+                    conn.commit()
+            return {'success': True, 'job_id': job_id}
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def get_generation_job(self, job_id: str) -> Dict[str, Any]:
+        """获取生成任务记录"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT data, updated_at FROM edu_data
+                        WHERE id = %s AND data_type = %s
+                    """, [job_id, GENERATION_JOB_DATA_TYPE])
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'success': True,
+                            'data': result['data'],
+                            'updated_at': result['updated_at']
+                        }
+                    else:
+                        return {
+                            'success': False,
+                            'error': 'Generation job not found'
+                        }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def find_active_generation_job(self, requirement_id: str) -> Dict[str, Any]:
+        """查找需求正在执行的生成任务（其他请求或其他worker发起的），使用 edu_data_active_generation_job_idx"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT id, data FROM edu_data
+                        WHERE data_type = %s AND data->>'requirement_id' = %s
+                        AND data->>'status' IN ('pending', 'running')
+                        ORDER BY created_at DESC LIMIT 1
+                    """, [GENERATION_JOB_DATA_TYPE, requirement_id])
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'success': True,
+                            'job_id': result['id'],
+                            'data': result['data']
+                        }
+                    else:
+                        return {
+                            'success': False,
+                            'error': 'No active generation job'
+                        }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def save_story_with_levels(self, story_id: str, requirement_id: str, story_data: Dict[str, Any]) -> Dict[str, Any]:
+        """保存故事并把 storyboards_data 中每个关卡写成单独的关卡记录，故事记录中只保留关卡列表"""
+        timestamp = datetime.now().isoformat()
+        items = (story_data.get('storyboards_data') or {}).get('storyboards') or []
+        storyboards = [build_storyboard_row(story_id, item, timestamp) for item in items]
+        return self.save_story_bundle(story_id, requirement_id, story_data, storyboards, detach_storyboards=True)
+
+    def save_story_bundle(self, story_id: str, requirement_id: str, story_data: Dict[str, Any],
+                          storyboards: List[Tuple[str, Dict[str, Any]]],
+                          detach_storyboards: bool = False) -> Dict[str, Any]:
+        """在一个事务中保存故事主体和所有关卡故事板（一条多行 INSERT ... ON CONFLICT）
+        storyboards 为 (storyboard_id, storyboard_data) 列表；任一行失败时整体回滚
+        detach_storyboards=True 时故事记录中不再重复保存关卡的storyboard"""
+        try:
+            # 添加关联信息（与save_story/save_storyboard一致）
+            story_data['requirement_id'] = requirement_id
+            now = datetime.now()
+            data, data_zstd = self._story_row_data(story_data, story_id if detach_storyboards else None)
+            rows = [(story_id, 'story', None, data, data_zstd, now, now)]
+            for storyboard_id, storyboard_data in storyboards:
+                storyboard_data['story_id'] = story_id
+                rows.append((storyboard_id, 'storyboard', None, fast_json.dumps(storyboard_data), None, now, now))
+
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    if story_compressor.enabled:
+                        execute_values(cursor, """
+                            INSERT INTO edu_data (id, data_type, user_id, data, data_zstd, created_at, updated_at)
+                            VALUES %s
+                            ON CONFLICT (id) DO UPDATE SET
+                            data = EXCLUDED.data,
+                            data_zstd = EXCLUDED.data_zstd,
+                            updated_at = EXCLUDED.updated_at
+                        """, rows, page_size=len(rows))
+                    else:
+                        execute_values(cursor, """
+                            INSERT INTO edu_data (id, data_type, user_id, data, created_at, updated_at)
+                            VALUES %s
+                            ON CONFLICT (id) DO UPDATE SET
+                            data = EXCLUDED.data,
+                            updated_at = EXCLUDED.updated_at
+                        """, [row[:4] + row[5:] for row in rows], page_size=len(rows))
+                    self._notify_story_changed(cursor, story_id)
+                    conn.commit()
+            story_cache.invalidate(story_id)
+
+            return {
+                'success': True,
+                'story_id': story_id,
+                'storyboard_ids': [storyboard_id for storyboard_id, _ in storyboards],
+                'timestamp': now.isoformat()
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def migrate_story_storage(self, batch_size: int = 50, dry_run: bool = False) -> Dict[str, Any]:
+        """把旧格式的故事记录转换为紧凑格式（每批一个事务），返回迁移条数和转换前后的字节数"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT id FROM edu_data
+                        WHERE data_type = 'story' AND NOT (data::jsonb ? 'format_version')
+                        ORDER BY created_at
+                    """)
+                    story_ids = [row[0] for row in cursor.fetchall()]
+
+            migrated, skipped, bytes_before, bytes_after = 0, 0, 0, 0
+            for offset in range(0, len(story_ids), batch_size):
+                batch = story_ids[offset:offset + batch_size]
+                with self.get_connection() as conn:
+                    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                        # 锁住本批记录，避免与并发写入交错
+                        cursor.execute("""
+                            SELECT id, data FROM edu_data
+                            WHERE id = ANY(%s) AND data_type = 'story'
+                            FOR UPDATE
+                        """, [batch])
+                        for row in cursor.fetchall():
+                            # 原地改写无法撤销：紧凑格式不能完整还原的记录保持原样
+                            if expand_story_data(compact_story_data(row['data'])) != row['data']:
+                                skipped += 1
+                                continue
+                            original = fast_json.dumps(row['data'])
+                            # 开启压缩时同时压缩
+                            compact, data_zstd = self._story_row_data(row['data'])
+                            bytes_before += len(original.encode('utf-8'))
+                            bytes_after += len(data_zstd) if data_zstd is not None else len(compact.encode('utf-8'))
+                            migrated += 1
+                            if dry_run:
+                                continue
+                            # 内容没有变化，不更新updated_at，客户端缓存仍然有效
+                            if story_compressor.enabled:
+                                cursor.execute("UPDATE edu_data SET data = %s, data_zstd = %s WHERE id = %s",
+                                               [compact, data_zstd, row['id']])
+                            else:
+                                cursor.execute("UPDATE edu_data SET data = %s WHERE id = %s", [compact, row['id']])
+                            self._notify_story_changed(cursor, row['id'])
+                        if dry_run:
+                            conn.rollback()
+                        else:
+                            conn.commit()
+                if not dry_run:
+                    for story_id in batch:
+                        story_cache.invalidate(story_id)
+
+            return {
+                'success': True,
+                'migrated': migrated,
+                'skipped': skipped,
+                'dry_run': dry_run,
+                'bytes_before': bytes_before,
+                'bytes_after': bytes_after
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
 # 全局客户端实例
 db_client = DatabaseClient()
\ No newline at end of file
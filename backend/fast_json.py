@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+JSON快速序列化
+安装了 orjson 时使用 orjson（比标准库快数倍），否则回退到 json 标准库；
+输出与 json.dumps(..., ensure_ascii=False) 一致：中文不转义
+"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 允许非字符串键（如关卡编号用int作键），与标准库行为一致
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """序列化为UTF-8字节（响应体直接使用）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=ORJSON_OPTIONS)
+        except TypeError:
+            # orjson不支持的类型（如超过64位的整数）回退到标准库
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def dumps(obj: Any) -> str:
+    """序列化为字符串（写入数据库时使用）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=ORJSON_OPTIONS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def loads(data: Any) -> Any:
+    """反序列化，接受str或bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+对话流程中的故事生成任务：幂等键 + 需求级锁
+- ReasoningGraph 在生成故事框架和关卡之前调用 claim() 获取需求锁，AgentService 保存 story_{requirement_id} 后调用 finish() 释放
+- 同一个幂等键（/process_request 的 Idempotency-Key 请求头）的重复请求返回同一个任务，不会再次生成
+- 每个 requirement_id 同时只有一个生成任务：执行期间持有 Postgres advisory 锁，所有worker之间互斥，
+  锁被占用时新请求挂到正在执行的任务上，通过同一个进度流获取结果
+- 任务状态和进度保存在 edu_data（data_type='generation_job'），每次写入时 pg_notify(GENERATION_JOB_CHANNEL, job_id)，
+  其他worker的进度流由故事缓存的监听线程（story_cache_listener）唤醒后读取该记录；监听连接断开时退回轮询
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import fast_json
+from story_cache import story_cache_listener
+
+
+# NOTIFY通道名，payload为job_id
+GENERATION_JOB_CHANNEL = "generation_job_changed"
+# 监听连接断开时进度流的轮询间隔（秒）
+GENERATION_JOB_POLL_INTERVAL = float(os.getenv("GENERATION_JOB_POLL_INTERVAL", "1.0"))
+# 锁被占用但还查不到任务记录（持有者刚拿到锁、尚未写入）时的等待时间（秒）
+ACTIVE_JOB_LOOKUP_TIMEOUT = 3.0
+SSE_KEEPALIVE_SECONDS = 15.0
+
+FINISHED_STATUSES = ("completed", "failed")
+
+
+def generation_job_id(idempotency_key: Optional[str]) -> str:
+    """有幂等键时任务ID由幂等键决定，重复请求得到同一个ID（生成完成后会话会换新的requirement_id，因此不参与计算）"""
+    if idempotency_key:
+        digest = hashlib.sha1(idempotency_key.encode("utf-8")).hexdigest()
+        return f"generation_job_{digest[:20]}"
+    return f"generation_job_{uuid.uuid4().hex[:20]}"
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {fast_json.dumps(data)}\n\n"
+
+
+class GenerationJobManager:
+    """获取需求锁、合并重复请求、记录生成进度，并提供任务进度流"""
+
+    def __init__(self, db_client, poll_interval: float = GENERATION_JOB_POLL_INTERVAL, listener=story_cache_listener):
+        self.db_client = db_client
+        self.poll_interval = poll_interval
+        self.listener = listener
+        # 本worker执行中的任务及其持有的锁连接
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock_conns: Dict[str, Any] = {}
+        # 等待任务变化的进度流：job_id -> [(事件循环, 事件)]
+        self._waiters: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        if listener is not None:
+            listener.subscribe(GENERATION_JOB_CHANNEL, self._notify_changed)
+        self._stats = {
+            "started": 0,
+            "idempotent_replays": 0,
+            "attached": 0,
+            "completed": 0,
+            "failed": 0
+        }
+
+    async def existing(self, requirement_id: str, idempotency_key: Optional[str] = None,
+                       check_active: bool = True) -> Optional[Dict[str, Any]]:
+        """请求开始前检查：幂等键已有任务（按主键查询），或该需求正在生成时返回已有任务（attached=True），否则返回None
+        check_active=False 时不查询正在执行的任务（会话还没有进入生成阶段）"""
+        if idempotency_key:
+            replay = await self.get_job(generation_job_id(idempotency_key))
+            if replay.get("success"):
+                self._count("idempotent_replays")
+                return self._attached(replay["data"])
+        if not check_active:
+            return None
+
+        active = await asyncio.to_thread(self.db_client.find_active_generation_job, requirement_id)
+        if not active.get("success"):
+            return None
+        lock_conn = await asyncio.to_thread(self.db_client.try_lock_requirement, requirement_id)
+        if lock_conn is not None:
+            # 锁没人持有，running记录来自已退出的worker，由下一次claim()标记失败
+            await asyncio.to_thread(self.db_client.unlock_requirement, lock_conn, requirement_id)
+            return None
+        attached = await self._attach_to_active(requirement_id,
+                                                generation_job_id(idempotency_key) if idempotency_key else None)
+        return attached if attached.get("success") else None
+
+    async def claim(self, requirement_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """获取需求锁并创建任务（attached=False，之后必须调用finish）；锁被占用或幂等键重复时返回已有任务"""
+        job_id = generation_job_id(idempotency_key)
+        lock_conn = await asyncio.to_thread(self.db_client.try_lock_requirement, requirement_id)
+        if lock_conn is None:
+            return await self._attach_to_active(requirement_id, job_id if idempotency_key else None)
+
+        try:
+            # 持有锁说明没有其他任务在执行，遗留的running记录来自已退出的worker
+            stale = await asyncio.to_thread(self.db_client.find_active_generation_job, requirement_id)
+            if stale.get("success"):
+                await asyncio.to_thread(self.db_client.save_generation_job, stale["job_id"],
+                                        {**stale["data"], "status": "failed", "error": "执行任务的worker已退出"})
+
+            job = {
+                "job_id": job_id,
+                "requirement_id": requirement_id,
+                "idempotency_key": idempotency_key,
+                "status": "running",
+                "events": [],
+                "result": None,
+                "error": None,
+                "worker_pid": os.getpid(),
+                "started_at": datetime.now().isoformat()
+            }
+            created = await asyncio.to_thread(self.db_client.create_generation_job, job_id, job)
+            if not created.get("success"):
+                raise RuntimeError(created.get("error"))
+            if not created["created"]:
+                # 同一幂等键的请求已经完成了任务（在请求开始的检查之后）
+                await asyncio.to_thread(self.db_client.unlock_requirement, lock_conn, requirement_id)
+                self._count("idempotent_replays")
+                return self._attached((await self.get_job(job_id))["data"])
+        except Exception:
+            await asyncio.to_thread(self.db_client.unlock_requirement, lock_conn, requirement_id)
+            raise
+
+        with self._lock:
+            self._jobs[job_id] = job
+            self._lock_conns[job_id] = lock_conn
+            self._stats["started"] += 1
+        print(f"🚀 开始生成任务 {job_id}，需求ID: {requirement_id}")
+        return {"success": True, "job_id": job_id, "status": "running", "attached": False}
+
+    async def publish(self, job_id: str, stage: str, detail: Dict[str, Any]) -> None:
+        """记录进度并写回任务记录，其他worker的进度流从数据库读取"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job["events"].append({"stage": stage, **detail, "timestamp": datetime.now().isoformat()})
+        await asyncio.to_thread(self._persist, job)
+        self._notify_changed(job_id)
+
+    async def finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None,
+                     error: Optional[str] = None) -> None:
+        """结束任务并释放需求锁"""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            lock_conn = self._lock_conns.pop(job_id, None)
+            if job is None:
+                return
+            job.update(status=status, result=result, error=error, finished_at=datetime.now().isoformat())
+            self._stats[status] += 1
+        try:
+            await asyncio.to_thread(self._persist, job)
+        finally:
+            try:
+                await asyncio.to_thread(self.db_client.unlock_requirement, lock_conn, job["requirement_id"])
+            except Exception as e:
+                # 释放失败时连接已关闭，锁随连接一起释放
+                print(f"⚠️ 释放需求锁失败 {job['requirement_id']}: {e}")
+            self._notify_changed(job_id)
+        print(f"{'✅' if status == 'completed' else '❌'} 生成任务 {job_id} 结束: {status}")
+
+    async def abort(self, requirement_id: str, error: str) -> None:
+        """推理流程异常退出时结束本worker中该需求的任务"""
+        with self._lock:
+            job_ids = [job_id for job_id, job in self._jobs.items() if job["requirement_id"] == requirement_id]
+        for job_id in job_ids:
+            await self.finish(job_id, "failed", error=error)
+
+    async def get_job(self, job_id: str) -> Dict[str, Any]:
+        """任务状态：本worker执行中的任务直接读内存，否则读数据库记录（幂等键别名读取它指向的任务）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return {"success": True, "data": {**job, "events": list(job["events"])}}
+        result = await asyncio.to_thread(self.db_client.get_generation_job, job_id)
+        if result.get("success") and result["data"].get("alias_of"):
+            return await self.get_job(result["data"]["alias_of"])
+        return result
+
+    async def stream(self, job_id: str) -> AsyncIterator[str]:
+        """SSE进度流：依次发送 progress 事件，任务结束时发送 completed / failed 并结束
+        任务记录变化时才重新读取（NOTIFY唤醒），监听连接断开时按 poll_interval 轮询"""
+        changed = asyncio.Event()
+        watched = [job_id]
+        # 先登记再读取，读取之后的变化不会错过
+        self._add_waiter(job_id, changed)
+        sent = 0
+        last_sent_at = time.monotonic()
+        try:
+            while True:
+                changed.clear()
+                result = await self.get_job(job_id)
+                if not result.get("success"):
+                    yield format_sse("failed", {"job_id": job_id, "error": result.get("error")})
+                    return
+
+                job = result["data"]
+                if job.get("job_id") and job["job_id"] not in watched:
+                    # 幂等键别名：通知来自它指向的任务
+                    watched.append(job["job_id"])
+                    self._add_waiter(job["job_id"], changed)
+                    continue
+
+                events = job.get("events") or []
+                for event in events[sent:]:
+                    yield format_sse("progress", event)
+                if len(events) > sent:
+                    sent = len(events)
+                    last_sent_at = time.monotonic()
+
+                if job.get("status") in FINISHED_STATUSES:
+                    yield format_sse(job["status"], {"job_id": job_id, "result": job.get("result"),
+                                                     "error": job.get("error")})
+                    return
+
+                if time.monotonic() - last_sent_at >= SSE_KEEPALIVE_SECONDS:
+                    yield ": keepalive\n\n"
+                    last_sent_at = time.monotonic()
+                listening = self.listener is not None and self.listener.connected
+                try:
+                    await asyncio.wait_for(changed.wait(),
+                                           SSE_KEEPALIVE_SECONDS if listening else self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for watched_id in watched:
+                self._remove_waiter(watched_id, changed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "running": len(self._jobs)}
+
+    async def _attach_to_active(self, requirement_id: str, alias_id: Optional[str]) -> Dict[str, Any]:
+        """锁被其他请求持有：挂到正在执行的任务上；带幂等键时记录别名，之后的重复请求返回同一个任务"""
+        deadline = time.monotonic() + ACTIVE_JOB_LOOKUP_TIMEOUT
+        while True:
+            active = await asyncio.to_thread(self.db_client.find_active_generation_job, requirement_id)
+            if active.get("success"):
+                if alias_id and alias_id != active["job_id"]:
+                    await asyncio.to_thread(self.db_client.create_generation_job, alias_id, {
+                        "job_id": alias_id,
+                        "requirement_id": requirement_id,
+                        "status": "alias",
+                        "alias_of": active["job_id"]
+                    })
+                self._count("attached")
+                print(f"🔗 需求 {requirement_id} 正在生成，挂到任务 {active['job_id']}")
+                return self._attached(active["data"])
+            if time.monotonic() >= deadline:
+                return {"success": False, "error": f"需求 {requirement_id} 正在生成，但未找到任务记录"}
+            await asyncio.sleep(0.2)
+
+    @staticmethod
+    def _attached(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {"success": True, "job_id": job["job_id"], "requirement_id": job.get("requirement_id"),
+                "status": job.get("status"), "attached": True, "result": job.get("result")}
+
+    def _add_waiter(self, job_id: str, event: asyncio.Event) -> None:
+        with self._lock:
+            self._waiters.setdefault(job_id, []).append((asyncio.get_running_loop(), event))
+
+    def _remove_waiter(self, job_id: str, event: asyncio.Event) -> None:
+        with self._lock:
+            waiters = [item for item in self._waiters.get(job_id, []) if item[1] is not event]
+            if waiters:
+                self._waiters[job_id] = waiters
+            else:
+                self._waiters.pop(job_id, None)
+
+    def _notify_changed(self, job_id: Optional[str]) -> None:
+        """任务记录有变化：唤醒等待该任务的进度流（在监听线程或事件循环中调用）"""
+        with self._lock:
+            waiters = list(self._waiters.get(job_id, [])) if job_id else []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _persist(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            data = {**job, "events": list(job["events"])}
+        result = self.db_client.save_generation_job(job["job_id"], data)
+        if not result.get("success"):
+            print(f"⚠️ 保存生成任务进度失败 {job['job_id']}: {result.get('error')}")
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+
+# 便利函数
+def create_generation_job_manager(db_client, poll_interval: float = GENERATION_JOB_POLL_INTERVAL,
+                                  listener=story_cache_listener) -> GenerationJobManager:
+    """创建生成任务管理器实例"""
+    return GenerationJobManager(db_client, poll_interval, listener)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+故事读取接口的HTTP缓存
+- ETag / Last-Modified 由 edu_data.updated_at 计算，只需查询版本号，不读取JSON数据
+- 条件请求（If-None-Match / If-Modified-Since）命中时直接返回 304
+- 各接口使用各自的 Cache-Control 策略
+"""
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+# 各接口的 Cache-Control 策略
+CACHE_POLICIES = {
+    # 故事按ID读取：重新生成和关卡写入（如按需生成的图片写回）都会更新故事记录的updated_at，
+    # 短时间内可直接使用缓存，之后重新验证
+    "story_by_id": "private, max-age=300, must-revalidate",
+    # "最新"故事随时可能变化，每次都要向服务器确认
+    "latest_storyboard": "private, no-cache",
+    "storyboards_lookup": "private, no-cache",
+    # 故事头和关卡与完整故事使用同一个版本号（updated_at）
+    "story_header": "private, max-age=300, must-revalidate",
+    "story_levels": "private, max-age=300, must-revalidate",
+    # 关卡图片生成后不再变化
+    "storyboard_image": "private, max-age=86400, immutable",
+    "default": "no-store"
+}
+
+
+def _to_utc(updated_at: datetime) -> datetime:
+    """数据库中的updated_at不带时区（本地时间写入），统一转换为UTC"""
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.astimezone()
+    return updated_at.astimezone(timezone.utc)
+
+
+def make_etag(story_id: str, updated_at: datetime, variant: str = "") -> str:
+    """由story_id、updated_at和表示变体（如是否包含调试字段）计算弱ETag
+    响应可能被压缩或编码为msgpack，字节不同但语义相同，所以使用弱ETag"""
+    raw = f"{story_id}|{_to_utc(updated_at).isoformat()}|{variant}"
+    return f'W/"{hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]}"'
+
+
+def format_last_modified(updated_at: datetime) -> str:
+    """格式化为HTTP日期（GMT）"""
+    return format_datetime(_to_utc(updated_at).replace(microsecond=0), usegmt=True)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 使用弱比较"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque_tag:
+            return True
+    return False
+
+
+def is_not_modified(request: Request, etag: str, updated_at: datetime) -> bool:
+    """判断条件请求是否命中；有 If-None-Match 时忽略 If-Modified-Since"""
+    if request.method not in ("GET", "HEAD"):
+        return False
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP日期精度为秒
+        return _to_utc(updated_at).replace(microsecond=0) <= since
+    return False
+
+
+def apply_cache_headers(response: Response, etag: str, updated_at: datetime, policy: str) -> Response:
+    """设置 ETag / Last-Modified / Cache-Control"""
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = format_last_modified(updated_at)
+    response.headers["Cache-Control"] = CACHE_POLICIES.get(policy, CACHE_POLICIES["default"])
+    return response
+
+
+def not_modified_response(etag: str, updated_at: datetime, policy: str) -> Response:
+    """构建304响应（不包含响应体）"""
+    response = Response(status_code=304)
+    response.headers["Vary"] = "Accept"
+    return apply_cache_headers(response, etag, updated_at, policy)
+
+
+def conditional_response(request: Request, story_id: str, updated_at: Optional[datetime],
+                         policy: str, variant: str = "") -> Optional[Response]:
+    """只根据版本号判断：命中时返回304响应，否则返回None，由调用方继续读取数据"""
+    if updated_at is None:
+        return None
+    etag = make_etag(story_id, updated_at, variant)
+    if is_not_modified(request, etag, updated_at):
+        return not_modified_response(etag, updated_at, policy)
+    return None
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+进程内共享的HTTP客户端
+图片生成、图片下载和OpenAI/LangChain客户端共用同一个连接池：
+- keep-alive复用TCP/TLS连接，安装了h2时使用HTTP/2
+- 连接数上限和连接/读取超时，避免卡住的请求一直占用线程
+- 通过httpcore的trace扩展统计新建连接数和连接复用率
+"""
+
+import importlib.util
+import os
+import threading
+from typing import Any, Dict, Optional
+
+import httpx
+
+
+# 安装了h2才能启用HTTP/2，否则httpx会报错
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+# 图片生成一般需要几十秒，读取超时要足够长
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+
+
+class ConnectionMetrics:
+    """连接复用统计：每个请求计数一次，新建TCP连接和TLS握手分别计数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "new_connections": 0, "tls_handshakes": 0, "http2_requests": 0}
+        self._hosts: Dict[str, int] = {}
+
+    def record(self, event_name: str, host: str) -> None:
+        with self._lock:
+            if event_name in ("http11.send_request_headers.started", "http2.send_request_headers.started"):
+                self._stats["requests"] += 1
+                if event_name.startswith("http2"):
+                    self._stats["http2_requests"] += 1
+            elif event_name == "connection.connect_tcp.complete":
+                self._stats["new_connections"] += 1
+                self._hosts[host] = self._hosts.get(host, 0) + 1
+            elif event_name == "connection.start_tls.complete":
+                self._stats["tls_handshakes"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self._stats["requests"]
+            reused = max(requests - self._stats["new_connections"], 0)
+            return {
+                **self._stats,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / requests, 4) if requests else 0.0,
+                "new_connections_by_host": dict(self._hosts),
+                "http2_enabled": HTTP2_AVAILABLE
+            }
+
+
+# 全局统计实例
+http_metrics = ConnectionMetrics()
+
+
+def _attach_trace(request: httpx.Request) -> None:
+    """请求事件钩子：给同步请求挂上trace回调"""
+    host = request.url.host
+
+    def trace(event_name: str, info: Dict[str, Any]) -> None:
+        http_metrics.record(event_name, host)
+
+    request.extensions = {**request.extensions, "trace": trace}
+
+
+async def _attach_async_trace(request: httpx.Request) -> None:
+    """请求事件钩子：异步连接池要求trace回调是协程函数"""
+    host = request.url.host
+
+    async def trace(event_name: str, info: Dict[str, Any]) -> None:
+        http_metrics.record(event_name, host)
+
+    request.extensions = {**request.extensions, "trace": trace}
+
+
+def _client_options() -> Dict[str, Any]:
+    return {
+        "http2": HTTP2_AVAILABLE,
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        "timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "follow_redirects": True
+    }
+
+
+_client_lock = threading.Lock()
+_sync_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.Client:
+    """同步客户端（Stage3在线程池中生成和下载图片、OpenAI SDK）"""
+    global _sync_client
+    with _client_lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(event_hooks={"request": [_attach_trace]}, **_client_options())
+        return _sync_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """异步客户端（LangChain ChatOpenAI 的异步调用）"""
+    global _async_client
+    with _client_lock:
+        if _async_client is None or _async_client.is_closed:
+            _async_client = httpx.AsyncClient(event_hooks={"request": [_attach_async_trace]}, **_client_options())
+        return _async_client
+
+
+async def close_http_clients() -> None:
+    """应用关闭时释放连接池"""
+    global _sync_client, _async_client
+    with _client_lock:
+        sync_client, async_client = _sync_client, _async_client
+        _sync_client, _async_client = None, None
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None:
+        await async_client.aclose()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+HTTP响应编码：压缩中间件、msgpack/CBOR内容协商和响应裁剪
+- 超过阈值的响应按 Accept-Encoding 使用 brotli 或 gzip 压缩
+- 客户端通过 Accept 请求 application/msgpack 或 application/cbor 时返回二进制编码
+- 关卡图片按 Accept 头在 AVIF / WebP / 原图之间选择
+- 默认去掉调试字段（level_details）和 storyboards_data 中重复的报告内容
+"""
+
+import gzip
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+import fast_json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+CBOR_MEDIA_TYPE = "application/cbor"
+
+# 不压缩的响应类型：SSE需要逐条发送；图片、视频等已经是压缩格式，再压缩几乎不减小体积
+UNCOMPRESSED_MEDIA_PREFIXES = ("text/event-stream", "image/", "video/", "application/zstd",
+                               "application/octet-stream")
+
+# 仅用于调试的字段，默认不返回
+DEBUG_FIELDS = ("level_details",)
+# storyboards_data 中与顶层重复的字段
+DUPLICATED_REPORT_FIELDS = ("analysis_report", "story_framework", "education_assessment_report")
+
+
+class FastJSONResponse(JSONResponse):
+    """使用 orjson 序列化的JSON响应（未安装orjson时回退到标准库）"""
+
+    def render(self, content: Any) -> bytes:
+        return fast_json.dumps_bytes(content)
+
+
+def _parse_quality_list(header_value: str) -> List[Tuple[str, float]]:
+    """解析 Accept / Accept-Encoding 头，按q值从高到低排序（同q值保持原顺序）"""
+    entries = []
+    for position, item in enumerate(header_value.split(",")):
+        parts = [part.strip() for part in item.split(";")]
+        token = parts[0].lower()
+        if not token:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            entries.append((position, token, quality))
+    entries.sort(key=lambda entry: (-entry[2], entry[0]))
+    return [(token, quality) for _, token, quality in entries]
+
+
+def negotiate_media_type(accept_header: str) -> str:
+    """根据 Accept 头选择响应格式，未安装对应编码库时回退为JSON"""
+    available = {JSON_MEDIA_TYPE: JSON_MEDIA_TYPE}
+    if msgpack is not None:
+        available[MSGPACK_MEDIA_TYPE] = MSGPACK_MEDIA_TYPE
+        available["application/x-msgpack"] = MSGPACK_MEDIA_TYPE
+    if cbor2 is not None:
+        available[CBOR_MEDIA_TYPE] = CBOR_MEDIA_TYPE
+
+    for token, _ in _parse_quality_list(accept_header or ""):
+        if token in available:
+            return available[token]
+        if token in ("*/*", "application/*"):
+            return JSON_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def negotiate_image_format(accept_header: str, available: List[str], default: str = "webp") -> str:
+    """根据 Accept 头在可用图片格式中选择（available按服务端偏好排序）
+    JSON接口的 Accept 里通常没有图片类型，此时使用 default"""
+    parsed = _parse_quality_list(accept_header or "")
+    for token, _ in parsed:
+        if token.startswith("image/") and token[len("image/"):] in available:
+            return token[len("image/"):]
+        if token in ("image/*", "*/*") and any(t.startswith("image/") for t, _ in parsed):
+            return available[0]
+    return default if default in available else available[-1]
+
+
+def build_response(request: Request, content: Any, status_code: int = 200) -> Response:
+    """按客户端 Accept 头编码响应内容
+    pydantic模型只做浅层展开，不再逐层校验/序列化 data 中的故事数据"""
+    if hasattr(content, "model_fields"):
+        content = {field: getattr(content, field) for field in type(content).model_fields}
+
+    media_type = negotiate_media_type(request.headers.get("accept", ""))
+    if media_type == MSGPACK_MEDIA_TYPE:
+        response = Response(msgpack.packb(content, use_bin_type=True, default=str),
+                            status_code=status_code, media_type=MSGPACK_MEDIA_TYPE)
+    elif media_type == CBOR_MEDIA_TYPE:
+        response = Response(cbor2.dumps(content, default=lambda encoder, value: encoder.encode(str(value))),
+                            status_code=status_code, media_type=CBOR_MEDIA_TYPE)
+    else:
+        response = FastJSONResponse(content, status_code=status_code)
+
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+def shape_story_payload(data: Any, include_debug: bool = False) -> Any:
+    """裁剪响应数据：去掉调试字段和 storyboards_data 中与顶层重复的报告（浅拷贝，不修改原对象）"""
+    if not isinstance(data, dict):
+        return data
+
+    shaped = dict(data)
+    if not include_debug:
+        for field in DEBUG_FIELDS:
+            shaped.pop(field, None)
+
+    # generate_complete_storyboards 的响应把整个故事嵌套在 story_data 中
+    if isinstance(shaped.get("story_data"), dict):
+        shaped["story_data"] = shape_story_payload(shaped["story_data"], include_debug)
+
+    storyboards_data = shaped.get("storyboards_data")
+    if isinstance(storyboards_data, dict):
+        duplicated = [field for field in DUPLICATED_REPORT_FIELDS
+                      if field in storyboards_data and field in shaped and storyboards_data[field] == shaped[field]]
+        if duplicated:
+            storyboards_data = {key: value for key, value in storyboards_data.items() if key not in duplicated}
+            shaped["storyboards_data"] = storyboards_data
+
+    return shaped
+
+
+class CompressionMiddleware:
+    """响应压缩中间件：超过 minimum_size 的响应使用 brotli（优先）或 gzip 压缩，流式响应和图片等已压缩格式不处理"""
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        for token, _ in _parse_quality_list(accept_encoding):
+            if token == "br" and brotli is not None:
+                return "br"
+            if token in ("gzip", "*"):
+                return "gzip"
+        return None
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])}
+        encoding = self._choose_encoding(headers.get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Dict[str, Any] = {}
+        body_parts: List[bytes] = []
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = {key.decode("latin-1").lower(): value.decode("latin-1")
+                                    for key, value in message.get("headers", [])}
+                content_type = response_headers.get("content-type", "")
+                # 已编码、流式（SSE）或已压缩格式的响应直接透传
+                if "content-encoding" in response_headers or content_type.startswith(UNCOMPRESSED_MEDIA_PREFIXES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body_parts.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(body_parts)
+            response_headers = [(key, value) for key, value in start_message.get("headers", [])
+                                if key.lower() != b"content-length"]
+            if len(body) >= self.minimum_size:
+                body = self._compress(body, encoding)
+                response_headers.append((b"content-encoding", encoding.encode("latin-1")))
+                vary = [value for key, value in response_headers if key.lower() == b"vary"]
+                response_headers = [(key, value) for key, value in response_headers if key.lower() != b"vary"]
+                vary_values = [v.strip() for value in vary for v in value.decode("latin-1").split(",") if v.strip()]
+                if "accept-encoding" not in [v.lower() for v in vary_values]:
+                    vary_values.append("Accept-Encoding")
+                response_headers.append((b"vary", ", ".join(vary_values).encode("latin-1")))
+            # 304/204 不能带响应体长度
+            if start_message.get("status") not in (204, 304):
+                response_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+
+            await send({**start_message, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+关卡图片缓存
+重新生成或复制的故事经常产生完全相同的图片提示词，按
+(规范化提示词, 模型, 尺寸, 质量) 的哈希把生成结果保存在本地磁盘，
+重复生成直接读盘；目录总大小超过上限时按最近使用时间淘汰
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+import fast_json
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', 'image_cache')
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# 淘汰时清理到上限的比例，避免每次写入都触发淘汰
+EVICTION_TARGET_RATIO = 0.9
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化提示词：全角/半角统一、合并空白"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def image_cache_key(prompt: str, model: str, size: str, quality: str) -> str:
+    raw = "\n".join([normalize_prompt(prompt), model, size, quality])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LocalBlobStore:
+    """本地磁盘blob存储：<root>/<key前2位>/<key>.<扩展名>，另存一个 .json 元数据文件"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2])
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self._dir(key), f"{key}.json")
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._meta_path(key))
+
+    def read(self, key: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        meta_path = self._meta_path(key)
+        try:
+            with open(meta_path, "rb") as f:
+                meta = json.loads(f.read())
+            blob_path = os.path.join(self._dir(key), meta["file_name"])
+            with open(blob_path, "rb") as f:
+                content = f.read()
+            # 更新访问时间，用于LRU淘汰
+            os.utime(meta_path)
+            return content, meta
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self, key: str, content: bytes, file_extension: str, meta: Dict[str, Any]) -> int:
+        """原子写入（先写临时文件再rename），返回写入的字节数"""
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+        file_name = f"{key}.{file_extension}"
+        meta = {**meta, "file_name": file_name, "size": len(content)}
+        meta_bytes = fast_json.dumps_bytes(meta)
+
+        for path, data in ((os.path.join(directory, file_name), content), (self._meta_path(key), meta_bytes)):
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return len(content) + len(meta_bytes)
+
+    def delete(self, key: str) -> int:
+        """删除blob和元数据，返回释放的字节数"""
+        freed = 0
+        directory = self._dir(key)
+        if not os.path.isdir(directory):
+            return 0
+        for name in os.listdir(directory):
+            if name.startswith(key):
+                path = os.path.join(directory, name)
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    pass
+        return freed
+
+    def entries(self) -> List[Tuple[str, float, int]]:
+        """所有条目 (key, 最近访问时间, 占用字节)"""
+        result = []
+        if not os.path.isdir(self.root):
+            return result
+        for sub in os.listdir(self.root):
+            directory = os.path.join(self.root, sub)
+            if not os.path.isdir(directory):
+                continue
+            sizes: Dict[str, int] = {}
+            last_used: Dict[str, float] = {}
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                key = name.split(".", 1)[0]
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                sizes[key] = sizes.get(key, 0) + stat.st_size
+                if name.endswith(".json"):
+                    last_used[key] = stat.st_mtime
+            result.extend((key, last_used.get(key, 0.0), size) for key, size in sizes.items())
+        return result
+
+
+class ImageCache:
+    """图片生成结果缓存（线程安全，Stage3在线程池中调用）"""
+
+    def __init__(self, store: LocalBlobStore, max_bytes: int = DEFAULT_MAX_BYTES, enabled: bool = True):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None  # 第一次使用时扫描目录
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "errors": 0}
+
+    def get(self, prompt: str, model: str, size: str, quality: str) -> Optional[Dict[str, Any]]:
+        """命中时返回与 SceneGenerator._generate_image 相同格式的结果"""
+        if not self.enabled:
+            return None
+        key = image_cache_key(prompt, model, size, quality)
+        cached = self.store.read(key)
+        with self._lock:
+            self._stats["hits" if cached else "misses"] += 1
+        if not cached:
+            return None
+        content, meta = cached
+        image = {
+            "base64_data": base64.b64encode(content).decode("utf-8"),
+            "file_extension": meta.get("file_extension", "png"),
+            "original_url": meta.get("original_url")
+        }
+        if meta.get("variants"):
+            image["variants"] = meta["variants"]
+        return image
+
+    def put(self, prompt: str, model: str, size: str, quality: str, image: Dict[str, Any]) -> None:
+        """保存原图；带 variants 时在元数据中保存衍生版本的引用（blob单独存储），命中时不需要重新转码"""
+        if not self.enabled or not image.get("base64_data"):
+            return
+        key = image_cache_key(prompt, model, size, quality)
+        try:
+            content = base64.b64decode(image["base64_data"])
+            written = self.store.write(key, content, image.get("file_extension", "png"), {
+                "file_extension": image.get("file_extension", "png"),
+                "original_url": image.get("original_url"),
+                "model": model,
+                "size": size,
+                "quality": quality,
+                "variants": image.get("variants")
+            })
+        except Exception as e:
+            print(f"⚠️ 图片缓存写入失败: {e}")
+            with self._lock:
+                self._stats["errors"] += 1
+            return
+
+        with self._lock:
+            self._stats["writes"] += 1
+            self._ensure_total_bytes()
+            self._total_bytes += written
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "enabled": self.enabled,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": round(self._stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+    def _ensure_total_bytes(self) -> None:
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, _, size in self.store.entries())
+
+    def _evict(self) -> None:
+        """按最近使用时间从旧到新删除，直到低于上限的90%（调用方持有锁）"""
+        target = int(self.max_bytes * EVICTION_TARGET_RATIO)
+        entries = sorted(self.store.entries(), key=lambda entry: entry[1])
+        self._total_bytes = sum(size for _, _, size in entries)
+        for key, _, _ in entries:
+            if self._total_bytes <= target:
+                break
+            self._total_bytes -= self.store.delete(key)
+            self._stats["evictions"] += 1
+
+
+# 全局缓存实例
+image_cache = ImageCache(
+    LocalBlobStore(os.getenv("IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR)),
+    max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(DEFAULT_MAX_BYTES))),
+    enabled=os.getenv("IMAGE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+关卡图片衍生版本
+生成图片后在进程池中转码（不占用事件循环所在进程的GIL）：
+- 原尺寸、512px、256px 三种尺寸，分别编码为 WebP 和 AVIF（Pillow支持AVIF时）
+- 每个衍生版本作为单独的blob保存在 LocalBlobStore（键为 图片提示词哈希_尺寸_格式），
+  故事板记录和图片缓存元数据中只保存引用（generated_image["variants"]: key、宽高、字节数），
+  接口按尺寸和 Accept 头选择版本时只读取需要的那一个blob
+未安装Pillow时不生成衍生版本，blob缺失时接口回退到原图
+"""
+
+import base64
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from image_cache import LocalBlobStore
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# 尺寸标签 -> 最长边像素（None为原尺寸）
+VARIANT_SIZES = {"full": None, "512": 512, "256": 256}
+# 编码质量
+ENCODE_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "avif": {"format": "AVIF", "quality": 60}
+}
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
+IMAGE_VARIANT_TIMEOUT = float(os.getenv("IMAGE_VARIANT_TIMEOUT", "60"))
+# 衍生版本blob目录（被故事板记录引用，不参与图片缓存的淘汰）
+DEFAULT_VARIANT_DIR = os.path.join(os.path.dirname(__file__), '..', 'image_variants')
+
+
+def variant_key(size: str, image_format: str) -> str:
+    return f"{size}_{image_format}"
+
+
+def variant_blob_key(image_key: str, variant: str) -> str:
+    """衍生版本blob的键：图片提示词哈希（image_cache_key）+ 版本"""
+    return f"{image_key}_{variant}"
+
+
+def _supported_formats() -> List[str]:
+    """当前进程中Pillow可以编码的格式（AVIF需要libavif或pillow-avif-plugin）"""
+    formats = ["webp"]
+    try:
+        from PIL import features
+        if features.check("avif"):
+            return formats + ["avif"]
+    except Exception:
+        pass
+    try:
+        import pillow_avif  # noqa: F401  导入即注册AVIF编码器
+        formats.append("avif")
+    except ImportError:
+        pass
+    return formats
+
+
+def render_variants(image_bytes: bytes, sizes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """在工作进程中执行：解码原图，按尺寸缩放并编码为各格式（返回图片字节）"""
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        source.load()
+        image = source.convert("RGBA" if "A" in source.getbands() else "RGB")
+
+    variants = {}
+    formats = _supported_formats()
+    for size in sizes:
+        max_side = VARIANT_SIZES[size]
+        resized = image
+        if max_side and max(image.size) > max_side:
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        for image_format in formats:
+            options = dict(ENCODE_OPTIONS[image_format])
+            buffer = io.BytesIO()
+            resized.save(buffer, **options)
+            content = buffer.getvalue()
+            variants[variant_key(size, image_format)] = {
+                "content": content,
+                "file_extension": image_format,
+                "width": resized.width,
+                "height": resized.height,
+                "bytes": len(content)
+            }
+    return variants
+
+
+class ImageVariantPipeline:
+    """衍生图片生成：Stage3的线程池线程提交到进程池并等待结果"""
+
+    def __init__(self, store: LocalBlobStore, max_workers: int = IMAGE_VARIANT_WORKERS,
+                 timeout: float = IMAGE_VARIANT_TIMEOUT):
+        self.store = store
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stats = {"jobs": 0, "failures": 0, "original_bytes": 0, "thumbnail_256_bytes": 0,
+                       "blob_reads": 0, "missing_blobs": 0}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None and self.max_workers > 0
+
+    def has_variants(self, generated_image: Optional[Dict[str, Any]]) -> bool:
+        """图片带有衍生版本引用，且引用的blob都存在"""
+        variants = (generated_image or {}).get("variants") or {}
+        return bool(variants) and all(self.store.exists(ref["key"]) for ref in variants.values() if "key" in ref)
+
+    def add_variants(self, generated_image: Optional[Dict[str, Any]], image_key: str) -> Optional[Dict[str, Any]]:
+        """转码并把各版本写入blob存储，返回带 variants 引用的新字典；已有完整引用、失败或不可用时原样返回
+        image_key: 原图的 image_cache_key，相同提示词的图片共用衍生版本blob"""
+        if not self.available or not generated_image or self.has_variants(generated_image):
+            return generated_image
+
+        try:
+            original = base64.b64decode(generated_image["base64_data"])
+            future = self._get_executor().submit(render_variants, original, list(VARIANT_SIZES))
+            rendered = future.result(timeout=self.timeout)
+            variants = {}
+            for variant, encoded in rendered.items():
+                content = encoded.pop("content")
+                key = variant_blob_key(image_key, variant)
+                self.store.write(key, content, encoded["file_extension"], encoded)
+                variants[variant] = {"key": key, **encoded}
+        except Exception as e:
+            print(f"⚠️ 图片衍生版本生成失败，使用原图: {e}")
+            with self._lock:
+                self._stats["failures"] += 1
+            return generated_image
+
+        with self._lock:
+            self._stats["jobs"] += 1
+            self._stats["original_bytes"] += len(original)
+            self._stats["thumbnail_256_bytes"] += variants.get(variant_key("256", "webp"), {}).get("bytes", 0)
+        return {**generated_image, "variants": variants}
+
+    def load_variant(self, ref: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """读取引用的blob，返回与原图相同格式的图片（base64_data）；blob缺失时返回None"""
+        if "base64_data" in ref:
+            # 旧记录中衍生版本直接保存在记录里
+            return dict(ref)
+        cached = self.store.read(ref["key"])
+        with self._lock:
+            self._stats["blob_reads" if cached else "missing_blobs"] += 1
+        if not cached:
+            return None
+        content, _ = cached
+        return {**{key: value for key, value in ref.items() if key != "key"},
+                "base64_data": base64.b64encode(content).decode("utf-8")}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "available": self.available, "workers": self.max_workers}
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # 服务进程中有监听线程和连接池，用spawn避免fork复制这些线程的锁状态
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+
+def select_image_variant(generated_image: Optional[Dict[str, Any]], size: str = "full",
+                         image_format: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """按尺寸和格式选择图片版本（只读取选中版本的blob），没有对应版本时返回原图（都不包含 variants 字段）"""
+    if not generated_image:
+        return generated_image
+
+    original = {key: value for key, value in generated_image.items() if key != "variants"}
+    variants = generated_image.get("variants") or {}
+    if image_format and image_format != original.get("file_extension"):
+        ref = variants.get(variant_key(size, image_format))
+        variant = image_variant_pipeline.load_variant(ref) if ref else None
+        if variant:
+            return {**variant, "original_url": original.get("original_url"), "variant": variant_key(size, image_format)}
+    return original
+
+
+def available_formats(generated_image: Optional[Dict[str, Any]], size: str = "full") -> List[str]:
+    """某个尺寸下可选的格式（按偏好排序），原图格式在最后"""
+    variants = (generated_image or {}).get("variants") or {}
+    formats = [image_format for image_format in ("avif", "webp") if variant_key(size, image_format) in variants]
+    return formats + [(generated_image or {}).get("file_extension", "png")]
+
+
+# 全局实例
+image_variant_pipeline = ImageVariantPipeline(LocalBlobStore(os.getenv("IMAGE_VARIANT_DIR", DEFAULT_VARIANT_DIR)))
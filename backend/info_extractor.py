@@ -4,6 +4,8 @@ from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from langchain_openai import ChatOpenAI
 from typing import List, Optional, Dict, Any
+from http_client import get_http_client, get_async_http_client
+from local_extractor import LOCAL_EXTRACTION, local_info_extractor, local_extraction_metrics
 
 
 # 拆分的模型定义
@@ -17,6 +19,14 @@ class BasicInfoExtracted(BaseModel):
         extra = "forbid"
 
 
+class KnowledgePointsExtracted(BaseModel):
+    """知识点提取模型（年级、学科已由本地词表识别）"""
+    knowledge_points: Optional[List[str]] = Field(None, description="具体知识点列表")
+    
+    class Config:
+        extra = "forbid"
+
+
 class TeachingInfoExtracted(BaseModel):
     """教学信息提取模型"""
     teaching_goals: Optional[List[str]] = Field(None, description="教学目标列表")
@@ -72,9 +82,10 @@ class ExtractedInfo(BaseModel):
 
 
 class InfoExtractor:
-    def __init__(self, llm: ChatOpenAI):
+    def __init__(self, llm: ChatOpenAI, local_extraction: bool = LOCAL_EXTRACTION):
         """初始化信息提取器"""
         self.llm = llm
+        self.local_extraction = local_extraction
         
         # 为每个stage创建parser
         self.parsers = {
@@ -83,10 +94,79 @@ class InfoExtractor:
             "gamestyle_info": PydanticOutputParser(pydantic_object=GameStyleExtracted),
             "scene_info": PydanticOutputParser(pydantic_object=SceneInfoExtracted)
         }
+        self.knowledge_points_parser = PydanticOutputParser(pydantic_object=KnowledgePointsExtracted)
 
     async def extract_from_user_input(self, user_input: str, stage: str = "basic_info") -> Dict[str, Any]:
         """从用户输入中提取信息 - 根据stage使用不同的parser"""
+        if self.local_extraction and stage == "basic_info":
+            return await self._extract_basic_info_locally(user_input)
+        return await self._extract_with_llm(user_input, stage)
+
+    async def _extract_basic_info_locally(self, user_input: str) -> Dict[str, Any]:
+        """年级、学科、知识点先查课程词表，还有词表外的内容时再调用LLM并合并知识点
+        年级和学科都已识别时只让LLM提取知识点，不做完整的basic_info提取"""
+        extraction = local_info_extractor.extract(user_input)
+        local_fields = extraction["fields"]
+        needs_llm = local_info_extractor.needs_llm(extraction)
+        knowledge_points_only = needs_llm and local_info_extractor.knowledge_points_only(extraction)
+        local_extraction_metrics.record(needs_llm, knowledge_points_only)
+
+        if not needs_llm:
+            print(f"Extracted locally for basic_info: {local_fields}")
+            return dict(local_fields)
+
+        if knowledge_points_only:
+            llm_fields = await self._extract_knowledge_points_with_llm(user_input, local_fields)
+        else:
+            llm_fields = await self._extract_with_llm(user_input, "basic_info")
+        # 词表识别出的学科和年级是规范名称，优先于LLM结果；知识点合并（词表外的知识点来自LLM）
+        merged = {**llm_fields, **local_fields}
+        knowledge_points = list(local_fields.get("knowledge_points") or [])
+        llm_points = llm_fields.get("knowledge_points") or []
+        for point in llm_points if isinstance(llm_points, list) else [llm_points]:
+            if point and point not in knowledge_points:
+                knowledge_points.append(point)
+        if knowledge_points:
+            merged["knowledge_points"] = knowledge_points
+        return merged
+
+    async def _extract_knowledge_points_with_llm(self, user_input: str, local_fields: Dict[str, Any]) -> Dict[str, Any]:
+        """只提取知识点的短prompt（年级、学科已识别），返回 {"knowledge_points": [...]} 或空字典"""
+        try:
+            parser = self.knowledge_points_parser
+            extraction_prompt = PromptTemplate(
+                template="""
+从用户输入中提取{grade}{subject}的具体知识点。只提取用户明确说出的知识点或教学方法（如"凑十法"），
+难度、语气等要求不是知识点；没有知识点时返回null。
+
+{format_instructions}
+
+用户输入："{user_input}"
+""",
+                input_variables=["user_input"],
+                partial_variables={
+                    "grade": local_fields.get("grade", ""),
+                    "subject": local_fields.get("subject", ""),
+                    "format_instructions": parser.get_format_instructions()
+                }
+            )
+
+            chain = LLMChain(
+                llm=self.llm,
+                prompt=extraction_prompt,
+                output_parser=parser
+            )
+
+            result = await chain.arun(user_input=user_input)
+            print(f"Extracted knowledge points: {result.dict()}")
+            return result.dict(exclude_none=True)
+
+        except Exception as e:
+            print(f"知识点提取失败: {e}")
+            return {}
 
+    async def _extract_with_llm(self, user_input: str, stage: str) -> Dict[str, Any]:
+        """调用LLM按stage的parser提取"""
         try:
             # 获取对应stage的parser
             parser = self.parsers.get(stage, self.parsers["basic_info"])
@@ -161,7 +241,7 @@ class InfoExtractor:
 
 
 # 便利函数
-def create_info_extractor(model_name: str = "gpt-4o-mini") -> InfoExtractor:
+def create_info_extractor(model_name: str = "gpt-4o-mini", local_extraction: bool = LOCAL_EXTRACTION) -> InfoExtractor:
     """创建信息提取器的便利函数"""
     import os
     from dotenv import load_dotenv
@@ -170,6 +250,8 @@ def create_info_extractor(model_name: str = "gpt-4o-mini") -> InfoExtractor:
     llm = ChatOpenAI(
         model=model_name, 
         temperature=0.3,
-        openai_api_key=os.getenv("OPENAI_API_KEY")
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client()
     )
-    return InfoExtractor(llm)
\ No newline at end of file
+    return InfoExtractor(llm, local_extraction=local_extraction)
\ No newline at end of file
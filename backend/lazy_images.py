@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+关卡图片按需生成
+LAZY_IMAGE_GENERATION 开启时，Stage3只保存"图片提示词"，图片在故事板页面第一次请求时才生成：
+- 同一个故事板的并发请求只触发一次生成（single_flight.py，进程内）
+- 生成后写回故事板记录，之后的请求直接读取
+- 返回当前关卡后在后台预取下一关的图片
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Set
+
+from single_flight import get_single_flight
+
+
+def storyboard_key(story_id: str, stage_id: str) -> str:
+    """故事板记录ID，与 SceneGenerator._save_stage3_to_database 一致"""
+    return f"storyboard_{story_id}_{stage_id}"
+
+
+class LazyImageService:
+    """按需生成关卡图片，并发请求合并为一次生成"""
+
+    def __init__(self, scene_generator, db_client, prefetch_next: bool = True):
+        self.scene_generator = scene_generator
+        self.db_client = db_client
+        self.prefetch_next = prefetch_next
+        # 进行中的生成任务
+        self._flight = get_single_flight("storyboard_image")
+        self._prefetch_tasks: Set[asyncio.Task] = set()
+        self._stats = {
+            "requests": 0,
+            "stored_hits": 0,
+            "generations": 0,
+            "deduplicated": 0,
+            "prefetches": 0,
+            "failures": 0
+        }
+
+    async def get_stage_image(self, story_id: str, stage_id: str) -> Dict[str, Any]:
+        """获取关卡图片，没有时生成；成功后预取下一关"""
+        self._stats["requests"] += 1
+        # 只有发起生成的请求负责预取，等待中的并发请求不重复预取
+        is_leader = not self._flight.in_flight(storyboard_key(story_id, stage_id))
+        result = await self._get_or_generate(story_id, stage_id)
+        if result.get("success") and self.prefetch_next and is_leader:
+            self._schedule_prefetch(story_id, stage_id)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self._stats, "inflight": self._flight.snapshot()["inflight"], "prefetching": len(self._prefetch_tasks)}
+
+    async def _get_or_generate(self, story_id: str, stage_id: str) -> Dict[str, Any]:
+        """single-flight：同一故事板已有生成任务时等待它的结果"""
+        key = storyboard_key(story_id, stage_id)
+        if self._flight.in_flight(key):
+            self._stats["deduplicated"] += 1
+        # 客户端断开时仍然生成并写回故事板，下次请求直接读取
+        return await self._flight.do_async(key, lambda: self._load_or_generate_safely(story_id, stage_id),
+                                           cancel_when_abandoned=False)
+
+    async def _load_or_generate_safely(self, story_id: str, stage_id: str) -> Dict[str, Any]:
+        """结果（包括失败）都作为返回值交给等待者，不抛异常"""
+        try:
+            return await self._load_or_generate(story_id, stage_id)
+        except Exception as e:
+            print(f"❌ {storyboard_key(story_id, stage_id)} 图片获取异常: {e}")
+            return {"success": False, "error": str(e)}
+
+    async def _load_or_generate(self, story_id: str, stage_id: str) -> Dict[str, Any]:
+        key = storyboard_key(story_id, stage_id)
+        storyboard_result = await asyncio.to_thread(self.db_client.get_storyboard, key)
+        if not storyboard_result.get("success"):
+            return {"success": False, "error": f"未找到故事板: {key}"}
+
+        storyboard_data = storyboard_result["data"]
+        image_data = storyboard_data.get("image_data") or {}
+        if image_data.get("generated_image"):
+            self._stats["stored_hits"] += 1
+            return {"success": True, "image": image_data["generated_image"], "generated": False}
+
+        image_prompt = image_data.get("prompt") or (storyboard_data.get("full_storyboard") or {}).get("图片提示词")
+        if not image_prompt:
+            return {"success": False, "error": f"故事板缺少图片提示词: {key}"}
+
+        print(f"🎨 按需生成图片: {key}")
+        self._stats["generations"] += 1
+        generated = await asyncio.to_thread(self.scene_generator._generate_image, image_prompt, stage_id)
+        if not generated:
+            self._stats["failures"] += 1
+            return {"success": False, "error": f"图片生成失败: {key}"}
+
+        # 写回故事板记录（复制后修改，不改动读取到的共享数据）
+        updated = dict(storyboard_data)
+        updated["image_data"] = {
+            **image_data,
+            "prompt": image_prompt,
+            "generated_image": generated,
+            "image_format": "base64"
+        }
+        updated["generation_status"] = {**(storyboard_data.get("generation_status") or {}), "image": "success"}
+        save_result = await asyncio.to_thread(self.db_client.save_storyboard, key, story_id, updated)
+        if not save_result.get("success"):
+            print(f"⚠️ {key} 图片已生成但保存失败: {save_result.get('error')}")
+
+        return {"success": True, "image": generated, "generated": True}
+
+    def _schedule_prefetch(self, story_id: str, stage_id: str) -> None:
+        task = asyncio.create_task(self._prefetch(story_id, stage_id))
+        self._prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, story_id: str, stage_id: str) -> None:
+        """后台生成下一关的图片（已有图片或正在生成时不会重复生成）"""
+        try:
+            story_result = await asyncio.to_thread(self.db_client.get_story, story_id)
+            if not story_result.get("success"):
+                return
+            for next_stage_id in self._next_stage_ids(story_result["data"], stage_id):
+                self._stats["prefetches"] += 1
+                await self._get_or_generate(story_id, next_stage_id)
+        except Exception as e:
+            print(f"⚠️ 预取下一关图片失败: {e}")
+
+    @staticmethod
+    def _next_stage_ids(story_data: Dict[str, Any], stage_id: str) -> List[str]:
+        """下一关：优先使用关卡的"下一关选项"，否则按关卡顺序取下一个"""
+        stages = story_data.get("stages_data") or []
+        stage_ids = [stage.get("关卡编号") for stage in stages]
+        if stage_id not in stage_ids:
+            return []
+
+        current = stages[stage_ids.index(stage_id)]
+        options = current.get("下一关选项") or {}
+        option_ids = options.values() if isinstance(options, dict) else options
+        next_ids = [option for option in option_ids if isinstance(option, str) and option in stage_ids]
+        if next_ids:
+            return next_ids
+
+        position = stage_ids.index(stage_id)
+        if current.get("是否结束节点") or position + 1 >= len(stage_ids):
+            return []
+        return [stage_ids[position + 1]]
+
+
+# 便利函数
+def create_lazy_image_service(scene_generator, db_client, prefetch_next: bool = True) -> LazyImageService:
+    """创建按需图片服务实例"""
+    return LazyImageService(scene_generator, db_client, prefetch_next)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基础信息本地提取
+年级、学科和常见知识点都是固定的词汇，用课程词表 + Aho-Corasick多模式匹配一次扫描即可提取，
+不需要调用LLM；教学目标、情节需求等自由文本字段仍由LLM提取
+词表外还有内容时：年级和学科都已识别则只用LLM补充知识点（短prompt），否则调用完整的basic_info提取
+"""
+
+import os
+import re
+import threading
+from collections import deque
+from typing import Any, Dict, List, Tuple
+
+
+# 开启后basic_info阶段先用本地词表提取，只有还剩词表外的内容时才调用LLM
+LOCAL_EXTRACTION = os.getenv("LOCAL_EXTRACTION", "false").lower() in ("1", "true", "yes")
+
+# 年级：规范名称 -> 别名
+GRADE_LEXICON = {
+    "一年级": ["一年级", "1年级", "小学一年级", "小一"],
+    "二年级": ["二年级", "2年级", "小学二年级", "小二"],
+    "三年级": ["三年级", "3年级", "小学三年级", "小三"],
+    "四年级": ["四年级", "4年级", "小学四年级", "小四"],
+    "五年级": ["五年级", "5年级", "小学五年级", "小五"],
+    "六年级": ["六年级", "6年级", "小学六年级", "小六"],
+    "初一": ["初一", "七年级", "7年级", "初中一年级"],
+    "初二": ["初二", "八年级", "8年级", "初中二年级"],
+    "初三": ["初三", "九年级", "9年级", "初中三年级"],
+    "高一": ["高一", "高中一年级"],
+    "高二": ["高二", "高中二年级"],
+    "高三": ["高三", "高中三年级"],
+    # 只说学段时保留学段（"高中数学导数"），具体年级由后续对话补充
+    "小学": ["小学"],
+    "初中": ["初中"],
+    "高中": ["高中"]
+}
+
+# 学科：规范名称 -> 别名
+SUBJECT_LEXICON = {
+    "数学": ["数学"],
+    "语文": ["语文"],
+    "英语": ["英语", "英文"],
+    "科学": ["科学"],
+    "物理": ["物理"],
+    "化学": ["化学"],
+    "生物": ["生物"],
+    "历史": ["历史"],
+    "地理": ["地理"],
+    "道德与法治": ["道德与法治", "道法", "思想品德"],
+    "音乐": ["音乐"],
+    "美术": ["美术"],
+    "信息技术": ["信息技术", "编程"]
+}
+
+# 常见课程知识点
+KNOWLEDGE_POINT_LEXICON = [
+    # 数学
+    "加法", "减法", "乘法", "除法", "加减法", "乘除法", "四则运算", "乘法口诀", "进位加法", "退位减法",
+    "分数", "小数", "百分数", "比例", "方程", "一元一次方程", "因数", "倍数", "质数", "约分", "通分",
+    "面积", "周长", "体积", "长方形", "正方形", "三角形", "圆", "角", "平行四边形", "数字大小比较",
+    "认识钟表", "认识时间", "认识人民币", "统计", "概率", "负数", "函数", "勾股定理",
+    # 语文
+    "拼音", "声母", "韵母", "识字", "汉字", "笔画", "偏旁部首", "古诗", "成语", "标点符号",
+    "阅读理解", "作文", "修辞手法", "比喻", "拟人", "文言文",
+    # 英语
+    "字母", "单词", "语法", "时态", "一般现在时", "现在进行时", "过去时", "自然拼读", "音标", "句型",
+    # 科学 / 物理 / 化学 / 生物 / 地理
+    "植物", "动物", "光合作用", "水的循环", "天气", "四季", "太阳系", "电路", "磁铁", "力", "浮力",
+    "杠杆", "光的反射", "声音", "物态变化", "细胞", "元素周期表", "化学反应", "食物链", "生态系统",
+    "地球", "经纬度", "地图"
+]
+
+# 知识点前的数量范围，例如"10以内的加法"
+RANGE_PREFIX_PATTERN = re.compile(r"(\d+|[一二三四五六七八九十百千万]+)以内的?$")
+# 去掉已识别词汇和常见字词后仍有这么多字符，说明可能还有词表外的知识点（如"凑十法""导数"）
+RESIDUAL_TEXT_THRESHOLD = 2
+# 不算作内容的常见字词
+FILLER_PATTERN = re.compile(r"[我想要给为的了是和与及、，。！？,.!?\s学生孩子做一个款游戏教学习课程希望主要重点内容知识点"
+                            r"帮请设计下吧呢啊吗好还有以及]")
+
+
+class AhoCorasick:
+    """Aho-Corasick多模式匹配自动机：一次扫描找出所有词表词汇"""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, Any]]] = [[]]
+
+    def add(self, pattern: str, value: Any) -> None:
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((pattern, value))
+
+    def build(self) -> "AhoCorasick":
+        """广度优先计算失配指针"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        return self
+
+    def find_all(self, text: str) -> List[Tuple[int, int, str, Any]]:
+        """返回所有匹配 (start, end, pattern, value)"""
+        matches = []
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern, value in self._output[state]:
+                matches.append((index - len(pattern) + 1, index + 1, pattern, value))
+        return matches
+
+    def find_longest(self, text: str) -> List[Tuple[int, int, str, Any]]:
+        """最左最长、互不重叠的匹配"""
+        matches = sorted(self.find_all(text), key=lambda match: (match[0], -(match[1] - match[0])))
+        selected = []
+        covered_until = 0
+        for match in matches:
+            if match[0] >= covered_until:
+                selected.append(match)
+                covered_until = match[1]
+        return selected
+
+
+class LocalInfoExtractor:
+    """基于课程词表的基础信息提取（subject / grade / knowledge_points）"""
+
+    def __init__(self):
+        self.automaton = AhoCorasick()
+        for canonical, aliases in GRADE_LEXICON.items():
+            for alias in aliases:
+                self.automaton.add(alias, ("grade", canonical))
+        for canonical, aliases in SUBJECT_LEXICON.items():
+            for alias in aliases:
+                self.automaton.add(alias, ("subject", canonical))
+        for point in KNOWLEDGE_POINT_LEXICON:
+            self.automaton.add(point, ("knowledge_points", point))
+        self.automaton.build()
+
+    def extract(self, user_input: str) -> Dict[str, Any]:
+        """返回 {字段: 值}（只包含识别到的字段）和 residual（去掉识别词汇后剩余的内容）"""
+        text = user_input or ""
+        result: Dict[str, Any] = {}
+        knowledge_points: List[str] = []
+        residual = text
+
+        for start, end, pattern, (field, value) in self.automaton.find_longest(text):
+            residual = residual.replace(pattern, " ")
+            if field == "knowledge_points":
+                prefix = RANGE_PREFIX_PATTERN.search(text[:start])
+                point = f"{prefix.group(1)}以内{value}" if prefix else value
+                if prefix:
+                    residual = residual.replace(prefix.group(0), " ")
+                if point not in knowledge_points:
+                    knowledge_points.append(point)
+            elif field not in result:
+                # 同一字段出现多次时取第一次出现的
+                result[field] = value
+
+        if knowledge_points:
+            result["knowledge_points"] = knowledge_points
+        result_residual = FILLER_PATTERN.sub("", residual)
+        return {"fields": result, "residual": result_residual}
+
+    def needs_llm(self, extraction: Dict[str, Any]) -> bool:
+        """还有未识别的内容时可能有词表外的知识点（即使已经识别出部分知识点），需要LLM"""
+        return len(extraction["residual"]) >= RESIDUAL_TEXT_THRESHOLD
+
+    def knowledge_points_only(self, extraction: Dict[str, Any]) -> bool:
+        """年级和学科都已识别，LLM只需要补充词表外的知识点"""
+        fields = extraction["fields"]
+        return bool(fields.get("grade") and fields.get("subject"))
+
+
+class LocalExtractionMetrics:
+    """本地提取统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # knowledge_points_fallback：llm_fallback 中只提取知识点的调用
+        self._stats = {"local_only": 0, "llm_fallback": 0, "knowledge_points_fallback": 0}
+
+    def record(self, used_llm: bool, knowledge_points_only: bool = False) -> None:
+        with self._lock:
+            self._stats["llm_fallback" if used_llm else "local_only"] += 1
+            if used_llm and knowledge_points_only:
+                self._stats["knowledge_points_fallback"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._stats["local_only"] + self._stats["llm_fallback"]
+            return {
+                **self._stats,
+                "enabled": LOCAL_EXTRACTION,
+                "local_ratio": round(self._stats["local_only"] / total, 4) if total else 0.0
+            }
+
+
+# 全局实例
+local_info_extractor = LocalInfoExtractor()
+local_extraction_metrics = LocalExtractionMetrics()
@@ -1,14 +1,33 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import asyncio
+import base64
+import os
 
 from agent_service import AgentService
 from scene_generator import create_scene_generator
 from database_client import db_client
+from prompt_cache import prompt_cache_metrics
+from context_builder import context_metrics
+from http_encoding import (CompressionMiddleware, FastJSONResponse, build_response, negotiate_image_format,
+                           shape_story_payload)
+from http_cache import CACHE_POLICIES, apply_cache_headers, conditional_response, make_etag
+from story_cache import story_cache, story_cache_listener
+from lazy_images import create_lazy_image_service
+from image_cache import image_cache
+from http_client import close_http_clients, http_metrics
+from speculation import level_speculation_metrics
+from input_prescreen import prescreen_metrics
+from local_extractor import local_extraction_metrics
+from assessment_memo import assessment_memo_metrics
+from story_compression import story_compressor
+from single_flight import single_flight_snapshot
+from image_variants import VARIANT_SIZES, available_formats, image_variant_pipeline, select_image_variant
 
-app = FastAPI(title="EduAgent API", version="1.0.0")
+app = FastAPI(title="EduAgent API", version="1.0.0", default_response_class=FastJSONResponse)
 
 # 配置CORS
 app.add_middleware(
@@ -19,9 +38,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 响应压缩（超过阈值的响应按 Accept-Encoding 使用 brotli/gzip）
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+)
+
 # 全局服务实例
 agent_service = AgentService()
 scene_generator = create_scene_generator()
+lazy_image_service = create_lazy_image_service(
+    scene_generator,
+    db_client,
+    prefetch_next=os.getenv("LAZY_IMAGE_PREFETCH", "true").lower() in ("1", "true", "yes")
+)
+# 对话流程生成故事时使用的生成任务（需求锁、幂等键、进度流）
+generation_job_manager = agent_service.reasoning_graph.generation_jobs
+
+@app.on_event("startup")
+async def start_story_cache():
+    """启动通知监听（每个worker一个监听连接，故事缓存失效和生成任务进度），STORY_CACHE_ENABLED=false 时不启用缓存"""
+    story_cache_listener.start(db_client.connection_string,
+                               cache_enabled=os.getenv("STORY_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"))
+
+@app.on_event("startup")
+async def prepare_story_compression():
+    """STORY_COMPRESSION=zstd 时确保 data_zstd 列存在"""
+    if story_compressor.enabled:
+        result = await asyncio.to_thread(db_client.ensure_story_compression_schema)
+        if not result.get("success"):
+            print(f"⚠️ 创建压缩存储列失败: {result.get('error')}")
+
+@app.on_event("startup")
+async def prepare_generation_job_index():
+    """确保查找正在执行的生成任务的索引存在"""
+    result = await asyncio.to_thread(db_client.ensure_generation_job_schema)
+    if not result.get("success"):
+        print(f"⚠️ 创建生成任务索引失败: {result.get('error')}")
+
+@app.on_event("shutdown")
+async def stop_story_cache():
+    story_cache_listener.stop()
+
+@app.on_event("shutdown")
+async def close_shared_http_clients():
+    """释放共享的HTTP连接池"""
+    await close_http_clients()
+
+@app.on_event("shutdown")
+async def stop_image_variant_pool():
+    """关闭图片转码进程池"""
+    image_variant_pipeline.shutdown()
 
 # 请求模型
 class StartConversationRequest(BaseModel):
@@ -44,6 +111,15 @@ class APIResponse(BaseModel):
     message: str = ""
     error: str = ""
 
+    @classmethod
+    def opaque(cls, **fields) -> "APIResponse":
+        """data 为数据库/LLM生成的故事数据时跳过逐层校验，由 build_response 直接序列化"""
+        return cls.model_construct(**fields)
+
+def _cache_variant(include_debug: bool) -> str:
+    """不同的响应裁剪方式对应不同的ETag"""
+    return "debug" if include_debug else ""
+
 @app.get("/")
 async def root():
     return {"message": "EduAgent API is running"}
@@ -66,8 +142,10 @@ async def start_conversation(request: StartConversationRequest):
         )
 
 @app.post("/process_request", response_model=APIResponse)
-async def process_request(request: ProcessRequestModel):
-    """处理用户请求"""
+async def process_request(request: ProcessRequestModel, http_request: Request, include_debug: bool = False):
+    """处理用户请求（include_debug=true 时返回 level_details 等调试字段）
+    带 Idempotency-Key 请求头的重复请求、以及需求正在生成时的重复请求返回已有的生成任务，
+    通过 /generation_jobs/{job_id}/events 获取进度"""
     try:
         if not request.user_input or not request.user_input.strip():
             raise HTTPException(
@@ -75,13 +153,14 @@ async def process_request(request: ProcessRequestModel):
                 detail="用户输入不能为空"
             )
         
-        result = await agent_service.process_request(request.user_input.strip())
+        result = await agent_service.process_request(request.user_input.strip(),
+                                                     http_request.headers.get("idempotency-key"))
         
-        return APIResponse(
+        return build_response(http_request, APIResponse.opaque(
             success=True,
-            data=result,
+            data=shape_story_payload(result, include_debug),
             message="请求处理成功"
-        )
+        ))
     except Exception as e:
         print(f"处理请求失败: {e}")
         raise HTTPException(
@@ -90,7 +169,7 @@ async def process_request(request: ProcessRequestModel):
         )
 
 @app.post("/generate_complete_storyboards", response_model=APIResponse)
-async def generate_complete_storyboards(request: GenerateStoryboardsRequest):
+async def generate_complete_storyboards(request: GenerateStoryboardsRequest, http_request: Request, include_debug: bool = False):
     """生成完整的RPG框架、关卡数据和所有故事板"""
     try:
         # 如果没有提供requirement_id，则获取最新的需求数据
@@ -119,6 +198,7 @@ async def generate_complete_storyboards(request: GenerateStoryboardsRequest):
         if story_result.get("success"):
             # 找到已生成的数据，直接返回
             story_data = story_result["data"]
+            updated_at = story_result.get("updated_at")
             print(f"找到已生成的故事板数据，story_id: {story_id}")
             
             response_data = {
@@ -136,11 +216,16 @@ async def generate_complete_storyboards(request: GenerateStoryboardsRequest):
                 detail=f"未找到故事板数据，需求ID: {request.requirement_id}"
             )
         
-        return APIResponse(
+        response = build_response(http_request, APIResponse.opaque(
             success=True,
-            data=response_data,
+            data=shape_story_payload(response_data, include_debug),
             message="成功获取故事板数据"
-        )
+        ))
+        # POST不做304，但返回与 GET /get_story_by_id 相同的ETag，前端之后可以用GET做条件请求
+        if updated_at:
+            apply_cache_headers(response, make_etag(story_id, updated_at, _cache_variant(include_debug)),
+                                updated_at, "storyboards_lookup")
+        return response
         
     except HTTPException:
         raise
@@ -151,6 +236,30 @@ async def generate_complete_storyboards(request: GenerateStoryboardsRequest):
             detail=f"生成故事板失败: {str(e)}"
         )
 
+@app.get("/generation_jobs/{job_id}", response_model=APIResponse)
+async def get_generation_job(job_id: str):
+    """查询生成任务的状态、进度和结果"""
+    result = await generation_job_manager.get_job(job_id)
+    if not result.get("success"):
+        raise HTTPException(
+            status_code=404,
+            detail=f"未找到生成任务: {job_id}"
+        )
+    return APIResponse(
+        success=True,
+        data=result["data"],
+        message="成功获取生成任务"
+    )
+
+@app.get("/generation_jobs/{job_id}/events")
+async def stream_generation_job(job_id: str):
+    """生成任务进度流（Server-Sent Events）"""
+    return StreamingResponse(
+        generation_job_manager.stream(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/get_all_stories", response_model=APIResponse)
 async def get_all_stories():
     """获取所有故事的历史记录"""
@@ -178,7 +287,8 @@ async def get_all_stories():
                     "grade": storyboards_data.get("grade", "未知"),
                     "created_at": story.get("created_at", ""),
                     "updated_at": story.get("updated_at", ""),
-                    "storyboard_count": len(storyboards_data.get("storyboards", []))
+                    # 压缩存储的故事只有投影，关卡数在投影中
+                    "storyboard_count": story_data.get("storyboard_count", len(storyboards_data.get("storyboards", [])))
                 }
                 history_list.append(history_item)
             
@@ -204,36 +314,52 @@ async def get_all_stories():
             detail=f"获取故事历史记录失败: {str(e)}"
         )
 
+def _get_story_response(http_request: Request, story_id: str, include_debug: bool):
+    """按story_id读取故事：先只查版本号处理条件请求，未命中时再读取JSON数据"""
+    if not story_id or not story_id.strip():
+        raise HTTPException(
+            status_code=400,
+            detail="故事ID不能为空"
+        )
+    story_id = story_id.strip()
+    variant = _cache_variant(include_debug)
+
+    version = db_client.get_story_version(story_id)
+    if version.get("success"):
+        not_modified = conditional_response(http_request, story_id, version["updated_at"], "story_by_id", variant)
+        if not_modified:
+            print(f"故事数据未修改，返回304: {story_id}")
+            return not_modified
+
+    print(f"获取故事数据，story_id: {story_id}")
+
+    # 从数据库获取故事数据
+    result = db_client.get_story(story_id)
+
+    if result.get("success"):
+        story_data = result["data"]
+        print(f"成功获取故事数据: {story_id}")
+
+        response = build_response(http_request, APIResponse.opaque(
+            success=True,
+            data=shape_story_payload(story_data, include_debug),
+            message="成功获取故事数据"
+        ))
+        updated_at = result.get("updated_at")
+        if updated_at:
+            apply_cache_headers(response, make_etag(story_id, updated_at, variant), updated_at, "story_by_id")
+        return response
+    else:
+        raise HTTPException(
+            status_code=404,
+            detail=f"未找到故事数据，ID: {story_id}"
+        )
+
 @app.post("/get_story_by_id", response_model=APIResponse)
-async def get_story_by_id(request: GetStoryByIdRequest):
+async def get_story_by_id(request: GetStoryByIdRequest, http_request: Request, include_debug: bool = False):
     """根据story_id获取完整的故事数据"""
     try:
-        if not request.story_id or not request.story_id.strip():
-            raise HTTPException(
-                status_code=400,
-                detail="故事ID不能为空"
-            )
-        
-        print(f"获取故事数据，story_id: {request.story_id}")
-        
-        # 从数据库获取故事数据
-        result = db_client.get_story(request.story_id.strip())
-        
-        if result.get("success"):
-            story_data = result["data"]
-            print(f"成功获取故事数据: {request.story_id}")
-            
-            return APIResponse(
-                success=True,
-                data=story_data,
-                message="成功获取故事数据"
-            )
-        else:
-            raise HTTPException(
-                status_code=404,
-                detail=f"未找到故事数据，ID: {request.story_id}"
-            )
-            
+        return _get_story_response(http_request, request.story_id, include_debug)
     except HTTPException:
         raise
     except Exception as e:
@@ -243,11 +369,112 @@ async def get_story_by_id(request: GetStoryByIdRequest):
             detail=f"获取故事数据失败: {str(e)}"
         )
 
+@app.get("/get_story_by_id", response_model=APIResponse)
+async def get_story_by_id_cached(http_request: Request, story_id: str, include_debug: bool = False):
+    """根据story_id获取完整的故事数据（GET，支持 If-None-Match / If-Modified-Since 条件请求）"""
+    try:
+        return _get_story_response(http_request, story_id, include_debug)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取故事数据失败: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"获取故事数据失败: {str(e)}"
+        )
+
+def _shaped_result(result: Dict[str, Any], include_debug: bool) -> Dict[str, Any]:
+    if result.get("success"):
+        return {**result, "data": shape_story_payload(result["data"], include_debug)}
+    return result
+
+def _story_part_response(http_request: Request, story_id: str, policy: str, variant: str, load, message: str,
+                         load_version=None):
+    """读取故事的一部分（故事头或关卡）并做条件请求，默认与完整故事共用版本号"""
+    version = load_version() if load_version else db_client.get_story_version(story_id)
+    if version.get("success"):
+        not_modified = conditional_response(http_request, story_id, version["updated_at"], policy, variant)
+        if not_modified:
+            return not_modified
+
+    result = load()
+    if not result.get("success"):
+        raise HTTPException(
+            status_code=404,
+            detail=f"未找到故事数据，ID: {story_id}"
+        )
+
+    response = build_response(http_request, APIResponse.opaque(
+        success=True,
+        data=result["data"],
+        message=message
+    ))
+    if version.get("success"):
+        apply_cache_headers(response, make_etag(story_id, version["updated_at"], variant),
+                            version["updated_at"], policy)
+    return response
+
+@app.get("/story/{story_id}/header", response_model=APIResponse)
+async def get_story_header(story_id: str, http_request: Request, include_debug: bool = False):
+    """获取故事头（报告、框架和关卡列表），不包含关卡内容；前端先加载故事头和第一关"""
+    try:
+        return _story_part_response(
+            http_request, story_id, "story_header", f"header:{_cache_variant(include_debug)}",
+            lambda: _shaped_result(db_client.get_story_header(story_id), include_debug),
+            "成功获取故事头"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取故事头失败: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"获取故事头失败: {str(e)}"
+        )
+
+@app.get("/story/{story_id}/levels", response_model=APIResponse)
+async def get_story_levels(story_id: str, http_request: Request, start: int = 1, end: Optional[int] = None):
+    """获取 stage_index 在 [start, end] 内的关卡（end为空时只返回start一关）"""
+    end = start if end is None else end
+    if end < start:
+        raise HTTPException(status_code=400, detail="end 不能小于 start")
+    try:
+        return _story_part_response(
+            http_request, story_id, "story_levels", f"levels:{start}-{end}",
+            lambda: db_client.get_story_levels(story_id, start, end),
+            "成功获取关卡数据",
+            # 响应内容来自关卡记录，版本号包含这些关卡记录的updated_at
+            load_version=lambda: db_client.get_story_levels_version(story_id, start, end)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取关卡数据失败: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"获取关卡数据失败: {str(e)}"
+        )
+
+@app.get("/story/{story_id}/levels/{stage_index}", response_model=APIResponse)
+async def get_story_level(story_id: str, stage_index: int, http_request: Request):
+    """获取单个关卡"""
+    return await get_story_levels(story_id, http_request, start=stage_index, end=stage_index)
+
 @app.get("/get_latest_storyboard", response_model=APIResponse)
-async def get_latest_storyboard():
+async def get_latest_storyboard(http_request: Request, include_debug: bool = False):
     """获取数据库中最新的故事板数据"""
     try:
         print("获取最新的故事板数据")
+        variant = _cache_variant(include_debug)
+
+        # 先只查询最新故事的版本号，客户端缓存仍有效时直接返回304
+        version = db_client.get_story_version()
+        if version.get("success"):
+            not_modified = conditional_response(http_request, version["story_id"], version["updated_at"],
+                                                "latest_storyboard", variant)
+            if not_modified:
+                print(f"最新故事未变化，返回304: {version['story_id']}")
+                return not_modified
 
         # 从数据库获取最新的故事数据
         result = db_client.get_latest_story()
@@ -256,11 +483,16 @@ async def get_latest_storyboard():
             story_data = result["data"]
             print(f"成功获取最新故事数据: {story_data.get('story_id', 'unknown')}")
 
-            return APIResponse(
+            response = build_response(http_request, APIResponse.opaque(
                 success=True,
-                data=story_data,
+                data=shape_story_payload(story_data, include_debug),
                 message="成功获取最新故事板数据"
-            )
+            ))
+            updated_at = result.get("updated_at")
+            if updated_at:
+                apply_cache_headers(response, make_etag(result["story_id"], updated_at, variant),
+                                    updated_at, "latest_storyboard")
+            return response
         else:
             raise HTTPException(
                 status_code=404,
@@ -276,6 +508,102 @@ async def get_latest_storyboard():
             detail=f"获取最新故事板数据失败: {str(e)}"
         )
 
+def _negotiated_image(http_request: Request, image: Dict[str, Any], size: str,
+                      image_format: Optional[str], default_format: str) -> Dict[str, Any]:
+    """按 size 和 image_format（未指定时按 Accept 头协商）选择图片版本"""
+    if size not in VARIANT_SIZES:
+        raise HTTPException(status_code=400, detail=f"不支持的图片尺寸: {size}，可选: {', '.join(VARIANT_SIZES)}")
+    formats = available_formats(image, size)
+    if not image_format or image_format not in formats:
+        image_format = negotiate_image_format(http_request.headers.get("accept", ""), formats, default_format)
+    return select_image_variant(image, size, image_format)
+
+@app.get("/storyboard_image/{story_id}/{stage_id}", response_model=APIResponse)
+async def get_storyboard_image(story_id: str, stage_id: str, http_request: Request,
+                               size: str = "full", image_format: Optional[str] = None):
+    """获取关卡图片：按需模式下第一次请求时生成，并在后台预取下一关
+    size 可选 full/512/256，列表和历史页面使用缩略图即可"""
+    try:
+        result = await lazy_image_service.get_stage_image(story_id, stage_id)
+        if not result.get("success"):
+            raise HTTPException(
+                status_code=404,
+                detail=result.get("error", "图片获取失败")
+            )
+
+        response = build_response(http_request, APIResponse.opaque(
+            success=True,
+            data={
+                "story_id": story_id,
+                "stage_id": stage_id,
+                "generated_image_data": _negotiated_image(http_request, result["image"], size, image_format, "webp"),
+                "newly_generated": result.get("generated", False)
+            },
+            message="成功获取关卡图片"
+        ))
+        # 图片生成后不再变化
+        response.headers["Cache-Control"] = CACHE_POLICIES["storyboard_image"]
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取关卡图片失败: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"获取关卡图片失败: {str(e)}"
+        )
+
+@app.get("/storyboard_image/{story_id}/{stage_id}/raw")
+async def get_storyboard_image_raw(story_id: str, stage_id: str, http_request: Request, size: str = "full"):
+    """直接返回图片字节，可用于 <img src>；浏览器的 Accept 头决定返回 AVIF/WebP/原图"""
+    try:
+        result = await lazy_image_service.get_stage_image(story_id, stage_id)
+        if not result.get("success"):
+            raise HTTPException(
+                status_code=404,
+                detail=result.get("error", "图片获取失败")
+            )
+
+        image = _negotiated_image(http_request, result["image"], size, None, result["image"].get("file_extension", "png"))
+        extension = image.get("file_extension", "png")
+        response = Response(
+            content=base64.b64decode(image["base64_data"]),
+            media_type=f"image/{'jpeg' if extension == 'jpg' else extension}"
+        )
+        response.headers["Vary"] = "Accept"
+        response.headers["Cache-Control"] = CACHE_POLICIES["storyboard_image"]
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取关卡图片失败: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"获取关卡图片失败: {str(e)}"
+        )
+
+@app.get("/metrics")
+async def get_metrics():
+    """运行时性能指标"""
+    return {
+        "prompt_cache": prompt_cache_metrics.snapshot(),
+        "context_budget": context_metrics.snapshot(),
+        "story_cache": story_cache.snapshot(),
+        "lazy_images": lazy_image_service.snapshot(),
+        "image_cache": image_cache.snapshot(),
+        "http_connections": http_metrics.snapshot(),
+        "image_variants": image_variant_pipeline.snapshot(),
+        "level_speculation": level_speculation_metrics.snapshot(),
+        "input_prescreen": prescreen_metrics.snapshot(),
+        "local_extraction": local_extraction_metrics.snapshot(),
+        "assessment_memo": assessment_memo_metrics.snapshot(),
+        "story_compression": story_compressor.snapshot(),
+        "single_flight": single_flight_snapshot(),
+        "generation_jobs": generation_job_manager.snapshot()
+    }
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+提示词前缀缓存辅助
+OpenAI 只对完全相同的提示词前缀命中缓存，所以组装顺序固定为：
+静态指令 → 同一故事共享的上下文（需求、故事框架）→ 单次调用的变量（关卡编号等）
+同时从API返回的usage字段统计每个调用点的缓存命中比例
+"""
+
+import threading
+from typing import Any, Dict, Tuple
+
+
+def assemble_prompt(static_instructions: str, shared_context: str = "", call_variables: str = "") -> str:
+    """按 静态指令 → 共享上下文 → 单次调用变量 的顺序拼接提示词，空段落会被跳过"""
+    sections = [section.strip() for section in (static_instructions, shared_context, call_variables) if section and section.strip()]
+    return "\n\n".join(sections)
+
+
+def _read(obj: Any, key: str) -> Any:
+    """同时兼容dict和带属性的对象"""
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+def extract_cache_usage(response: Any) -> Tuple[int, int]:
+    """从API响应中读取 (prompt_tokens, cached_tokens)，兼容OpenAI SDK响应和LangChain消息"""
+    # OpenAI SDK: response.usage.prompt_tokens_details.cached_tokens
+    usage = _read(response, "usage")
+    if usage is not None and _read(usage, "prompt_tokens") is not None:
+        details = _read(usage, "prompt_tokens_details")
+        return int(_read(usage, "prompt_tokens") or 0), int(_read(details, "cached_tokens") or 0)
+
+    # LangChain: usage_metadata.input_token_details.cache_read
+    usage_metadata = _read(response, "usage_metadata")
+    if usage_metadata:
+        details = _read(usage_metadata, "input_token_details")
+        return int(_read(usage_metadata, "input_tokens") or 0), int(_read(details, "cache_read") or 0)
+
+    # 旧版LangChain: response_metadata.token_usage 保留了原始的OpenAI usage
+    token_usage = _read(_read(response, "response_metadata"), "token_usage")
+    if token_usage:
+        details = _read(token_usage, "prompt_tokens_details")
+        return int(_read(token_usage, "prompt_tokens") or 0), int(_read(details, "cached_tokens") or 0)
+
+    return 0, 0
+
+
+def extract_token_usage(response: Any) -> Tuple[int, int]:
+    """从API响应中读取 (输入tokens, 输出tokens)，兼容OpenAI SDK响应和LangChain消息"""
+    usage = _read(response, "usage")
+    if usage is not None and _read(usage, "prompt_tokens") is not None:
+        return int(_read(usage, "prompt_tokens") or 0), int(_read(usage, "completion_tokens") or 0)
+
+    usage_metadata = _read(response, "usage_metadata")
+    if usage_metadata:
+        return int(_read(usage_metadata, "input_tokens") or 0), int(_read(usage_metadata, "output_tokens") or 0)
+
+    token_usage = _read(_read(response, "response_metadata"), "token_usage")
+    if token_usage:
+        return int(_read(token_usage, "prompt_tokens") or 0), int(_read(token_usage, "completion_tokens") or 0)
+
+    return 0, 0
+
+
+class PromptCacheMetrics:
+    """按调用点累计prompt tokens和命中缓存的tokens（线程安全，Stage3在线程池中调用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def record(self, call_site: str, response: Any) -> float:
+        """记录一次调用的usage，返回本次调用的缓存命中比例"""
+        prompt_tokens, cached_tokens = extract_cache_usage(response)
+        if prompt_tokens <= 0:
+            return 0.0
+
+        with self._lock:
+            stats = self._stats.setdefault(call_site, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+
+        ratio = cached_tokens / prompt_tokens
+        print(f"[prompt_cache] {call_site}: {cached_tokens}/{prompt_tokens} tokens 命中缓存 ({ratio:.0%})")
+        return ratio
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """返回各调用点的累计统计和缓存命中比例"""
+        with self._lock:
+            result = {}
+            for call_site, stats in self._stats.items():
+                prompt_tokens = stats["prompt_tokens"]
+                result[call_site] = {
+                    **stats,
+                    "cached_ratio": round(stats["cached_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0
+                }
+            return result
+
+    def reset(self) -> None:
+        """清空统计"""
+        with self._lock:
+            self._stats.clear()
+
+
+# 全局统计实例
+prompt_cache_metrics = PromptCacheMetrics()
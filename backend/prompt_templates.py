@@ -1,6 +1,52 @@
 from langchain.prompts import PromptTemplate
 from typing import Dict, Any
 
+from prompt_cache import assemble_prompt
+
+
+# 故事框架审核维度及评估标准（按维度并发审核时每个维度单独一次调用）
+STORY_REVIEW_DIMENSIONS = {
+    "主线明确性": """- 故事目标是否清晰明确
+- 主角动机是否合理充分
+- 核心冲突设置是否有吸引力
+- 教学目标与故事融合度
+- 整体故事弧线是否完整""",
+    "内容一致性": """- 与用户需求的匹配程度
+- 学科、年级、知识点的准确对应
+- 游戏风格、角色、世界观的一致性
+- 教学难点的合理体现
+- 互动需求的准确实现""",
+    "剧情连贯性": """- 6个关卡间的逻辑衔接
+- 故事情节发展的流畅性
+- 角色成长轨迹的合理性
+- 情节过渡的自然性
+- 整体叙事的完整性""",
+    "教育融合度": """- 知识点融入的自然程度
+- 考核方式的创新性和合理性
+- 互动设计与教学目标的匹配
+- 避免生硬"做题"的程度
+- 教学难点的有效解决方案""",
+    "吸引力评估": """- 故事的趣味性和吸引力
+- 游戏化设计的丰富程度
+- 沉浸感体验的营造
+- "玩中学"理念的体现
+- 对目标年龄段的适宜性""",
+    "场景剧本贴合度": """- 场景设定的完整性和生动性（环境概述、核心场景、氛围定调）
+- 场景与剧情的自然融合度
+- 环境描述与教学内容的匹配程度
+- 视觉场景的想象力激发效果
+- 场景氛围与学习目标的协调性
+- 各关卡场景间的风格一致性和变化合理性"""
+}
+
+# 详细度评估维度说明（只重新评估部分维度时使用）
+SUFFICIENCY_DIMENSIONS = {
+    "基础信息充足性": "学科、年级、知识点的明确性和具体性",
+    "教学信息充足性": "教学目标和难点的清晰度和可操作性",
+    "游戏设定充足性": "游戏风格、角色、世界观的完整性和吸引力",
+    "情节设定充足性": "故事情节、互动方式的丰富性和教育性"
+}
+
 
 class PromptTemplates:
     def __init__(self):
@@ -368,6 +414,39 @@ class PromptTemplates:
             template=template
         )
     
+    def get_sufficiency_dimension_assessment_prompt(self) -> PromptTemplate:
+        """获取部分维度详细度评估模板（只评估字段有变化的维度）"""
+        static_instructions = """你是专业的教育游戏设计评估专家。请评估收集到的信息是否足够详细，能够用来生成高质量的教育游戏内容。
+只需要评估文末指定的维度，每个维度给出0-100分的评分和具体理由。
+
+评分标准：
+- 90-100分：信息非常详细完整，可以直接生成高质量内容
+- 75-89分：信息基本充足，可能需要少量补充
+- 60-74分：信息有一定基础，但需要重要补充
+- 60分以下：信息不足，需要大量补充
+
+请只返回JSON，不要输出其他内容：
+{{
+    "dimension_scores": {{"[维度名称]": [0-100分，基于实际评估]}},
+    "dimension_analysis": {{"[维度名称]": "[具体分析该维度的充足程度]"}}
+}}"""
+
+        shared_context = """已收集信息：
+{collected_info}
+
+对话上下文：
+{conversation_context}"""
+
+        call_variables = """需要评估的维度：
+{dimensions}
+
+请只对以上维度评分，维度名称保持不变。"""
+
+        return PromptTemplate(
+            input_variables=["collected_info", "conversation_context", "dimensions"],
+            template=assemble_prompt(static_instructions, shared_context, call_variables)
+        )
+
     def get_sufficiency_questions_prompt(self) -> PromptTemplate:
         """获取详细度补充问题生成模板"""
         template = """你是专业的教育游戏设计助手。根据以下信息评估结果，生成针对性的补充问题来完善游戏设计信息。
@@ -724,13 +803,8 @@ class PromptTemplates:
 
     def get_story_review_prompt(self) -> PromptTemplate:
         """获取故事框架审核评分模板"""
-        template = """你是专业的教育游戏质量评估专家。请对以下RPG故事框架进行全面评估打分。
-
-原始需求：
-{collected_info}
-
-生成的故事框架：
-{story_framework}
+        # 评分规则是静态前缀，需求和待审核框架放在最后，便于跨会话、跨迭代命中缓存
+        static_instructions = """你是专业的教育游戏质量评估专家。请对文末提供的RPG故事框架进行全面评估打分。
 
 请从以下6个维度进行评分（每项0-100分）：
 
@@ -836,9 +910,91 @@ class PromptTemplates:
 
 重要提醒：请根据故事框架的实际质量进行客观评分，不要使用示例中的数字！"""
 
+        shared_context = """原始需求：
+{collected_info}"""
+
+        call_variables = """生成的故事框架：
+{story_framework}
+
+请按照上述评分维度和通过标准，以JSON格式返回评分结果。"""
+
         return PromptTemplate(
             input_variables=["collected_info", "story_framework"],
-            template=template
+            template=assemble_prompt(static_instructions, shared_context, call_variables)
+        )
+
+    def get_story_dimension_review_prompt(self) -> PromptTemplate:
+        """获取单维度故事框架审核模板（各维度并发调用）"""
+        # 需求和待审核框架在同一次审核的所有维度间共享，放在维度说明之前以命中缓存
+        static_instructions = """你是专业的教育游戏质量评估专家。请只针对文末指定的一个维度，对RPG故事框架进行评分（0-100分）。
+
+评分要求：
+- 根据故事框架的实际质量客观评分
+- 评价简明扼要，指出主要优点和不足
+- 改进建议具体可执行
+
+请只返回JSON，不要输出其他内容：
+{{
+    "分数": [0-100的分数],
+    "评价": "[该维度的简要分析]",
+    "改进建议": "[针对性的改进建议]"
+}}"""
+
+        shared_context = """原始需求：
+{collected_info}
+
+生成的故事框架：
+{story_framework}"""
+
+        call_variables = """评分维度：{dimension}
+评估标准：
+{criteria}
+
+请按照上述评估标准，以JSON格式返回该维度的评分。"""
+
+        return PromptTemplate(
+            input_variables=["collected_info", "story_framework", "dimension", "criteria"],
+            template=assemble_prompt(static_instructions, shared_context, call_variables)
+        )
+
+    def get_level_assessment_prompt(self) -> PromptTemplate:
+        """获取单关卡教育达成度评估模板（关卡生成完成后立即评估，最后汇总）"""
+        static_instructions = """你是专业的教育游戏评估专家。请评估文末提供的RPG教育游戏中【单个关卡】的教育达成度。
+
+请从以下6个维度评分（每项0-100分）：
+1. 教学目标匹配度：关卡内容与教学目标的一致性、知识点覆盖、学习目标可达成性
+2. 知识点融合度：知识点与剧情的自然融合、呈现合理性、知识传递的逻辑性
+3. 难点突破有效性：对教学难点的针对性设计、难点分解和递进
+4. 年龄段适配度：内容难度、语言表达与目标年龄段的匹配，认知负荷是否合理
+5. 互动参与度：学习者主动参与的设计、互动机制的教育价值、反馈是否及时有效
+6. 趣味性与教育性平衡：趣味元素是否促进学习、是否过度娱乐化
+
+请只返回JSON，不要输出其他内容：
+{{
+    "维度得分": {{
+        "教学目标匹配度": [0-100],
+        "知识点融合度": [0-100],
+        "难点突破有效性": [0-100],
+        "年龄段适配度": [0-100],
+        "互动参与度": [0-100],
+        "趣味性与教育性平衡": [0-100]
+    }},
+    "优势": ["[本关卡的主要优势，1-2条]"],
+    "问题": ["[本关卡的主要问题，0-2条]"],
+    "改进建议": ["[针对本关卡的改进建议，1-2条]"]
+}}"""
+
+        shared_context = """## 教学需求信息
+{collected_info}"""
+
+        call_variables = """## 第{level}关卡内容
+{level_content}
+
+请按照上述维度评估该关卡，以JSON格式返回结果。"""
+
+        return PromptTemplate(
+            input_variables=["collected_info", "level", "level_content"],
+            template=assemble_prompt(static_instructions, shared_context, call_variables)
         )
 
     def get_story_improvement_prompt(self) -> PromptTemplate:
@@ -876,8 +1032,9 @@ class PromptTemplates:
 
     def get_level_scenes_generation_prompt(self) -> PromptTemplate:
         """获取关卡场景剧本生成模板"""
-        template = """节奏感知场景剧本生成Prompt
-你是一名"剧情驱动教育游戏分镜设计师"。你的任务是基于Story Framework为第{level}关创造沉浸式的冒险分镜，其中学科知识是解决困境、推进剧情的核心工具。
+        # 静态指令在前、共享的故事框架居中、关卡编号放最后，六个关卡的并发调用才能共享缓存前缀
+        static_instructions = """节奏感知场景剧本生成Prompt
+你是一名"剧情驱动教育游戏分镜设计师"。你的任务是基于文末的Story Framework为指定关卡创造沉浸式的冒险分镜，其中学科知识是解决困境、推进剧情的核心工具。
 
 【核心设计理念】
 - 学科知识必须是解决剧情困境的唯一途径
@@ -886,12 +1043,6 @@ class PromptTemplates:
 - 避免"老师出题"模式，采用"伙伴探索"模式
 节奏适配：根据关卡特点调整场景氛围和剧情节奏，创造丰富的情感体验层次
 
-【Story Framework】
-{story_framework}
-
-【当前任务】
-请分析Story Framework中的"关卡{level}"部分，生成该关卡的完整分镜内容。
-
 【关卡节奏识别与场景适配】
 首先分析关卡特点，判断应采用的场景氛围类型：
 
@@ -1003,9 +1154,15 @@ class PromptTemplates:
 
 请严格按照上述要求生成氛围一致的分镜脚本。"""
 
+        shared_context = """【Story Framework】
+{story_framework}"""
+
+        call_variables = """【当前任务】
+请分析Story Framework中的"关卡{level}"部分，生成第{level}关的完整分镜内容。"""
+
         return PromptTemplate(
             input_variables=["story_framework", "level"],
-            template=template
+            template=assemble_prompt(static_instructions, shared_context, call_variables)
         )
 
 
@@ -1,19 +1,66 @@
 from langchain.chains import ConversationChain
 from langchain.memory import ConversationSummaryBufferMemory  
 from langchain_openai import ChatOpenAI
-from typing import Dict, List, TypedDict, Any
+from typing import Dict, List, Optional, TypedDict, Any
 from typing_extensions import Annotated
 import json
 import hashlib
+import uuid
+import asyncio
 from datetime import datetime
 from langgraph.graph import StateGraph, END
 import os
 
 from database_client import db_client
+from prompt_cache import extract_token_usage, prompt_cache_metrics
+from context_builder import create_context_builder
+from http_client import get_http_client, get_async_http_client
+from prompt_templates import STORY_REVIEW_DIMENSIONS, SUFFICIENCY_DIMENSIONS
+from speculation import level_speculation_metrics
+from input_prescreen import (INPUT_PRESCREEN_MODE, InputPrescreener, input_prescreener, prescreen_metrics,
+                             record_fitness_sample)
+from assessment_memo import (FITNESS_FIELDS, SUFFICIENCY_DIMENSION_FIELDS, assessment_memo_metrics, dirty_dimensions,
+                             fields_hash)
+from single_flight import LLM_SINGLE_FLIGHT, llm_call_flight, request_key
+from generation_jobs import create_generation_job_manager
 
 
 # ==================== StateGraph版本的ReasoningGraph ====================
 
+# 故事框架生成模式：
+# iterative - 生成 → 审核 → 改进 → 再审核，串行迭代
+# best_of_n - 并发生成N个候选并发审核，选通过的最高分；都不通过时只做一次定向改进
+STORY_FRAMEWORK_MODE = os.getenv("STORY_FRAMEWORK_MODE", "iterative")
+STORY_FRAMEWORK_CANDIDATES = int(os.getenv("STORY_FRAMEWORK_CANDIDATES", "3"))
+MAX_STORY_ITERATIONS = 3
+
+# 故事框架审核模式：
+# single        - 一次调用输出所有维度的评分
+# per_dimension - 每个维度一个小的并发审核调用，任一维度严重不达标时立即结束审核进入改进
+STORY_REVIEW_MODE = os.getenv("STORY_REVIEW_MODE", "single")
+STORY_REVIEW_HARD_FAIL_SCORE = int(os.getenv("STORY_REVIEW_HARD_FAIL_SCORE", "60"))
+# 通过标准（与审核prompt一致）
+STORY_REVIEW_DIMENSION_PASS_SCORE = 75
+STORY_REVIEW_TOTAL_PASS_SCORE = 80
+
+# 推测生成关卡：审核故事框架的同时开始生成6个关卡，审核不通过时取消并丢弃
+LEVEL_SPECULATION = os.getenv("LEVEL_SPECULATION", "false").lower() in ("1", "true", "yes")
+
+# 增量教育达成度评估：每个关卡生成完成后立即评估该关卡，汇聚时只做本地汇总，不再调用一次大的评估prompt
+INCREMENTAL_ASSESSMENT = os.getenv("INCREMENTAL_ASSESSMENT", "false").lower() in ("1", "true", "yes")
+# 评估结果复用：collected_info相关字段没有变化的详细度维度、适宜性检查直接复用上次结果
+ASSESSMENT_MEMO = os.getenv("ASSESSMENT_MEMO", "false").lower() in ("1", "true", "yes")
+
+# 教育达成度评估维度及满分
+EDUCATION_ASSESSMENT_DIMENSIONS = {
+    "教学目标匹配度": 25,
+    "知识点融合度": 20,
+    "难点突破有效性": 20,
+    "年龄段适配度": 15,
+    "互动参与度": 10,
+    "趣味性与教育性平衡": 10
+}
+
 def merge_level_details(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
     """合并level_details字典，用于并发状态更新"""
     if not left:
@@ -21,21 +68,38 @@ def merge_level_details(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str
     if not right:
         return left or {}
     
-    # 深度合并level_details
+    # 深度合并level_details（不修改输入，并发分支各自只返回自己的关卡）
     merged = left.copy()
     for key, value in right.items():
         if key in merged and isinstance(merged[key], dict) and isinstance(value, dict):
-            merged[key].update(value)
+            merged[key] = {**merged[key], **value}
         else:
             merged[key] = value
     return merged
 
+
+def empty_collected_info() -> Dict[str, Any]:
+    """需求收集字段的初始状态"""
+    return {
+        "subject": None,
+        "grade": None,
+        "knowledge_points": None,
+        "teaching_goals": None,
+        "teaching_difficulties": None,
+        "game_style": None,
+        "character_design": None,
+        "world_setting": None,
+        "plot_requirements": None,
+        "interaction_requirements": None
+    }
+
 class ReasoningState(TypedDict):
     """ReasoningGraph的状态定义 - 包含Stage1合并的字段"""
     # 基础会话状态
     messages: List[Dict[str, str]]
     user_id: str
     requirement_id: str  # 预先确定的需求ID，避免并发问题
+    run_context: Dict[str, Any]  # 单次运行的上下文（session_id、run_id等），图实例本身不保存任何会话数据
     
     # 需求收集状态
     collected_info: Dict[str, Any]
@@ -51,6 +115,9 @@ class ReasoningState(TypedDict):
     sufficiency_threshold: float         # 阈值 (默认75)
     sufficiency_passed: bool
     
+    # 评估结果复用记录：{"sufficiency": {维度: {hash, score, analysis}}, "fitness": {hash, result}}
+    assessment_memo: Dict[str, Any]
+    
     # 输入适宜性检查状态
     input_fitness_result: Dict[str, Any]
     input_fitness_passed: bool
@@ -66,10 +133,13 @@ class ReasoningState(TypedDict):
     story_review_result: Dict[str, Any]
     story_iteration_count: int
     story_framework_approved: bool
+    requirement_analysis_report: str
     
     # 关卡详细内容状态 - 使用Annotated处理并发更新
     level_details: Annotated[Dict[str, Any], merge_level_details]  # 存储每个关卡的角色对话和场景剧本
     level_generation_status: str   # pending/in_progress/completed/failed
+    generation_job: Dict[str, Any]  # 本次运行获取的生成任务（claim结果），attached=True 表示挂到了其他请求的任务上
+    education_assessment_report: Dict[str, Any]
     
     # 最终状态
     ready_for_generation: bool
@@ -79,13 +149,29 @@ class ReasoningState(TypedDict):
 class ReasoningGraph:
     """基于StateGraph的智能推理图 - 合并了Stage1功能"""
     
-    def __init__(self, db_client=None):
+    def __init__(self, db_client=None, framework_mode: str = STORY_FRAMEWORK_MODE,
+                 framework_candidates: int = STORY_FRAMEWORK_CANDIDATES, review_mode: str = STORY_REVIEW_MODE,
+                 speculative_levels: bool = LEVEL_SPECULATION, incremental_assessment: bool = INCREMENTAL_ASSESSMENT,
+                 prescreen_mode: str = INPUT_PRESCREEN_MODE, memoize_assessments: bool = ASSESSMENT_MEMO,
+                 coalesce_llm_calls: bool = LLM_SINGLE_FLIGHT):
+        self.framework_mode = framework_mode
+        self.framework_candidates = max(1, framework_candidates)
+        self.review_mode = review_mode
+        self.speculative_levels = speculative_levels
+        self.incremental_assessment = incremental_assessment
+        self.prescreen_mode = prescreen_mode
+        self.memoize_assessments = memoize_assessments
+        self.coalesce_llm_calls = coalesce_llm_calls
+
         # 如果没有传入db_client，就使用全局的db_client
         if db_client is not None:
             self.db_client = db_client
         else:
             from database_client import db_client as global_db_client
             self.db_client = global_db_client
+
+        # 生成故事框架和关卡时持有需求锁，重复请求挂到正在执行的任务上
+        self.generation_jobs = create_generation_job_manager(self.db_client)
         
         # 初始化LLM
         import os
@@ -95,7 +181,9 @@ class ReasoningGraph:
         self.llm = ChatOpenAI(
             model="gpt-4o-mini", 
             temperature=0.7,  # 对话生成使用较高温度
-            openai_api_key=os.getenv("OPENAI_API_KEY")
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client()
         )
         
         # 初始化信息提取器
@@ -103,27 +191,8 @@ class ReasoningGraph:
         self.extractor = create_info_extractor("gpt-4o-mini")
         
         # ===== 从Stage1ReasoningGraph合并的状态管理 =====
-        
-        # 初始化Memory (从Stage1合并)
-        self.memory = ConversationSummaryBufferMemory(
-            max_token_limit=8000,
-            llm=self.llm,
-            return_messages=True
-        )
-        
-        # 收集的信息存储 (从Stage1合并)
-        self.collected_info = {
-            "subject": None,
-            "grade": None,
-            "knowledge_points": None,
-            "teaching_goals": None,
-            "teaching_difficulties": None,
-            "game_style": None,
-            "character_design": None,
-            "world_setting": None,
-            "plot_requirements": None,
-            "interaction_requirements": None
-        }
+        # collected_info、对话memory等会话数据全部放在ReasoningState中，
+        # 同一个编译好的图实例可以被多个会话并发调用
         
         # 完成条件定义 (从Stage1合并)
         self.completion_criteria = {
@@ -137,28 +206,31 @@ class ReasoningGraph:
         from prompt_templates import PromptTemplates
         self.prompts = PromptTemplates()
         
+        # 按调用点token预算构建上下文
+        self.context_builder = create_context_builder()
+        
         self.graph = self._build_reasoning_graph()
     
     # ===== 从Stage1ReasoningGraph合并的方法 =====
     
-    def determine_current_stage(self) -> str:
+    def determine_current_stage(self, collected_info: Dict[str, Any]) -> str:
         """确定当前应该收集哪个阶段的信息"""
-        if not self._stage_completed("basic_info"):
+        if not self._stage_completed("basic_info", collected_info):
             return "basic_info"
-        elif not self._stage_completed("teaching_info"):
+        elif not self._stage_completed("teaching_info", collected_info):
             return "teaching_info"
-        elif not self._stage_completed("gamestyle_info"):
+        elif not self._stage_completed("gamestyle_info", collected_info):
             return "gamestyle_info"
-        elif not self._stage_completed("scene_info"):
+        elif not self._stage_completed("scene_info", collected_info):
             return "scene_info"
         else:
             return "complete"
 
-    def _stage_completed(self, stage: str) -> bool:
+    def _stage_completed(self, stage: str, collected_info: Dict[str, Any]) -> bool:
         """检查特定阶段是否完成"""
         required_fields = self.completion_criteria[stage]
         for field in required_fields:
-            value = self.collected_info.get(field)
+            value = collected_info.get(field)
             if not value:
                 return False
             if isinstance(value, list) and len(value) == 0:
@@ -169,34 +241,36 @@ class ReasoningGraph:
         """提取用户输入中的信息"""
         return await self.extractor.extract_from_user_input(user_input, stage)
 
-    def update_state(self, extracted_info: Dict) -> None:
-        """更新收集状态"""
+    def update_state(self, collected_info: Dict[str, Any], extracted_info: Dict) -> Dict[str, Any]:
+        """合并提取结果，返回新的collected_info（不修改传入的字典）"""
         print(f"DEBUG update_state: received = {extracted_info}")
+        updated_info = {**empty_collected_info(), **(collected_info or {})}
         for key, value in extracted_info.items():
             print(f"DEBUG: processing key={key}, value={value}")
-            if value and key in self.collected_info:
+            if value and key in updated_info:
                 if isinstance(value, list):
                     # 处理列表类型的数据
-                    if self.collected_info[key]:
+                    if updated_info[key]:
                         # 合并列表，去重
-                        existing = self.collected_info[key] if isinstance(self.collected_info[key], list) else [self.collected_info[key]]
+                        existing = updated_info[key] if isinstance(updated_info[key], list) else [updated_info[key]]
                         combined = existing + value
-                        self.collected_info[key] = list(set(combined))
+                        updated_info[key] = list(set(combined))
                     else:
-                        self.collected_info[key] = value
+                        updated_info[key] = value
                 else:
                     # 处理字符串类型的数据
-                    self.collected_info[key] = value
+                    updated_info[key] = value
         
-        print(f"DEBUG update_state: final collected_info = {self.collected_info}")
+        print(f"DEBUG update_state: final collected_info = {updated_info}")
+        return updated_info
 
-    def check_stage_completion(self) -> bool:
+    def check_stage_completion(self, collected_info: Dict[str, Any]) -> bool:
         """检查是否达成Stage1目标"""
-        return self.determine_current_stage() == "complete"
+        return self.determine_current_stage(collected_info) == "complete"
     
-    def get_lacked_info(self) -> Dict:
+    def get_lacked_info(self, collected_info: Dict[str, Any]) -> Dict:
         """获取缺失信息详情"""
-        current_stage = self.determine_current_stage()
+        current_stage = self.determine_current_stage(collected_info)
 
         if current_stage == "complete":
             return {"stage": "complete", "missing_fields": [], "missing_details": {}, "completion_rate": 1.0}
@@ -204,28 +278,28 @@ class ReasoningGraph:
         print(f"current stage is {current_stage}")
         # 根据当前阶段获取缺失信息
         if current_stage == "basic_info":
-            return self._check_basic_info_gaps()
+            return self._check_basic_info_gaps(collected_info)
         elif current_stage == "teaching_info":
-            return self._check_teaching_info_gaps()
+            return self._check_teaching_info_gaps(collected_info)
         elif current_stage == "gamestyle_info":
-            return self._check_gamestyle_info_gaps()
+            return self._check_gamestyle_info_gaps(collected_info)
         elif current_stage == "scene_info":
-            return self._check_scene_info_gaps()
+            return self._check_scene_info_gaps(collected_info)
         else:
             return {"stage": current_stage, "missing_fields": [], "missing_details": {}, "completion_rate": 0.0}
 
-    def _check_basic_info_gaps(self) -> Dict:
+    def _check_basic_info_gaps(self, collected_info: Dict[str, Any]) -> Dict:
         """检查基础信息缺失"""
         missing_fields = []
         missing_details = {}
         
-        if not self.collected_info.get("subject"):
+        if not collected_info.get("subject"):
             missing_fields.append("subject")
             missing_details["subject"] = "学科领域"
-        if not self.collected_info.get("grade"):
+        if not collected_info.get("grade"):
             missing_fields.append("grade")
             missing_details["grade"] = "目标年级"
-        if not self.collected_info.get("knowledge_points"):
+        if not collected_info.get("knowledge_points"):
             missing_fields.append("knowledge_points")
             missing_details["knowledge_points"] = "具体知识点"
         
@@ -237,15 +311,15 @@ class ReasoningGraph:
             "completion_rate": completion_rate
         }
 
-    def _check_teaching_info_gaps(self) -> Dict:
+    def _check_teaching_info_gaps(self, collected_info: Dict[str, Any]) -> Dict:
         """检查教学信息缺失"""
         missing_fields = []
         missing_details = {}
         
-        if not self.collected_info.get("teaching_goals"):
+        if not collected_info.get("teaching_goals"):
             missing_fields.append("teaching_goals")
             missing_details["teaching_goals"] = "教学目标"
-        if not self.collected_info.get("teaching_difficulties"):
+        if not collected_info.get("teaching_difficulties"):
             missing_fields.append("teaching_difficulties")
             missing_details["teaching_difficulties"] = "教学难点"
         
@@ -257,18 +331,18 @@ class ReasoningGraph:
             "completion_rate": completion_rate
         }
 
-    def _check_gamestyle_info_gaps(self) -> Dict:
+    def _check_gamestyle_info_gaps(self, collected_info: Dict[str, Any]) -> Dict:
         """检查游戏风格信息缺失"""
         missing_fields = []
         missing_details = {}
         
-        if not self.collected_info.get("game_style"):
+        if not collected_info.get("game_style"):
             missing_fields.append("game_style")
             missing_details["game_style"] = "游戏风格"
-        if not self.collected_info.get("character_design"):
+        if not collected_info.get("character_design"):
             missing_fields.append("character_design")
             missing_details["character_design"] = "角色设计"
-        if not self.collected_info.get("world_setting"):
+        if not collected_info.get("world_setting"):
             missing_fields.append("world_setting")
             missing_details["world_setting"] = "世界背景"
         
@@ -280,15 +354,15 @@ class ReasoningGraph:
             "completion_rate": completion_rate
         }
 
-    def _check_scene_info_gaps(self) -> Dict:
+    def _check_scene_info_gaps(self, collected_info: Dict[str, Any]) -> Dict:
         """检查情节信息缺失"""
         missing_fields = []
         missing_details = {}
         
-        if not self.collected_info.get("plot_requirements"):
+        if not collected_info.get("plot_requirements"):
             missing_fields.append("plot_requirements")
             missing_details["plot_requirements"] = "情节需求"
-        if not self.collected_info.get("interaction_requirements"):
+        if not collected_info.get("interaction_requirements"):
             missing_fields.append("interaction_requirements")
             missing_details["interaction_requirements"] = "互动方式"
         
@@ -300,12 +374,41 @@ class ReasoningGraph:
             "completion_rate": completion_rate
         }
     
-    async def generate_response_with_lacked_info(self, lacked_info: Dict) -> str:
+    async def _llm_apredict(self, prompt: str) -> str:
+        """调用LLM；coalesce_llm_calls 开启时并发的相同请求只调用一次"""
+        if not self.coalesce_llm_calls:
+            return await self.llm.apredict(prompt)
+        key = request_key("apredict", getattr(self.llm, "model_name", None), getattr(self.llm, "temperature", None), prompt)
+        return await llm_call_flight.do_async(key, lambda: self.llm.apredict(prompt))
+
+    async def _llm_ainvoke(self, prompt: Any) -> Any:
+        """同 _llm_apredict，返回消息对象（合并的调用共享同一个对象，不要修改）"""
+        if not self.coalesce_llm_calls:
+            return await self.llm.ainvoke(prompt)
+        key = request_key("ainvoke", getattr(self.llm, "model_name", None), getattr(self.llm, "temperature", None), prompt)
+        return await llm_call_flight.do_async(key, lambda: self.llm.ainvoke(prompt))
+
+    def _build_memory(self, messages: List[Dict[str, Any]]) -> ConversationSummaryBufferMemory:
+        """由本次运行的对话历史构建memory（每次调用独立创建，不在会话之间共享）"""
+        memory = ConversationSummaryBufferMemory(
+            max_token_limit=8000,
+            llm=self.llm,
+            return_messages=True
+        )
+        for msg in messages:
+            if msg.get("role") == "user":
+                memory.chat_memory.add_user_message(msg["content"])
+            elif msg.get("role") == "assistant":
+                memory.chat_memory.add_ai_message(msg["content"])
+        return memory
+
+    async def generate_response_with_lacked_info(self, lacked_info: Dict, collected_info: Dict[str, Any],
+                                                 messages: List[Dict[str, Any]]) -> str:
         """基于缺失信息生成回复"""
         # 获取动态prompt
         dynamic_prompt = self.prompts.generate_dynamic_prompt(
             lacked_info["stage"],
-            self.collected_info,
+            collected_info,
             lacked_info
         )
         print(f"dynamic prompt is : {dynamic_prompt}")
@@ -313,7 +416,7 @@ class ReasoningGraph:
         # 创建对话链
         conversation = ConversationChain(
             llm=self.llm,
-            memory=self.memory,
+            memory=self._build_memory(messages),
             prompt=dynamic_prompt
         )
         
@@ -341,8 +444,8 @@ class ReasoningGraph:
                 "id": requirement_id,
                 "user_id": state["user_id"],
                 "timestamp": timestamp,
-                "collected_info": self.collected_info,
-                "final_requirements": self.collected_info,  # 为了兼容性
+                "collected_info": state["collected_info"],
+                "final_requirements": state["collected_info"],  # 为了兼容性
                 "analysis_report": state.get("requirement_analysis_report", ""),  # 添加分析报告
                 "story_framework": state.get("story_framework", ""),  # 添加故事框架
                 "status": "completed"
@@ -400,9 +503,13 @@ class ReasoningGraph:
         workflow.add_node("check_fitness", self._check_fitness)
         workflow.add_node("generate_negotiate_response", self._generate_negotiate_response)
         workflow.add_node("generate_finish_response", self._generate_finish_response)
+        workflow.add_node("claim_generation", self._claim_generation)
         
         # 故事框架生成节点
-        workflow.add_node("generate_story_framework", self._generate_story_framework)
+        if self.framework_mode == "best_of_n":
+            workflow.add_node("generate_story_framework_candidates", self._generate_story_framework_candidates)
+        else:
+            workflow.add_node("generate_story_framework", self._generate_story_framework)
         workflow.add_node("review_story_framework", self._review_story_framework)
         workflow.add_node("improve_story_framework", self._improve_story_framework)
         workflow.add_node("distribute_to_levels", self._distribute_to_levels)
@@ -412,7 +519,7 @@ class ReasoningGraph:
         for level in range(1, 7):
             # 场景、角色、对话一体化生成节点
             workflow.add_node(f"generate_level_{level}_scenes",
-                             partial(self._generate_level_scenes, level=level))
+                             partial(self._generate_level_node, level=level))
         
         # 最终汇聚节点：等待所有对话完成  
         workflow.add_node("collect_all_levels", self._collect_all_level_results)
@@ -477,11 +584,33 @@ class ReasoningGraph:
         # 有适宜性问题时，生成协商回复后结束（等待用户回应）
         workflow.add_edge("generate_negotiate_response", END)
         
-        # 所有检查通过，生成完成回复后进入故事框架生成
-        workflow.add_edge("generate_finish_response", "generate_story_framework")
-        
-        # 故事框架生成后进行审核
-        workflow.add_edge("generate_story_framework", "review_story_framework")
+        # 所有检查通过，生成完成回复后获取需求锁，再进入故事框架生成
+        workflow.add_edge("generate_finish_response", "claim_generation")
+        framework_node = ("generate_story_framework_candidates" if self.framework_mode == "best_of_n"
+                          else "generate_story_framework")
+        workflow.add_conditional_edges(
+            "claim_generation",
+            self._decide_after_claim,
+            {
+                "claimed": framework_node,
+                "attached": END  # 该需求已在生成，挂到正在执行的任务上
+            }
+        )
+
+        if self.framework_mode == "best_of_n":
+
+            # 有候选通过时直接分发关卡，否则对最高分候选做一次定向改进
+            workflow.add_conditional_edges(
+                "generate_story_framework_candidates",
+                self._decide_after_candidates,
+                {
+                    "approved": "distribute_to_levels",
+                    "improve": "improve_story_framework"
+                }
+            )
+        else:
+            # 故事框架生成后进行审核
+            workflow.add_edge("generate_story_framework", "review_story_framework")
         
         # 故事框架审核后的条件路由
         workflow.add_conditional_edges(
@@ -541,7 +670,7 @@ class ReasoningGraph:
     
     def _should_continue_story_iteration(self, state: ReasoningState) -> str:
         """判断是否需要继续故事框架迭代"""
-        max_iterations = 3  # 最大迭代次数
+        max_iterations = MAX_STORY_ITERATIONS  # 最大迭代次数
         
         if state["story_framework_approved"]:
             return "approved"
@@ -550,6 +679,20 @@ class ReasoningGraph:
             return "max_reached"
         else:
             return "continue_iteration"
+
+    def _decide_after_claim(self, state: ReasoningState) -> str:
+        """获取需求锁后的路由：拿到锁才生成，否则结束本次运行"""
+        job = state.get("generation_job") or {}
+        if job.get("success") and not job.get("attached"):
+            return "claimed"
+        return "attached"
+
+    def _decide_after_candidates(self, state: ReasoningState) -> str:
+        """best_of_n模式：候选框架审核后的路由"""
+        if state["story_framework_approved"]:
+            return "approved"
+        print("所有候选框架均未通过审核，对最高分候选进行定向改进")
+        return "improve"
     
     # ==================== 新增节点函数 ====================
     
@@ -566,8 +709,22 @@ class ReasoningGraph:
             
         latest_user_input = user_messages[-1]["content"]
         
-        # 使用LLM进行输入适宜性检查
-        fitness_result = await self._llm_check_input_fitness(latest_user_input, state["collected_info"])
+        # 本地预筛：明显正常的输入跳过LLM（shadow模式只记录预筛结论，仍以LLM结果为准）
+        screen_result = None
+        if self.prescreen_mode in ("on", "shadow"):
+            screen_result = input_prescreener.screen(latest_user_input)
+            prescreen_metrics.record(screen_result["decision"])
+
+        if self.prescreen_mode == "on" and screen_result["decision"] == "pass":
+            print("本地预筛判定为正常输入，跳过LLM输入适宜性检查")
+            fitness_result = InputPrescreener.passed_result(screen_result)
+        else:
+            # 使用LLM进行输入适宜性检查
+            fitness_result = await self._llm_check_input_fitness(latest_user_input, state["collected_info"])
+            record_fitness_sample(latest_user_input, fitness_result)
+            if screen_result is not None:
+                prescreen_metrics.record_comparison(screen_result["decision"],
+                                                    fitness_result.get("input_fitness") == "passed")
         
         # 更新状态
         state["input_fitness_result"] = fitness_result
@@ -626,7 +783,7 @@ class ReasoningGraph:
         )
 
         try:
-            report = await self.llm.apredict(analysis_prompt)
+            report = await self._llm_apredict(analysis_prompt)
             return report.strip()
         except Exception as e:
             print(f"生成需求分析报告失败: {e}")
@@ -671,6 +828,7 @@ class ReasoningGraph:
         )
 
         try:
+            # 不合并：best_of_n 模式并发生成的候选使用相同的提示词，需要各自独立采样
             framework = await self.llm.apredict(framework_prompt)
             return framework.strip()
         except Exception as e:
@@ -689,6 +847,8 @@ class ReasoningGraph:
     async def _llm_review_story_framework(self, collected_info: Dict[str, Any], 
                                         story_framework: str) -> Dict[str, Any]:
         """使用LLM审核故事框架"""
+        if self.review_mode == "per_dimension":
+            return await self._llm_review_story_framework_by_dimension(collected_info, story_framework)
         
         # 使用PromptTemplate
         prompt_template = self.prompts.get_story_review_prompt()
@@ -698,8 +858,9 @@ class ReasoningGraph:
         )
 
         try:
-            response = await self.llm.apredict(review_prompt)
-            json_content = self._extract_json_from_markdown(response.strip())
+            response = await self._llm_ainvoke(review_prompt)
+            prompt_cache_metrics.record("story_review", response)
+            json_content = self._extract_json_from_markdown(response.content.strip())
             result = json.loads(json_content)
             return result
         except Exception as e:
@@ -721,6 +882,75 @@ class ReasoningGraph:
                 "重点改进方向": ["修复系统错误", "重新生成框架"]
             }
 
+    async def _llm_review_story_framework_by_dimension(self, collected_info: Dict[str, Any],
+                                                     story_framework: str) -> Dict[str, Any]:
+        """按维度并发审核，合并为与整体审核相同结构的结果；任一维度低于硬性下限时取消其余维度"""
+        prompt_template = self.prompts.get_story_dimension_review_prompt()
+        formatted_info = self._format_collected_info_for_assessment(collected_info)
+
+        tasks = {
+            asyncio.ensure_future(self._llm_review_dimension(
+                prompt_template.format(collected_info=formatted_info, story_framework=story_framework,
+                                       dimension=dimension, criteria=criteria)
+            )): dimension
+            for dimension, criteria in STORY_REVIEW_DIMENSIONS.items()
+        }
+
+        dimension_results = {}
+        hard_failed = None
+        pending = set(tasks)
+        while pending and hard_failed is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                dimension = tasks[task]
+                dimension_results[dimension] = task.result()
+                if dimension_results[dimension]["分数"] < STORY_REVIEW_HARD_FAIL_SCORE:
+                    hard_failed = dimension
+
+        for task in pending:
+            task.cancel()
+        if hard_failed:
+            print(f"维度「{hard_failed}」严重不达标（{dimension_results[hard_failed]['分数']}分），跳过其余{len(pending)}个维度的审核")
+
+        return self._merge_dimension_reviews(dimension_results, [tasks[task] for task in pending])
+
+    async def _llm_review_dimension(self, review_prompt: str) -> Dict[str, Any]:
+        """审核单个维度，失败时按60分处理（与整体审核的默认结果一致）"""
+        try:
+            response = await self._llm_ainvoke(review_prompt)
+            prompt_cache_metrics.record("story_review_dimension", response)
+            result = json.loads(self._extract_json_from_markdown(response.content.strip()))
+            result["分数"] = float(result.get("分数", 0))
+            return result
+        except Exception as e:
+            print(f"故事框架维度审核失败: {e}")
+            return {"分数": 60.0, "评价": "审核错误", "改进建议": "重新生成"}
+
+    def _merge_dimension_reviews(self, dimension_results: Dict[str, Dict[str, Any]],
+                                 skipped_dimensions: List[str]) -> Dict[str, Any]:
+        """合并各维度评分：总分为已完成维度的平均分，有跳过的维度时不通过"""
+        scores = {dimension: result["分数"] for dimension, result in dimension_results.items()}
+        total_score = round(sum(scores.values()) / len(scores), 1) if scores else 0.0
+        failed_dimensions = sorted((dimension for dimension, score in scores.items()
+                                    if score < STORY_REVIEW_DIMENSION_PASS_SCORE), key=scores.get)
+        passed = (not skipped_dimensions and not failed_dimensions
+                  and total_score >= STORY_REVIEW_TOTAL_PASS_SCORE)
+
+        overall = f"按维度审核：{len(scores)}个维度平均{total_score}分"
+        if failed_dimensions:
+            overall += f"，未达标维度：{', '.join(failed_dimensions)}"
+        if skipped_dimensions:
+            overall += f"，因严重不达标未审核：{', '.join(skipped_dimensions)}"
+
+        return {
+            **dimension_results,
+            "总分": total_score,
+            "整体评价": overall,
+            "是否通过": passed,
+            "重点改进方向": [f"{dimension}: {dimension_results[dimension].get('改进建议', '需要改进')}"
+                         for dimension in failed_dimensions]
+        }
+
     async def _llm_improve_story_framework(self, collected_info: Dict[str, Any],
                                          current_framework: str,
                                          review_feedback: Dict[str, Any]) -> str:
@@ -748,7 +978,7 @@ class ReasoningGraph:
         )
 
         try:
-            improved_framework = await self.llm.apredict(improvement_prompt)
+            improved_framework = await self._llm_apredict(improvement_prompt)
             return improved_framework.strip()
         except Exception as e:
             print(f"改进故事框架失败: {e}")
@@ -773,12 +1003,9 @@ class ReasoningGraph:
             extracted_info = await self.extract_info(user_input, current_stage)
             print(f"DEBUG: 提取到的信息: {extracted_info}")
             
-            # 更新状态
-            self.update_state(extracted_info)
-            
             # 更新state中的信息
             state["extracted_info"] = extracted_info
-            state["collected_info"] = self.collected_info.copy()
+            state["collected_info"] = self.update_state(state.get("collected_info", {}), extracted_info)
             
             return state
             
@@ -790,8 +1017,9 @@ class ReasoningGraph:
         """确定当前阶段和完成状态"""
         try:
             # 确定当前阶段
-            current_stage = self.determine_current_stage()
-            stage1_complete = self.check_stage_completion()
+            collected_info = state.get("collected_info", {})
+            current_stage = self.determine_current_stage(collected_info)
+            stage1_complete = self.check_stage_completion(collected_info)
             
             print(f"DEBUG: 当前阶段: {current_stage}, Stage1完成: {stage1_complete}")
             
@@ -804,7 +1032,7 @@ class ReasoningGraph:
                 save_result = self.save_final_requirements(state)
                 if save_result["success"]:
                     state["ready_for_generation"] = True
-                    state["final_requirements"] = self.collected_info.copy()
+                    state["final_requirements"] = dict(collected_info)
                     print(f"需求信息已保存: {save_result['requirement_id']}")
             
             return state
@@ -828,27 +1056,22 @@ class ReasoningGraph:
         """检查基础信息完整性 - 简化版，主要用于初始化"""
         print("检查基础信息完整性...")
         
-        # 同步状态
-        self.collected_info = state["collected_info"]
-        
         # 这个节点现在主要是一个占位符，实际检查在determine_stage中进行
-        print(f"当前collected_info: {self.collected_info}")
+        print(f"当前collected_info: {state['collected_info']}")
             
         return state
     
     async def _generate_lack_response(self, state: ReasoningState) -> ReasoningState:
         """生成信息不足的回复 - 使用合并的Stage1逻辑"""
         print("生成信息不足回复...")
-        print(f"current collected_info is {self.collected_info}")
-        
-        # 同步状态
-        self.collected_info = state["collected_info"]
+        collected_info = state["collected_info"]
+        print(f"current collected_info is {collected_info}")
         
         # 获取缺失信息详情
-        lacked_info = self.get_lacked_info()
+        lacked_info = self.get_lacked_info(collected_info)
         
         # 生成回复
-        response = await self.generate_response_with_lacked_info(lacked_info)
+        response = await self.generate_response_with_lacked_info(lacked_info, collected_info, state["messages"])
         
         # 更新状态
         state["messages"].append({
@@ -866,10 +1089,13 @@ class ReasoningGraph:
         print("评估信息详细度...")
         
         collected_info = state["collected_info"]
-        conversation_context = self._build_conversation_context(state["messages"])
         
         # 使用LLM评估各个维度的详细度
-        sufficiency_assessment = await self._llm_assess_sufficiency(collected_info, conversation_context)
+        if self.memoize_assessments:
+            sufficiency_assessment = await self._assess_sufficiency_incrementally(state)
+        else:
+            conversation_context = self._build_conversation_context(state["messages"], "sufficiency_assessment")
+            sufficiency_assessment = await self._llm_assess_sufficiency(collected_info, conversation_context)
         
         # 更新状态
         state["sufficiency_score"] = sufficiency_assessment["dimension_scores"]
@@ -882,6 +1108,47 @@ class ReasoningGraph:
         print(f"  总体评分: {sufficiency_assessment['overall_score']:.1f}/100 (阈值: {state['sufficiency_threshold']})")
         
         return state
+
+    async def _assess_sufficiency_incrementally(self, state: ReasoningState) -> Dict[str, Any]:
+        """只重新评估字段有变化的维度，其余维度复用上次的评分"""
+        collected_info = state["collected_info"]
+        memo = dict(state.get("assessment_memo") or {})
+        sufficiency_memo = dict(memo.get("sufficiency") or {})
+        dirty = dirty_dimensions(collected_info, sufficiency_memo)
+        assessment_memo_metrics.record_sufficiency(len(dirty), len(SUFFICIENCY_DIMENSION_FIELDS) - len(dirty))
+
+        result = {}
+        if not dirty:
+            print("收集的信息没有变化，复用上次的详细度评估")
+        else:
+            conversation_context = self._build_conversation_context(state["messages"], "sufficiency_assessment")
+            if len(dirty) == len(SUFFICIENCY_DIMENSION_FIELDS):
+                result = await self._llm_assess_sufficiency(collected_info, conversation_context)
+            else:
+                print(f"只重新评估有变化的维度: {dirty}")
+                result = await self._llm_assess_sufficiency_dimensions(collected_info, conversation_context, dirty)
+
+        new_scores = result.get("dimension_scores") or {}
+        analysis = result.get("dimension_analysis") or {}
+        dimension_scores = {}
+        for dimension, fields in SUFFICIENCY_DIMENSION_FIELDS.items():
+            if dimension not in dirty:
+                dimension_scores[dimension] = sufficiency_memo[dimension]["score"]
+                continue
+            dimension_scores[dimension] = new_scores.get(dimension, 60)
+            # 评估失败的默认分不记录，下一轮重新评估
+            if dimension in new_scores and not result.get("assessment_failed"):
+                sufficiency_memo[dimension] = {
+                    "hash": fields_hash(collected_info, fields),
+                    "score": new_scores[dimension],
+                    "analysis": analysis.get(dimension, "")
+                }
+
+        state["assessment_memo"] = {**memo, "sufficiency": sufficiency_memo}
+        return {
+            "dimension_scores": dimension_scores,
+            "overall_score": sum(dimension_scores.values()) / len(dimension_scores)
+        }
         
     async def _generate_sufficiency_questions(self, state: ReasoningState) -> ReasoningState:
         """生成详细度补充问题"""
@@ -896,7 +1163,7 @@ class ReasoningGraph:
             collected_info=state["collected_info"],
             sufficiency_scores=sufficiency_scores,
             overall_score=overall_score,
-            conversation_context=self._build_conversation_context(state["messages"])
+            conversation_context=self._build_conversation_context(state["messages"], "sufficiency_questions")
         )
         
         # 更新状态
@@ -915,10 +1182,13 @@ class ReasoningGraph:
         
         # 获取收集的信息
         collected_info = state["collected_info"]
-        conversation_context = self._build_conversation_context(state["messages"])
+        conversation_context = self._build_conversation_context(state["messages"], "fitness_check")
         
         # 使用LLM进行适宜性检查
-        fitness_result = await self._llm_check_fitness(collected_info, conversation_context)
+        if self.memoize_assessments:
+            fitness_result = await self._check_fitness_with_memo(state, conversation_context)
+        else:
+            fitness_result = await self._llm_check_fitness(collected_info, conversation_context)
         
         # 更新状态
         state["fitness_assessment"] = fitness_result
@@ -932,6 +1202,25 @@ class ReasoningGraph:
             print(f"发现{concern_count}个适宜性问题需要处理")
         
         return state
+
+    async def _check_fitness_with_memo(self, state: ReasoningState, conversation_context: str) -> Dict[str, Any]:
+        """字段都没有变化时复用上次通过的检查结果"""
+        collected_info = state["collected_info"]
+        memo = dict(state.get("assessment_memo") or {})
+        content_hash = fields_hash(collected_info, FITNESS_FIELDS)
+        fitness_memo = memo.get("fitness") or {}
+
+        if fitness_memo.get("hash") == content_hash:
+            print("收集的信息没有变化，复用上次的适宜性检查结果")
+            assessment_memo_metrics.record_fitness(reused=True)
+            return fitness_memo["result"]
+
+        fitness_result = await self._llm_check_fitness(collected_info, conversation_context)
+        assessment_memo_metrics.record_fitness(reused=False)
+        # 有问题的结果不复用：用户可能在对话中解释或调整，需要结合新的上下文重新检查
+        if not fitness_result.get("concerns") and not fitness_result.get("assessment_failed"):
+            state["assessment_memo"] = {**memo, "fitness": {"hash": content_hash, "result": fitness_result}}
+        return fitness_result
         
     async def _generate_negotiate_response(self, state: ReasoningState) -> ReasoningState:
         """生成适宜性协商回复"""
@@ -945,7 +1234,7 @@ class ReasoningGraph:
         negotiate_response = await self._llm_generate_negotiate_response(
             fitness_concerns=fitness_concerns,
             collected_info=state["collected_info"],
-            conversation_context=self._build_conversation_context(state["messages"])
+            conversation_context=self._build_conversation_context(state["messages"], "negotiate_response")
         )
         
         # 更新状态
@@ -966,7 +1255,7 @@ class ReasoningGraph:
         final_response = await self._llm_generate_final_response(
             collected_info=state["collected_info"],
             sufficiency_scores=state["sufficiency_score"],
-            conversation_context=self._build_conversation_context(state["messages"])
+            conversation_context=self._build_conversation_context(state["messages"], "finish_response")
         )
         
         # 生成需求分析报告
@@ -989,6 +1278,33 @@ class ReasoningGraph:
         
         return state
 
+    async def _claim_generation(self, state: ReasoningState) -> ReasoningState:
+        """获取需求锁并创建生成任务：同一需求同时只有一次故事框架和关卡生成，
+        锁被占用或幂等键重复时挂到已有任务上，由AgentService返回任务ID供客户端订阅进度"""
+        idempotency_key = (state.get("run_context") or {}).get("idempotency_key")
+        job = await self.generation_jobs.claim(state["requirement_id"], idempotency_key)
+        state["generation_job"] = job
+
+        if not job.get("success"):
+            state["messages"].append({
+                "role": "assistant",
+                "content": f"该需求正在生成中，请稍后再试（{job.get('error')}）",
+                "type": "error"
+            })
+        elif job.get("attached"):
+            state["messages"].append({
+                "role": "assistant",
+                "content": "该需求已经在生成中，可以通过生成任务的进度流查看进度",
+                "type": "generation_attached"
+            })
+        return state
+
+    async def _publish_generation_progress(self, state: ReasoningState, stage: str, detail: Dict[str, Any]) -> None:
+        """本次运行持有生成任务时记录进度"""
+        job = state.get("generation_job") or {}
+        if job.get("success") and not job.get("attached"):
+            await self.generation_jobs.publish(job["job_id"], stage, detail)
+
     async def _generate_story_framework(self, state: ReasoningState) -> ReasoningState:
         """生成RPG故事框架"""
         print("生成RPG故事框架...")
@@ -1006,9 +1322,39 @@ class ReasoningGraph:
         print(f"故事框架生成完成 (第{state['story_iteration_count']}次)")
         return state
 
+    async def _generate_story_framework_candidates(self, state: ReasoningState) -> ReasoningState:
+        """best_of_n模式：并发生成N个候选框架并并发审核，选择通过审核的最高分候选"""
+        candidate_count = self.framework_candidates
+        print(f"并发生成{candidate_count}个RPG故事框架候选...")
+
+        frameworks = await asyncio.gather(*(
+            self._llm_generate_story_framework(state["collected_info"], state["sufficiency_score"])
+            for _ in range(candidate_count)
+        ))
+        reviews = await asyncio.gather(*(
+            self._llm_review_story_framework(state["collected_info"], framework)
+            for framework in frameworks
+        ))
+
+        candidates = sorted(zip(frameworks, reviews),
+                            key=lambda candidate: (bool(candidate[1].get("是否通过", False)),
+                                                   candidate[1].get("总分", 0)),
+                            reverse=True)
+        for index, (_, review) in enumerate(candidates, 1):
+            print(f"  候选{index}: 总分 {review.get('总分', 0)}/100，{'通过' if review.get('是否通过') else '未通过'}")
+
+        best_framework, best_review = candidates[0]
+        state["story_framework"] = best_framework
+        # 候选都不通过时只保留一次定向改进机会（改进后审核仍不通过即达到最大迭代次数）
+        state["story_iteration_count"] = MAX_STORY_ITERATIONS - 1
+        self._apply_story_review(state, best_review)
+        return state
+
     async def _review_story_framework(self, state: ReasoningState) -> ReasoningState:
         """审核故事框架"""
         print("审核故事框架质量...")
+        if self.speculative_levels:
+            return await self._review_with_speculative_levels(state)
         
         # 审核故事框架
         review_result = await self._llm_review_story_framework(
@@ -1016,7 +1362,75 @@ class ReasoningGraph:
             state["story_framework"]
         )
         
-        # 更新状态
+        self._apply_story_review(state, review_result)
+        return state
+
+    async def _review_with_speculative_levels(self, state: ReasoningState) -> ReasoningState:
+        """审核的同时推测生成6个关卡：通过时保留关卡结果（关卡节点会直接复用），不通过时取消并丢弃"""
+        # 已发出的关卡prompt，取消的调用按prompt计算已消耗的输入tokens
+        sent_prompts: Dict[int, str] = {}
+        level_tasks = {
+            level: asyncio.ensure_future(self._generate_level_scenes(state, level, sent_prompts))
+            for level in range(1, 7)
+        }
+        print("推测模式：故事框架审核与6个关卡生成同时进行")
+
+        try:
+            review_result = await self._llm_review_story_framework(
+                state["collected_info"],
+                state["story_framework"]
+            )
+        except BaseException:
+            for task in level_tasks.values():
+                task.cancel()
+            raise
+
+        self._apply_story_review(state, review_result)
+
+        if state["story_framework_approved"]:
+            results = await asyncio.gather(*level_tasks.values())
+            speculative_details = {}
+            for result in results:
+                speculative_details.update(result["level_details"])
+            input_tokens, output_tokens = self._sum_level_tokens(speculative_details)
+            level_speculation_metrics.record_hit(input_tokens, output_tokens)
+            state["level_details"] = merge_level_details(state.get("level_details") or {}, speculative_details)
+            print("推测命中：审核通过，直接使用已生成的关卡内容")
+            return state
+
+        finished = {level: task for level, task in level_tasks.items() if task.done()}
+        for level, task in level_tasks.items():
+            if level not in finished:
+                task.cancel()
+        discarded_details = {}
+        for task in finished.values():
+            if not task.cancelled() and task.exception() is None:
+                discarded_details.update(task.result()["level_details"])
+        input_tokens, output_tokens = self._sum_level_tokens(discarded_details)
+        # 取消的调用没有用量返回，输入tokens按已发出的prompt计数（输出tokens无法得知）
+        cancelled_input_tokens = sum(self.context_builder.counter.count(sent_prompts[level])
+                                     for level in level_tasks if level not in finished and level in sent_prompts)
+        level_speculation_metrics.record_miss(input_tokens, output_tokens,
+                                              wasted_calls=len(finished),
+                                              cancelled_calls=len(level_tasks) - len(finished),
+                                              cancelled_input_tokens=cancelled_input_tokens)
+        print(f"推测未命中：审核未通过，丢弃{len(finished)}个已完成关卡，取消{len(level_tasks) - len(finished)}个进行中的关卡")
+        return state
+
+    @staticmethod
+    def _sum_level_tokens(level_details: Dict[str, Any]) -> tuple:
+        """累计关卡生成调用的 (输入tokens, 输出tokens)"""
+        usages = [(level_data.get("token_usage") or {}) for level_data in level_details.values()]
+        return (sum(usage.get("input_tokens", 0) for usage in usages),
+                sum(usage.get("output_tokens", 0) for usage in usages))
+
+    @staticmethod
+    def _framework_hash(story_framework: str) -> str:
+        """关卡内容对应的故事框架版本"""
+        return hashlib.sha1((story_framework or "").encode("utf-8")).hexdigest()
+
+    def _apply_story_review(self, state: ReasoningState, review_result: Dict[str, Any]) -> None:
+        """把审核结果写入状态；通过时添加故事框架完成消息"""
         state["story_review_result"] = review_result
         state["story_framework_approved"] = review_result.get("是否通过", False)
         
@@ -1025,8 +1439,7 @@ class ReasoningGraph:
         print(f"故事框架审核完成:")
         print(f"  总分: {total_score}/100")
         
-        dimensions = ["主线明确性", "内容一致性", "剧情连贯性", "教育融合度", "吸引力评估"]
-        for dim in dimensions:
+        for dim in STORY_REVIEW_DIMENSIONS:
             if dim in review_result and isinstance(review_result[dim], dict):
                 score = review_result[dim].get("分数", 0)
                 print(f"  {dim}: {score}/100")
@@ -1050,8 +1463,6 @@ class ReasoningGraph:
             improvement_areas = review_result.get("重点改进方向", [])
             for area in improvement_areas:
                 print(f"  - {area}")
-        
-        return state
 
     async def _improve_story_framework(self, state: ReasoningState) -> ReasoningState:
         """改进故事框架"""
@@ -1075,9 +1486,8 @@ class ReasoningGraph:
         """分发到所有关卡生成 - 并发生成6个关卡"""
         print("故事框架审核通过，开始并发生成6个关卡...")
         
-        # 初始化所有关卡的状态字段
-        if "level_details" not in state:
-            state["level_details"] = {}
+        # 初始化所有关卡的状态字段（新建字典，不修改上一步的状态对象）
+        state["level_details"] = dict(state.get("level_details") or {})
             
         for level in range(1, 7):
             level_key = f"level_{level}"
@@ -1087,26 +1497,15 @@ class ReasoningGraph:
                     "characters_status": "pending"
                 }
         
+        await self._publish_generation_progress(state, "framework", {"total": 6})
         print("已初始化6个关卡的状态，准备开始并发生成")
         return state
     
     # ==================== LLM辅助方法 ====================
     
-    def _build_conversation_context(self, messages: List[Dict[str, str]]) -> str:
-        """构建对话上下文"""
-        if not messages:
-            return "暂无对话记录"
-            
-        context_parts = []
-        # 取最近10轮对话
-        recent_messages = messages[-10:] if len(messages) > 10 else messages
-        
-        for msg in recent_messages:
-            role = msg.get("role", "unknown")
-            content = msg.get("content", "")  # 移除长度限制
-            context_parts.append(f"{role}: {content}")
-            
-        return "\n".join(context_parts)
+    def _build_conversation_context(self, messages: List[Dict[str, str]], call_site: str = "default") -> str:
+        """构建对话上下文 - 取最近10轮对话，按调用点的token预算截断和摘要"""
+        return self.context_builder.build_conversation_context(messages, call_site)
     
     async def _llm_check_input_fitness(self, user_input: str, collected_info: Dict[str, Any]) -> Dict[str, Any]:
         """使用LLM检查用户输入的适宜性"""
@@ -1119,7 +1518,7 @@ class ReasoningGraph:
         )
 
         try:
-            response = await self.llm.apredict(fitness_prompt)
+            response = await self._llm_apredict(fitness_prompt)
             json_content = self._extract_json_from_markdown(response.strip())
             result = json.loads(json_content)
             return result
@@ -1150,7 +1549,7 @@ class ReasoningGraph:
         )
 
         try:
-            response = await self.llm.apredict(assessment_prompt)
+            response = await self._llm_apredict(assessment_prompt)
             # 提取markdown代码块中的JSON内容
             json_content = self._extract_json_from_markdown(response.strip())
             result = json.loads(json_content)
@@ -1170,7 +1569,29 @@ class ReasoningGraph:
                     "strengths": [],
                     "weaknesses": ["评估过程中出现错误"],
                     "suggestions": ["请重新评估信息详细度"]
-                }
+                },
+                "assessment_failed": True
+            }
+
+    async def _llm_assess_sufficiency_dimensions(self, collected_info: Dict[str, Any], conversation_context: str,
+                                               dimensions: List[str]) -> Dict[str, Any]:
+        """使用LLM只评估指定维度的详细度"""
+        prompt_template = self.prompts.get_sufficiency_dimension_assessment_prompt()
+        assessment_prompt = prompt_template.format(
+            collected_info=self._format_collected_info_for_assessment(collected_info),
+            conversation_context=conversation_context,
+            dimensions="\n".join(f"- {dimension}（{SUFFICIENCY_DIMENSIONS[dimension]}）" for dimension in dimensions)
+        )
+
+        try:
+            response = await self._llm_apredict(assessment_prompt)
+            json_content = self._extract_json_from_markdown(response.strip())
+            return json.loads(json_content)
+        except Exception as e:
+            print(f"LLM维度评估失败: {e}")
+            return {
+                "dimension_scores": {dimension: 60 for dimension in dimensions},
+                "assessment_failed": True
             }
     
     async def _llm_generate_sufficiency_questions(self, collected_info: Dict[str, Any], 
@@ -1195,7 +1616,7 @@ class ReasoningGraph:
         )
 
         try:
-            return await self.llm.apredict(questions_prompt)
+            return await self._llm_apredict(questions_prompt)
         except Exception as e:
             print(f"生成补充问题失败: {e}")
             return f"为了更好地设计游戏，请提供更多关于{lowest_dimension}的详细信息。比如您希望游戏具体如何帮助学生学习？"
@@ -1212,7 +1633,7 @@ class ReasoningGraph:
         )
 
         try:
-            response = await self.llm.apredict(fitness_prompt)
+            response = await self._llm_apredict(fitness_prompt)
             print(f"DEBUG: 适宜性检查原始响应: {response[:200]}...")
             json_content = self._extract_json_from_markdown(response.strip())
             print(f"DEBUG: 提取的JSON内容: {json_content[:200]}...")
@@ -1224,7 +1645,8 @@ class ReasoningGraph:
             return {
                 "overall_fitness": "适宜",
                 "concerns": [],
-                "positive_aspects": ["内容积极健康"]
+                "positive_aspects": ["内容积极健康"],
+                "assessment_failed": True
             }
     
     async def _llm_generate_negotiate_response(self, fitness_concerns: List[Dict], 
@@ -1246,7 +1668,7 @@ class ReasoningGraph:
         )
 
         try:
-            return await self.llm.apredict(negotiate_prompt)
+            return await self._llm_apredict(negotiate_prompt)
         except Exception as e:
             print(f"生成协商回复失败: {e}")
             return "发现一些需要调整的地方，请修改设计以确保内容更适合目标学生群体。"
@@ -1269,7 +1691,7 @@ class ReasoningGraph:
         )
 
         try:
-            return await self.llm.apredict(final_prompt)
+            return await self._llm_apredict(final_prompt)
         except Exception as e:
             print(f"生成最终回复失败: {e}")
             return "信息收集完成！您的教育游戏设计非常棒，我们现在开始生成具体的游戏内容。"
@@ -1366,9 +1788,10 @@ class ReasoningGraph:
             messages=[],
             user_id=user_id,
             requirement_id=requirement_id,  # 预先确定的requirement_id
+            run_context={"session_id": session_id},
             
             # 需求收集状态
-            collected_info=collected_info,
+            collected_info={**empty_collected_info(), **(collected_info or {})},
             stage1_complete=False,
             
             # === Stage1状态字段 ===
@@ -1380,6 +1803,7 @@ class ReasoningGraph:
             overall_sufficiency=0.0,
             sufficiency_threshold=75.0,  # 可配置
             sufficiency_passed=False,
+            assessment_memo={},
             
             # 输入适宜性检查状态
             input_fitness_result={},
@@ -1396,10 +1820,12 @@ class ReasoningGraph:
             story_review_result={},
             story_iteration_count=0,
             story_framework_approved=False,
+            requirement_analysis_report="",
             
             # 最终状态
             ready_for_generation=False,
-            final_requirements={}
+            final_requirements={},
+            generation_job={}
         )
     
     async def process_reasoning_request(self, session_id: str, user_id: str, 
@@ -1408,12 +1834,10 @@ class ReasoningGraph:
         
         # 初始化状态
         initial_state = self.initialize_reasoning_state(session_id, user_id, collected_info)
-        
-        # 运行图 - 使用固定thread_id避免并发冲突
-        thread_config = {"configurable": {"thread_id": "main_thread"}}
+        initial_state["run_context"] = self._new_run_context(initial_state)
         
         try:
-            final_state = await self.graph.ainvoke(initial_state, config=thread_config)
+            final_state = await self.graph.ainvoke(initial_state, config=self._run_config(initial_state))
             
             return {
                 "success": True,
@@ -1432,40 +1856,24 @@ class ReasoningGraph:
             }
     
     async def process_reasoning_request_with_state(self, reasoning_state: Dict[str, Any], 
-                                                  user_input: str) -> Dict[str, Any]:
-        """使用已有状态处理推理请求 - 支持状态持久化"""
+                                                  user_input: str, idempotency_key: str = None) -> Dict[str, Any]:
+        """使用已有状态处理推理请求 - 支持状态持久化
+        idempotency_key: 请求的幂等键，本次运行进入生成时用于生成任务的去重"""
         
         try:
-            # 添加用户输入到消息历史
-            if "messages" not in reasoning_state:
-                reasoning_state["messages"] = []
-            
-            # 添加用户消息
-            reasoning_state["messages"].append({
+            # 复制一份本次运行的状态，节点对messages/collected_info的修改不会影响调用方持有的状态
+            run_state = dict(reasoning_state)
+            run_state["messages"] = list(reasoning_state.get("messages", [])) + [{
                 "role": "user",
                 "content": user_input,
                 "timestamp": datetime.now().isoformat()
-            })
+            }]
+            run_state["collected_info"] = {**empty_collected_info(), **(reasoning_state.get("collected_info") or {})}
+            run_state["run_context"] = {**self._new_run_context(reasoning_state), "idempotency_key": idempotency_key}
+            run_state["generation_job"] = {}
+            print(f"DEBUG: 本次运行状态，collected_info: {run_state['collected_info']}")
             
-            # 同步更新collected_info状态
-            print(f"DEBUG: 同步更新状态，collected_info: {reasoning_state.get('collected_info', {})}")
-            self.collected_info = reasoning_state.get("collected_info", {})
-            
-            # 清空之前的memory并重新同步对话历史（避免重复）
-            self.memory.chat_memory.clear()
-            
-            # 重新添加所有历史消息到memory
-            messages = reasoning_state.get("messages", [])
-            for msg in messages:
-                if msg.get("role") == "user":
-                    self.memory.chat_memory.add_user_message(msg["content"])
-                elif msg.get("role") == "assistant":
-                    self.memory.chat_memory.add_ai_message(msg["content"])
-            
-            # 运行图 - 使用固定thread_id避免并发冲突
-            thread_config = {"configurable": {"thread_id": "main_thread"}}
-            
-            final_state = await self.graph.ainvoke(reasoning_state, config=thread_config)
+            final_state = await self.graph.ainvoke(run_state, config=self._run_config(run_state))
             
             return {
                 "success": True,
@@ -1483,6 +1891,19 @@ class ReasoningGraph:
                 "ready_for_generation": False
             }
     
+    def _new_run_context(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """为单次图运行生成上下文，保留会话级字段（session_id）"""
+        run_context = dict(state.get("run_context") or {})
+        run_context["run_id"] = uuid.uuid4().hex
+        run_context["started_at"] = datetime.now().isoformat()
+        return run_context
+
+    def _run_config(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """按会话区分thread_id，不同会话的运行互不干扰"""
+        run_context = state.get("run_context") or {}
+        thread_id = run_context.get("session_id") or run_context.get("run_id") or state.get("requirement_id", "main_thread")
+        return {"configurable": {"thread_id": thread_id}}
+
     def _determine_current_stage(self, final_state: ReasoningState) -> str:
         """根据最终状态确定当前所处阶段"""
         
@@ -1501,18 +1922,35 @@ class ReasoningGraph:
     # ==================== 关卡详细内容生成节点 ====================
     
     
-    async def _generate_level_scenes(self, state: ReasoningState, level: int) -> ReasoningState:
-        """为指定关卡生成完整内容：场景、角色、对话、剧本一体化生成"""
+    async def _generate_level_node(self, state: ReasoningState, level: int) -> ReasoningState:
+        """关卡生成节点：生成（或复用推测生成的）关卡后记录生成任务进度"""
+        update = await self._generate_level_scenes(state, level)
+        level_key = f"level_{level}"
+        level_data = update["level_details"].get(level_key) or (state.get("level_details") or {}).get(level_key) or {}
+        await self._publish_generation_progress(state, "level", {
+            "stage_index": level,
+            "status": level_data.get("scenes_status", "failed"),
+            "total": 6
+        })
+        return update
+
+    async def _generate_level_scenes(self, state: ReasoningState, level: int,
+                                     sent_prompts: Optional[Dict[int, str]] = None) -> ReasoningState:
+        """为指定关卡生成完整内容：场景、角色、对话、剧本一体化生成；sent_prompts 记录已发出的prompt（推测模式统计用）"""
+
+        # 只修改本关卡的副本，6个关卡并发执行时互不影响
+        level_key = f"level_{level}"
+        level_data = dict((state.get("level_details") or {}).get(level_key) or {})
+        framework_hash = self._framework_hash(state.get("story_framework", ""))
+
+        # 推测模式下审核期间已按同一版本的框架生成过，直接复用
+        if level_data.get("scenes_status") == "completed" and level_data.get("framework_hash") == framework_hash:
+            print(f"第{level}关卡已在审核期间生成，直接使用")
+            return {"level_details": {}}
 
         try:
             print(f"开始生成第{level}关卡的完整内容（场景+角色+对话）...")
             
-            # 初始化level_details如果不存在
-            if "level_details" not in state:
-                state["level_details"] = {}
-            if f"level_{level}" not in state["level_details"]:
-                state["level_details"][f"level_{level}"] = {}
-            
             # 获取场景剧本生成prompt
             from prompt_templates import create_prompt_templates
             templates = create_prompt_templates()
@@ -1528,8 +1966,14 @@ class ReasoningGraph:
             
             # 调用LLM生成场景剧本
             print(f"第{level}关卡调用LLM，prompt长度: {len(formatted_prompt)}")
-            response = await self.llm.ainvoke([{"role": "user", "content": formatted_prompt}])
+            if sent_prompts is not None:
+                sent_prompts[level] = formatted_prompt
+            response = await self._llm_ainvoke([{"role": "user", "content": formatted_prompt}])
+            prompt_cache_metrics.record("level_scenes", response)
             scenes_content = response.content
+            input_tokens, output_tokens = extract_token_usage(response)
+            level_data["token_usage"] = {"input_tokens": input_tokens, "output_tokens": output_tokens}
+            level_data["framework_hash"] = framework_hash
             
             print(f"第{level}关卡LLM返回内容长度: {len(scenes_content)}")
             # print(f"第{level}关卡LLM返回内容: {repr(scenes_content)}")  # 注释掉避免编码问题
@@ -1542,24 +1986,30 @@ class ReasoningGraph:
                 scene_data = json.loads(json_content)
 
                 # 保存完整的场景数据（包含角色和对话）
-                state["level_details"][f"level_{level}"]["scenes_script"] = scenes_content
-                state["level_details"][f"level_{level}"]["parsed_scene_data"] = scene_data
-                state["level_details"][f"level_{level}"]["scenes_status"] = "completed"
-                state["level_details"][f"level_{level}"]["scenes_generated_at"] = datetime.now().isoformat()
+                level_data["scenes_script"] = scenes_content
+                level_data["parsed_scene_data"] = scene_data
+                level_data["scenes_status"] = "completed"
+                level_data["scenes_generated_at"] = datetime.now().isoformat()
 
                 # 同时标记角色对话也已完成（因为现在是一起生成的）
-                state["level_details"][f"level_{level}"]["characters_dialogue"] = scene_data.get("人物对话", [])
-                state["level_details"][f"level_{level}"]["characters_status"] = "completed"
-                state["level_details"][f"level_{level}"]["characters_generated_at"] = datetime.now().isoformat()
+                level_data["characters_dialogue"] = scene_data.get("人物对话", [])
+                level_data["characters_status"] = "completed"
+                level_data["characters_generated_at"] = datetime.now().isoformat()
 
                 print(f"第{level}关卡场景和角色数据解析成功")
 
             except json.JSONDecodeError as e:
                 print(f"第{level}关卡JSON解析失败: {e}")
                 # 如果解析失败，至少保存原始内容
-                state["level_details"][f"level_{level}"]["scenes_script"] = scenes_content
-                state["level_details"][f"level_{level}"]["scenes_status"] = "completed"
-                state["level_details"][f"level_{level}"]["scenes_generated_at"] = datetime.now().isoformat()
+                level_data["scenes_script"] = scenes_content
+                level_data["scenes_status"] = "completed"
+                level_data["scenes_generated_at"] = datetime.now().isoformat()
+
+            # 增量评估：本关卡完成后立即评估，汇聚时只需汇总
+            if self.incremental_assessment:
+                level_data["assessment_fragment"] = await self._assess_level_fragment(
+                    state.get("collected_info", {}), level, level_data
+                )
             
            
             print(f"第{level}关卡场景剧本生成完成")
@@ -1568,16 +2018,11 @@ class ReasoningGraph:
             print(f"第{level}关卡场景剧本生成失败: {e}")
             
             # 即使失败也保存错误信息
-            if "level_details" not in state:
-                state["level_details"] = {}
-            if f"level_{level}" not in state["level_details"]:
-                state["level_details"][f"level_{level}"] = {}
-                
-            state["level_details"][f"level_{level}"]["scenes_status"] = "failed"
-            state["level_details"][f"level_{level}"]["scenes_error"] = str(e)
+            level_data["scenes_status"] = "failed"
+            level_data["scenes_error"] = str(e)
         
-        # 只返回level_details更新，避免并发冲突
-        return {"level_details": state["level_details"]}
+        # 只返回本关卡的level_details更新，由merge_level_details合并，避免并发冲突
+        return {"level_details": {level_key: level_data}}
     
     async def _collect_all_level_results(self, state: ReasoningState) -> ReasoningState:
         """汇聚所有关卡的生成结果"""
@@ -1628,13 +2073,19 @@ class ReasoningGraph:
                 "type": "level_generation_summary"
             })
             
-            # 生成教育达成度评估报告
-            education_assessment = await self._generate_education_assessment(
-                collected_info=state.get("collected_info", {}),
-                level_details=state.get("level_details", {}),
-                story_framework=state.get("story_framework", ""),
-                analysis_report=state.get("requirement_analysis_report", "")
-            )
+            # 生成教育达成度评估报告：增量模式下汇总各关卡的评估片段，没有可用片段时再整体评估
+            education_assessment = None
+            if self.incremental_assessment:
+                education_assessment = self._aggregate_assessment_fragments(
+                    state.get("collected_info", {}), level_details
+                )
+            if education_assessment is None:
+                education_assessment = await self._generate_education_assessment(
+                    collected_info=state.get("collected_info", {}),
+                    level_details=state.get("level_details", {}),
+                    story_framework=state.get("story_framework", ""),
+                    analysis_report=state.get("requirement_analysis_report", "")
+                )
 
             # 添加评估报告到状态
             state["education_assessment_report"] = education_assessment
@@ -1644,10 +2095,6 @@ class ReasoningGraph:
 
             print("关卡生成结果汇聚完成")
             print(f"教育达成度评估完成，总分：{education_assessment.get('总分', 0)}/100")
-
-            # 在完成所有内容生成后清空 memory
-            self._clear_memory_after_completion()
-            print("已清空对话memory，准备进入下一轮对话")
             
         except Exception as e:
             print(f"汇聚结果失败: {e}")
@@ -1677,10 +2124,10 @@ class ReasoningGraph:
 {self._format_collected_info_for_assessment(collected_info)}
 
 ## 故事框架
-{story_framework}
+{self.context_builder.fit_text(story_framework, "assessment_story_framework")}
 
 ## 需求分析报告
-{analysis_report}
+{self.context_builder.fit_text(analysis_report, "assessment_analysis_report")}
 
 ## 生成的游戏内容概况
 {self._format_level_details_for_assessment(level_details)}
@@ -1773,7 +2220,7 @@ class ReasoningGraph:
 """
 
             # 调用LLM生成评估报告
-            response = await self.llm.ainvoke([{"role": "user", "content": assessment_prompt}])
+            response = await self._llm_ainvoke([{"role": "user", "content": assessment_prompt}])
             assessment_content = response.content
 
             # 解析JSON评估结果
@@ -1796,18 +2243,109 @@ class ReasoningGraph:
             print(f"生成教育达成度评估失败: {e}")
             return self._create_default_assessment(collected_info)
 
+    async def _assess_level_fragment(self, collected_info: Dict[str, Any], level: int,
+                                     level_data: Dict[str, Any]) -> Dict[str, Any]:
+        """评估单个关卡的教育达成度，失败时返回None（汇总时跳过该关卡）"""
+        level_content = "\n".join([
+            self._format_level_details_for_assessment({f"level_{level}": level_data}),
+            self.context_builder.fit_text(level_data.get("scenes_script", ""), "assessment_level_fragment")
+        ])
+        prompt = self.prompts.get_level_assessment_prompt().format(
+            collected_info=self._format_collected_info_for_assessment(collected_info),
+            level=level,
+            level_content=level_content
+        )
+
+        try:
+            response = await self._llm_ainvoke(prompt)
+            prompt_cache_metrics.record("level_assessment", response)
+            fragment = json.loads(self._extract_json_from_markdown(response.content.strip()))
+            scores = fragment.get("维度得分") or {}
+            fragment["维度得分"] = {dimension: float(scores[dimension])
+                                for dimension in EDUCATION_ASSESSMENT_DIMENSIONS if dimension in scores}
+            print(f"第{level}关卡教育达成度评估完成")
+            return fragment
+        except Exception as e:
+            print(f"第{level}关卡教育达成度评估失败: {e}")
+            return None
+
+    def _aggregate_assessment_fragments(self, collected_info: Dict[str, Any],
+                                        level_details: Dict[str, Any]) -> Dict[str, Any]:
+        """把各关卡的评估片段汇总为完整的评估报告（不调用LLM），没有任何片段时返回None"""
+        fragments = {}
+        for level in range(1, 7):
+            fragment = (level_details.get(f"level_{level}") or {}).get("assessment_fragment")
+            if fragment and fragment.get("维度得分"):
+                fragments[level] = fragment
+        if not fragments:
+            return None
+
+        def unique_items(field: str, limit: int) -> List[str]:
+            items = []
+            for fragment in fragments.values():
+                for item in fragment.get(field) or []:
+                    if isinstance(item, str) and item and item not in items:
+                        items.append(item)
+            return items[:limit]
+
+        dimensions = {}
+        total_score = 0
+        for dimension, full_score in EDUCATION_ASSESSMENT_DIMENSIONS.items():
+            level_scores = {level: fragment["维度得分"][dimension]
+                            for level, fragment in fragments.items() if dimension in fragment["维度得分"]}
+            average = sum(level_scores.values()) / len(level_scores) if level_scores else 0
+            score = round(average / 100 * full_score)
+            total_score += score
+
+            weakest_level = min(level_scores, key=level_scores.get) if level_scores else None
+            weakest_suggestions = (fragments[weakest_level].get("改进建议") or []) if weakest_level else []
+            dimensions[dimension] = {
+                "得分": score,
+                "满分": full_score,
+                "评分理由": "按关卡评估汇总，" + "，".join(
+                    f"第{level}关{level_score:.0f}分" for level, level_score in level_scores.items()
+                ),
+                "改进建议": f"重点关注第{weakest_level}关：{weakest_suggestions[0]}" if weakest_suggestions else "保持当前设计"
+            }
+
+        if total_score >= 90:
+            grade_label = "优秀"
+        elif total_score >= 75:
+            grade_label = "良好"
+        elif total_score >= 60:
+            grade_label = "合格"
+        else:
+            grade_label = "待改进"
+
+        subject = collected_info.get("subject", "未指定")
+        grade = collected_info.get("grade", "未指定")
+        print(f"教育达成度评估由{len(fragments)}个关卡的评估片段汇总生成")
+        return {
+            "评估维度": dimensions,
+            "总分": total_score,
+            "满分": 100,
+            "等级评定": grade_label,
+            "整体评价": f"这是一个针对{grade}{subject}教学的RPG教育游戏，按{len(fragments)}个关卡分别评估后汇总，总分{total_score}/100，等级{grade_label}。",
+            "主要优势": unique_items("优势", 5),
+            "主要问题": unique_items("问题", 5),
+            "改进建议": unique_items("改进建议", 5),
+            "适用场景": f"适用于{grade}学生的{subject}课堂教学或课外学习，建议配合教师指导使用。",
+            "评估方式": "incremental"
+        }
+
     def _format_level_details_for_assessment(self, level_details: Dict[str, Any]) -> str:
         """格式化关卡详情用于评估"""
 
         if not level_details:
             return "无关卡详情"
 
-        summary_lines = []
+        level_sections = []
 
         for level in range(1, 7):
             level_key = f"level_{level}"
             if level_key in level_details:
                 level_data = level_details[level_key]
+                summary_lines = []
 
                 # 提取关卡基本信息
                 scenes_status = level_data.get("scenes_status", "未知")
@@ -1840,7 +2378,13 @@ class ReasoningGraph:
                     if dialogues:
                         summary_lines.append(f"  - 对话段数：{len(dialogues)}")
 
-        return "\n".join(summary_lines) if summary_lines else "无有效关卡内容"
+                level_sections.append("\n".join(summary_lines))
+
+        if not level_sections:
+            return "无有效关卡内容"
+
+        # 各关卡平分token预算，避免个别关卡内容过长撑大评估prompt
+        return "\n".join(self.context_builder.fit_sections(level_sections, "assessment_level_details"))
 
     def _create_default_assessment(self, collected_info: Dict[str, Any]) -> Dict[str, Any]:
         """创建默认的评估结果（当评估生成失败时使用）"""
@@ -1908,31 +2452,6 @@ class ReasoningGraph:
             "适用场景": f"适用于{grade}学生的{subject}课堂教学或课外学习，建议配合教师指导使用。"
         }
 
-    def _clear_memory_after_completion(self):
-        """在完成所有内容生成后清空memory，为下次对话做准备"""
-        try:
-            if hasattr(self, 'memory') and self.memory:
-                self.memory.chat_memory.clear()
-                print("已清空ConversationSummaryBufferMemory")
-
-            # 重置collected_info为初始状态
-            self.collected_info = {
-                "subject": None,
-                "grade": None,
-                "knowledge_points": None,
-                "teaching_goals": None,
-                "teaching_difficulties": None,
-                "game_style": None,
-                "character_design": None,
-                "world_setting": None,
-                "plot_requirements": None,
-                "interaction_requirements": None
-            }
-            print("已重置collected_info状态")
-
-        except Exception as e:
-            print(f"清空memory时出错: {e}")
-
 
 # 便利函数
 def create_reasoning_graph() -> ReasoningGraph:
@@ -10,43 +10,45 @@ import json
 import os
 import uuid
 import concurrent.futures
-import requests
 import base64
 from datetime import datetime
 from typing import Dict, Any, List, Tuple, Optional
 from database_client import db_client
+from prompt_cache import assemble_prompt, prompt_cache_metrics
+from image_cache import image_cache, image_cache_key
+from http_client import get_http_client
+from image_variants import image_variant_pipeline
+from story_storage import build_storyboard_row
+from single_flight import LLM_SINGLE_FLIGHT, llm_call_flight, request_key
 from dotenv import load_dotenv
 from openai import OpenAI
 
 # 加载环境变量
 load_dotenv()
 
+# 按需生成图片：Stage3只保存图片提示词，图片在第一次查看关卡时生成（见 lazy_images.py）
+LAZY_IMAGE_GENERATION = os.getenv("LAZY_IMAGE_GENERATION", "false").lower() in ("1", "true", "yes")
+
+# 图片生成参数（同时是图片缓存键的一部分）
+IMAGE_MODEL = "dall-e-3"
+IMAGE_SIZE = "1024x1024"
+IMAGE_QUALITY = "standard"
+
 # Stage2 RPG框架生成prompt
-STAGE_2_PROMPT = """你是一名"剧情驱动教育游戏设计师"。你的任务是创造一个真正的故事冒险，其中{subject}知识是解决困境、推进剧情的核心工具，而不是附加的学习任务。**必须生成6个关卡**，每个关卡都有真实的困境需要数学知识才能突破。
+# 静态设计指令在前、本次需求的输入数据在后，所有Stage2调用共享同一个可缓存前缀
+STAGE_2_INSTRUCTIONS = """你是一名"剧情驱动教育游戏设计师"。你的任务是创造一个真正的故事冒险，其中学科知识是解决困境、推进剧情的核心工具，而不是附加的学习任务。**必须生成6个关卡**，每个关卡都有真实的困境需要学科知识才能突破。
 
 【核心设计理念】
-- 每个关卡角色都面临真实困境，{subject}知识是解决困境的唯一途径
+- 每个关卡角色都面临真实困境，学科知识是解决困境的唯一途径
 - 避免"老师出题学生答题"模式，营造"冒险者遇到困难并解决"氛围
 - 知识点要融入世界观，成为这个世界的自然法则
 - 学习过程伪装成"发现世界规律"和"解谜探索"
 
-【输入数据】
-- 学科：{subject}
-- 年级：{grade}
-- 知识点：{knowledge_points}      # 列表，示例：["等量相加","乘法交换律",...]
-- 教学目标：{teaching_goals}       # 面向本单元整体目标的表述
-- 教学难点：{teaching_difficulties}
-- 游戏风格：{game_style}          # 如"童话/蒸汽朋克/科幻探险/地城探险"等
-- 角色设计：{character_design}     # 仅两个：玩家 + 1 位 NPC（向导/导师/同伴）
-- 世界背景：{world_setting}        # 故事设定、主线矛盾、任务缘由
-- 情节需求：{plot_requirements}   # "情节=故事发展脉络"，描述希望的剧情发展类型
-- 互动需求：{interaction_requirements}
-
 【剧情驱动框架设计】
 1) **整体RPG冒险框架**：
-   - 标题：体现冒险感和{subject}融合的标题
-   - 世界观：{subject}知识是这个世界运行的核心规律
-   - 主线剧情：角色有明确目标，遇到真实困境，必须学会{subject}规律才能达成目标
+   - 标题：体现冒险感和学科融合的标题
+   - 世界观：学科知识是这个世界运行的核心规律
+   - 主线剧情：角色有明确目标，遇到真实困境，必须学会学科规律才能达成目标
    - 主要角色：玩家是冒险者，NPC是探索伙伴（不是老师）
    - 故事推进逻辑：每个困境的解决都推进主线剧情
 
@@ -54,10 +56,10 @@ STAGE_2_PROMPT = """你是一名"剧情驱动教育游戏设计师"。你的任
    - 关卡名称：体现困境性质，如"失控的魔法阵"、"古老机关的秘密"
    - 场景名称：具体的冒险场景，营造紧迫感
    - 关卡编号：唯一标识符，格式为"node_1"、"node_2"等  
-   - 教学目标：对应{knowledge_points}，但包装成"需要掌握的世界规律"
+   - 教学目标：对应输入数据中的知识点，但包装成"需要掌握的世界规律"
    - 故事情境：描述角色面临的真实困境，制造紧张感和探索欲望
-   - 知识讲解：将{subject}知识包装成"世界法则"，通过角色探索自然发现
-   - 困境解决：具体说明{subject}知识如何成为解决困境的关键
+   - 知识讲解：将学科知识包装成"世界法则"，通过角色探索自然发现
+   - 困境解决：具体说明学科知识如何成为解决困境的关键
    - 难度标签：困境复杂程度递增
    - 衔接逻辑：前一个困境的解决为下一个困境埋下伏笔
    - 下一关选项：根据关卡类型提供选择分支（详见下方分支规则）
@@ -71,9 +73,9 @@ STAGE_2_PROMPT = """你是一名"剧情驱动教育游戏设计师"。你的任
    - 所有路径最终都能到达结束节点
    - 关卡编号必须唯一且按"node_1"、"node_2"格式命名
 
-4) **叙事表达**：每关用 2–4 句"故事化旁白 + 角色对话"呈现学习情境（避免艰深术语），与 {game_style}/{world_setting} 一致。
+4) **叙事表达**：每关用 2–4 句"故事化旁白 + 角色对话"呈现学习情境（避免艰深术语），与输入数据中的游戏风格和世界背景一致。
 
-5) **语言风格**：简洁、积极、鼓励式反馈；使用 {grade} 能理解的比喻与词汇。
+5) **语言风格**：简洁、积极、鼓励式反馈；使用目标年级学生能理解的比喻与词汇。
 
 6) **只输出 JSON 对象**，严格按照以下结构：
 {{
@@ -81,7 +83,7 @@ STAGE_2_PROMPT = """你是一名"剧情驱动教育游戏设计师"。你的任
     "标题": "...",
     "世界观": "...",
     "主线剧情": "...",
-    "游戏风格": "{game_style}",
+    "游戏风格": "与输入数据中的游戏风格一致",
     "主要角色": {{
       "玩家角色": {{
         "角色名": "...",
@@ -141,26 +143,52 @@ STAGE_2_PROMPT = """你是一名"剧情驱动教育游戏设计师"。你的任
 
 【剧情驱动自检标准】
 - 困境真实性：每个关卡的困境都是角色世界中的真实问题，不是为了学习而设计的
-- 知识融合度：{subject}知识看起来是世界的自然法则，解决困境的必备工具
+- 知识融合度：学科知识看起来是世界的自然法则，解决困境的必备工具
 - 情感动机：角色有真实的目标追求，困境带来挫败感，解决带来成就感
 - 冒险氛围：避免"课堂感"，营造"探索解谜"的紧张和兴奋
 - 伙伴关系：NPC与玩家是探索伙伴关系，共同面对困境，不是师生关系
 - 剧情推进：每个困境的解决都获得有意义的故事进展，不只是"答对了"
-- 世界一致性：{subject}知识在世界观中有合理存在意义，不显突兀
-- 适龄挑战：困境难度符合{grade}年级认知水平，但有真实的紧迫感
+- 世界一致性：学科知识在世界观中有合理存在意义，不显突兀
+- 适龄挑战：困境难度符合目标年级认知水平，但有真实的紧迫感
 - 分支合理：按照1/3分支比例规则，确保分支关卡提供有意义的选择，线性关卡推进剧情
 - 连通完整：检查所有关卡的跳转逻辑，确保每个关卡都可达，没有孤立节点，所有路径都能到达结束节点
 
-请按以上要求直接输出最终 JSON，确保格式完全符合标准。"""
+请按以上要求，基于文末的输入数据直接输出最终 JSON，确保格式完全符合标准。"""
+
+STAGE_2_INPUT = """【输入数据】
+- 学科：{subject}
+- 年级：{grade}
+- 知识点：{knowledge_points}      # 列表，示例：["等量相加","乘法交换律",...]
+- 教学目标：{teaching_goals}       # 面向本单元整体目标的表述
+- 教学难点：{teaching_difficulties}
+- 游戏风格：{game_style}          # 如"童话/蒸汽朋克/科幻探险/地城探险"等
+- 角色设计：{character_design}     # 仅两个：玩家 + 1 位 NPC（向导/导师/同伴）
+- 世界背景：{world_setting}        # 故事设定、主线矛盾、任务缘由
+- 情节需求：{plot_requirements}   # "情节=故事发展脉络"，描述希望的剧情发展类型
+- 互动需求：{interaction_requirements}
+
+请基于以上输入数据，按前述要求直接输出最终 JSON。"""
+
+STAGE_2_PROMPT = assemble_prompt(STAGE_2_INSTRUCTIONS, call_variables=STAGE_2_INPUT)
 
 
 class SceneGenerator:
-    def __init__(self, model_name: str = "gpt-4o-mini"):
+    def __init__(self, model_name: str = "gpt-4o-mini", lazy_images: bool = LAZY_IMAGE_GENERATION,
+                 coalesce_llm_calls: bool = LLM_SINGLE_FLIGHT):
         """初始化场景生成器"""
         self.model_name = model_name
-        self.openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.lazy_images = lazy_images
+        self.coalesce_llm_calls = coalesce_llm_calls
+        self.openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=get_http_client())
         self.db_client = db_client
 
+    def _chat_completion(self, **kwargs):
+        """调用OpenAI；coalesce_llm_calls 开启时并发的相同请求（如重复点击生成）只调用一次"""
+        if not self.coalesce_llm_calls:
+            return self.openai_client.chat.completions.create(**kwargs)
+        return llm_call_flight.do(request_key("chat_completion", kwargs),
+                                  lambda: self.openai_client.chat.completions.create(**kwargs))
+
     def _get_stage1_data(self, requirement_id: str) -> Optional[Dict]:
         """从数据库获取Stage1数据"""
         if not self.db_client:
@@ -238,7 +266,7 @@ class SceneGenerator:
             print("🎮 正在生成RPG故事框架...")
             
             # 调用OpenAI
-            response = self.openai_client.chat.completions.create(
+            response = self._chat_completion(
                 model=self.model_name,
                 messages=[
                     {"role": "system", "content": "你是专业的教育游戏故事设计师。"},
@@ -247,6 +275,7 @@ class SceneGenerator:
                 temperature=0.8,
                 max_tokens=4000
             )
+            prompt_cache_metrics.record("stage2_framework", response)
             
             return response.choices[0].message.content
             
@@ -359,7 +388,7 @@ class SceneGenerator:
             story_id = f"story_{str(uuid.uuid4())[:8]}"
             timestamp = datetime.now().isoformat()
             
-            # 1. 首先保存故事主体数据（包含RPG框架和关卡列表）
+            # 1. 故事主体数据（包含RPG框架和关卡列表）
             story_data = {
                 "story_id": story_id,
                 "story_title": rpg_framework.get('游戏名称', '未命名游戏'),
@@ -374,76 +403,17 @@ class SceneGenerator:
                 "successful_storyboards": len(storyboards_list)
             }
             
-            # 保存故事主体
-            story_result = self.db_client.save_story(story_id, requirement_id, story_data)
-            if not story_result.get('success'):
-                print(f"❌ 故事主体保存失败: {story_result.get('error')}")
-                return None
-            
-            print(f"✅ 故事主体已保存: {story_id}")
+            # 2. 构建每个关卡的详细故事板数据
+            storyboards = [build_storyboard_row(story_id, storyboard_item, timestamp)
+                           for storyboard_item in storyboards_list]
             
-            # 2. 逐个保存每个关卡的详细故事板数据
-            saved_count = 0
-            for storyboard_item in storyboards_list:
-                try:
-                    stage_id = storyboard_item.get('stage_id', f"stage_{storyboard_item.get('stage_index', 0)}")
-                    storyboard_id = f"storyboard_{story_id}_{stage_id}"
-                    
-                    # 提取关卡连接信息
-                    next_stages = []
-                    stage_connections = storyboard_item.get('storyboard', {}).get('人物对话', {}).get('场景转换', {})
-                    if stage_connections:
-                        next_stages = list(stage_connections.keys())
-                    
-                    # 构建包含所有必要信息的故事板数据
-                    complete_storyboard_data = {
-                        "storyboard_id": storyboard_id,
-                        "story_id": story_id,
-                        "stage_id": stage_id,
-                        "stage_index": storyboard_item.get('stage_index'),
-                        "stage_name": storyboard_item.get('stage_name'),
-                        "timestamp": timestamp,
-                        
-                        # 剧本信息
-                        "script": storyboard_item.get('storyboard', {}).get('剧本', {}),
-                        
-                        # 角色信息
-                        "characters": storyboard_item.get('storyboard', {}).get('人物档案', {}),
-                        
-                        # 对话内容
-                        "dialogue_content": storyboard_item.get('generated_dialogue'),
-                        
-                        # 图像信息
-                        "image_data": {
-                            "prompt": storyboard_item.get('storyboard', {}).get('图片提示词'),
-                            "generated_image": storyboard_item.get('generated_image_data'),
-                            "image_format": "base64" if storyboard_item.get('generated_image_data') else None
-                        },
-                        
-                        # 下一关选项（节点名称）
-                        "next_stage_options": next_stages,
-                        "stage_connections": stage_connections,
-                        
-                        # 生成状态
-                        "generation_status": storyboard_item.get('generation_status', {}),
-                        
-                        # 完整的原始故事板数据
-                        "full_storyboard": storyboard_item.get('storyboard', {})
-                    }
-                    
-                    # 保存单个故事板
-                    storyboard_result = self.db_client.save_storyboard(storyboard_id, story_id, complete_storyboard_data)
-                    
-                    if storyboard_result.get('success'):
-                        saved_count += 1
-                        print(f"✅ 关卡故事板已保存: {storyboard_item.get('stage_name')} ({stage_id})")
-                    else:
-                        print(f"❌ 关卡故事板保存失败: {storyboard_item.get('stage_name')} - {storyboard_result.get('error')}")
-                        
-                except Exception as e:
-                    print(f"❌ 保存关卡故事板异常 {storyboard_item.get('stage_name', 'unknown')}: {e}")
-                    continue
+            # 3. 故事主体和所有故事板在一个事务中写入，失败时不会留下只写了一半的故事
+            bundle_result = self.db_client.save_story_bundle(story_id, requirement_id, story_data, storyboards)
+            if not bundle_result.get('success'):
+                print(f"❌ Stage3数据保存失败（已回滚）: {bundle_result.get('error')}")
+                return None
             
+            saved_count = len(bundle_result.get('storyboard_ids', []))
             print(f"💾 Stage3数据保存完成: {saved_count}/{len(storyboards_list)} 个关卡故事板已保存")
             return story_id
             
@@ -621,7 +591,7 @@ class SceneGenerator:
             )
             
             # 调用OpenAI生成故事板
-            response = self.openai_client.chat.completions.create(
+            response = self._chat_completion(
                 model=self.model_name,
                 messages=[
                     {"role": "system", "content": "你是专业的教育游戏分镜设计师，擅长创作生动有趣的教学游戏剧本。"},
@@ -630,6 +600,7 @@ class SceneGenerator:
                 temperature=0.8,
                 max_tokens=3000
             )
+            prompt_cache_metrics.record("stage3_storyboard", response)
             
             raw_storyboard = response.choices[0].message.content
             
@@ -735,7 +706,7 @@ class SceneGenerator:
 修复后的JSON：
 """
 
-            response = self.openai_client.chat.completions.create(
+            response = self._chat_completion(
                 model="gpt-4o-mini",
                 messages=[
                     {"role": "system", "content": "你是JSON格式修复专家，只返回格式正确的JSON，不添加任何解释。"},
@@ -780,23 +751,36 @@ class SceneGenerator:
             if image_prompt.get('技术参数'):
                 parts.append(f"Technical: {image_prompt['技术参数']}")
 
-            full_prompt = ', '.join(parts)
+            full_prompt = f"pixel art RPG style, high resolution game art, {', '.join(parts)}"
+
+            # 相同提示词已生成过时直接读取本地缓存
+            image_key = image_cache_key(full_prompt, IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY)
+            cached_image = image_cache.get(full_prompt, IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY)
+            if cached_image:
+                print(f"🎨 {stage_id} 命中图片缓存")
+                if image_variant_pipeline.has_variants(cached_image):
+                    return cached_image
+                # 旧的缓存条目没有衍生版本（或blob已删除）：转码一次后写回缓存
+                cached_image = image_variant_pipeline.add_variants(cached_image, image_key)
+                if image_variant_pipeline.has_variants(cached_image):
+                    image_cache.put(full_prompt, IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY, cached_image)
+                return cached_image
 
             print(f"🎨 正在为 {stage_id} 生成图像...")
 
-            # 调用OpenAI DALL-E 3 API
-            response = requests.post(
+            # 调用OpenAI DALL-E 3 API（共享连接池，带超时）
+            response = get_http_client().post(
                 'https://api.openai.com/v1/images/generations',
                 headers={
                     'Content-Type': 'application/json',
                     'Authorization': f'Bearer {os.getenv("OPENAI_API_KEY")}',
                 },
                 json={
-                    "model": "dall-e-3",
-                    "prompt": f"pixel art RPG style, high resolution game art, {full_prompt}",
+                    "model": IMAGE_MODEL,
+                    "prompt": full_prompt,
                     "n": 1,
-                    "size": "1024x1024",
-                    "quality": "standard",
+                    "size": IMAGE_SIZE,
+                    "quality": IMAGE_QUALITY,
                     "response_format": "url"
                 }
             )
@@ -809,7 +793,7 @@ class SceneGenerator:
                     
                     # 下载图片文件
                     try:
-                        image_response = requests.get(image_url, timeout=30)
+                        image_response = get_http_client().get(image_url, timeout=30)
                         if image_response.status_code == 200:
                             # 获取图片数据
                             image_content = image_response.content
@@ -827,11 +811,15 @@ class SceneGenerator:
                             image_base64 = base64.b64encode(image_content).decode('utf-8')
                             
                             print(f"✅ {stage_id} 图像下载并转换成功 ({len(image_content)} bytes)")
-                            return {
+                            generated_image = {
                                 'base64_data': image_base64,
                                 'file_extension': file_ext,
                                 'original_url': image_url
                             }
+                            # WebP/AVIF和缩略图写入blob存储，原图旁边（包括图片缓存）只保存引用
+                            generated_image = image_variant_pipeline.add_variants(generated_image, image_key)
+                            image_cache.put(full_prompt, IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY, generated_image)
+                            return generated_image
                         else:
                             print(f"❌ {stage_id} 图像下载失败：{image_response.status_code}")
                             return None
@@ -890,7 +878,7 @@ class SceneGenerator:
 请生成8-15轮完整的沉浸式对话，包含完整的互动解谜环节。
 """
 
-            response = self.openai_client.chat.completions.create(
+            response = self._chat_completion(
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": dialogue_prompt}],
                 temperature=0.7,
@@ -942,7 +930,7 @@ class SceneGenerator:
                         print(f"❌ [线程{i+1}] 故事板生成失败，终止该关卡")
                         return None
 
-                # 2. 并行生成图像和对话
+                # 2. 并行生成图像和对话（按需模式下只生成对话，图片提示词随故事板保存）
                 print(f"🚀 [线程{i+1}] 步骤2/3: 并行生成图像和对话...")
 
                 # 使用嵌套的ThreadPoolExecutor进行子并行处理
@@ -953,7 +941,7 @@ class SceneGenerator:
                     # 提交图像生成任务
                     image_future = None
                     image_prompt = storyboard_data.get('图片提示词', {})
-                    if image_prompt:
+                    if image_prompt and not self.lazy_images:
                         image_future = sub_executor.submit(self._generate_image, image_prompt, stage_id)
 
                     # 提交对话生成任务
@@ -989,7 +977,7 @@ class SceneGenerator:
                     "generated_dialogue": generated_dialogue,
                     "generation_status": {
                         "storyboard": "success",
-                        "image": "success" if image_data else "failed",
+                        "image": "success" if image_data else ("deferred" if self.lazy_images and image_prompt else "failed"),
                         "dialogue": "success" if generated_dialogue else "failed"
                     }
                 }
@@ -1010,46 +998,15 @@ class SceneGenerator:
 
 
 # Stage3 故事板生成prompt（剧情驱动版本）
-STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。你的任务是为这个关卡创造沉浸式的冒险分镜，其中{subject}知识是解决困境、推进剧情的核心工具，而不是附加的学习任务。
+# 拆成三段：静态设计指令 → 同一故事共享的RPG框架 → 单个关卡的数据，关卡间并发调用共享缓存前缀
+STORYBOARD_INSTRUCTIONS = """你是一名"剧情驱动教育游戏分镜设计师"。你的任务是为文末指定的关卡创造沉浸式的冒险分镜，其中学科知识是解决困境、推进剧情的核心工具，而不是附加的学习任务。
 
 【核心设计理念】
-- {subject}知识必须是解决剧情困境的唯一途径
+- 学科知识必须是解决剧情困境的唯一途径
 - 角色有真实的动机和目标，遇到真实的困难
 - 学习过程伪装成"发现世界规律"和"解谜探索"
 - 避免"老师出题"模式，采用"伙伴探索"模式
 
-
-【RPG框架】
-- 标题：{title}
-- 世界观：{worldview}
-- 主线剧情：{main_plot}
-- 游戏风格：{game_style}
-- 玩家角色：{player_character}
-- NPC角色：{npc_character}
-
-【关卡数据】
-- 关卡名称：{stage_name}
-- 场景名称：{scene_name}
-- 关卡编号：{stage_id}
-- 教学目标：{teaching_goal}
-- 故事情境：{story_context}
-- 知识讲解：{knowledge_explanation}
-- 下一关选项：{next_options}
-  请在"场景转换"中使用格式：目标节点ID: 选项描述
-- 是否结束节点：{is_final}
-
-【角色关系发展】
-- 主角姓名：{player_character}
-- NPC姓名：{npc_character}
-- 当前信任度：[基于前几关的交互历史]
-- 默契程度：[共同经历后的配合度]
-- 情感深度：[友谊或师徒关系的深化]
-
-【玩家互动需求】
-- 用户期望的互动方式：{interaction_requirements}
-- 必须在设计中体现用户的互动偏好
-- 互动形式要与剧情自然融合，不能生硬植入
-
 【剧情衔接要求】
 - 如果不是第一关，开场要简单回顾上一关的结果和角色状态
 - 不要每关都是紧急危机，可以有探索、准备、过渡类的轻松时刻
@@ -1062,7 +1019,7 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
    - 分镜标题：格式为"关卡X-场景名称"（X为关卡编号中的数字，如node_1对应关卡1）
    - 场景类型：如"困境发现场景"、"探索解谜场景"、"突破场景"等
    - 时长估计：预估该分镜的游戏时长（分钟）  
-   - 关键事件：描述角色面临的真实困境和{subject}知识如何成为解决方案
+   - 关键事件：描述角色面临的真实困境和学科知识如何成为解决方案
 
 2) **人物档案**：
    - **重要**：角色基本信息必须从RPG框架中严格继承，保持全程一致性
@@ -1074,10 +1031,10 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
 3) **剧情驱动对话设计**：
    - **困境呈现阶段**：角色遇到真实问题，感到困惑和挫败
    - **探索发现阶段**：角色开始探索，发现问题可能有规律可循
-   - **知识融合阶段**：{subject}知识自然浮现为解决方案，不是被"教授"的
+   - **知识融合阶段**：学科知识自然浮现为解决方案，不是被"教授"的
    - **互动解谜环节**：根据用户的互动偏好设计具体的互动方式
      * 必须结合用户期望的互动形式（如选择分支、操作任务、推理解谜等）
-     * 伪装成世界规律：让{subject}看起来是这个世界的自然法则
+     * 伪装成世界规律：让学科知识看起来是这个世界的自然法则
      * 探索式发现：玩家通过尝试和观察发现规律
      * 成就感设计：解决问题后获得剧情奖励，不只是"答对了"
      * 失败引导：失败时提供探索线索，引导直到成功
@@ -1086,8 +1043,8 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
 
 4) **剧本**：
    - 旁白：冒险情境的沉浸式开场 - 营造紧张、神秘或兴奋的冒险氛围。描述角色面临的真实困境和环境威胁，让玩家感受到"必须行动"的紧迫感。避免教学痕迹，专注于故事张力。
-   - 情节描述：完整的冒险弧线 - 从"困境发现"到"探索尝试"到"突破成功"的情感起伏。重点刻画角色的真实动机和情感变化，{subject}知识作为"世界规律"自然出现。要让玩家感到自己是在冒险，不是在上课。
-   - 互动设计：伪装成冒险解谜的学习机制 - {subject}知识被包装为"古老智慧"、"神秘法则"或"重要线索"。设计探索式发现过程：玩家通过观察、实验、推理逐步掌握规律。失败时NPC提供情感支持和探索提示，成功时获得真实的剧情奖励和角色成长。
+   - 情节描述：完整的冒险弧线 - 从"困境发现"到"探索尝试"到"突破成功"的情感起伏。重点刻画角色的真实动机和情感变化，学科知识作为"世界规律"自然出现。要让玩家感到自己是在冒险，不是在上课。
+   - 互动设计：伪装成冒险解谜的学习机制 - 学科知识被包装为"古老智慧"、"神秘法则"或"重要线索"。设计探索式发现过程：玩家通过观察、实验、推理逐步掌握规律。失败时NPC提供情感支持和探索提示，成功时获得真实的剧情奖励和角色成长。
 
 5) **图片提示词**：
    - 视觉风格：必须符合用户选择的游戏风格（如Lego style、童话风格、蒸汽朋克等）
@@ -1100,7 +1057,7 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
 【特殊要求】
 
 1) **困境驱动设计原则**：
-   - {subject}知识必须是解决剧情困境的唯一有效途径，不是额外考试
+   - 学科知识必须是解决剧情困境的唯一有效途径，不是额外考试
    - 困境要有真实的威胁感和紧迫感，角色有强烈的解决动机
    - 知识点伪装成"世界法则"、"古老智慧"或"关键线索"自然出现
    - 选择错误时角色遭遇挫折但获得新线索，引导继续探索直到成功
@@ -1110,10 +1067,10 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
    - NPC是平等的冒险伙伴，不是权威老师，使用探讨式而非教授式语气
    - 失败时表达理解和鼓励："我们再仔细观察一下..."、"或许还有其他线索..."
    - 成功时展现真实的兴奋和感激："太好了！有了你的发现，我们终于..."
-   - 语言符合角色身份和{grade}年级理解水平，但要有冒险感和情感深度
+   - 语言符合角色身份和目标年级理解水平，但要有冒险感和情感深度
 
 3) **剧情连贯性**：
-   - 每个场景都推进主线剧情，{subject}知识融入故事发展
+   - 每个场景都推进主线剧情，学科知识融入故事发展
    - 角色间的关系和信任随着冒险深入而加深
    - 失败和成功都对后续剧情产生影响，增强选择的意义感
    - 保持世界观一致性，避免破坏第四堵墙
@@ -1122,22 +1079,22 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
 
 {{
   "分镜基础信息": {{
-    "分镜编号": "scene_{stage_id}",
-    "分镜标题": "关卡{stage_number}-{scene_name}",
+    "分镜编号": "scene_[关卡编号]",
+    "分镜标题": "关卡[关卡序号]-[场景名称]",
     "场景类型": "困境发现场景",
     "时长估计": "8分钟",
     "关键事件": "具体的事件描述"
   }},
   "人物档案": {{
     "主角": {{
-      "角色名": "{player_character}",
+      "角色名": "[玩家角色名]",
       "外貌": "从RPG框架中复制外貌特征，保持一致",
       "性格": "从RPG框架中复制核心性格，保持一致",
       "当前状态": "本关卡中角色的具体情况和情感状态",
       "能力成长": "相比前几关获得的新能力或认知"
     }},
     "NPC": {{
-      "角色名": "{npc_character}",
+      "角色名": "[NPC角色名]",
       "外貌": "从RPG框架中复制外貌特征，保持一致",
       "性格": "从RPG框架中复制核心性格，保持一致",
       "当前状态": "本关卡中NPC的具体情况和情感状态",
@@ -1166,11 +1123,11 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
       "探索引导": "NPC引导玩家观察环境中的线索，发现可能的解决思路",
       "考核设计": {{
         "考核类型": "根据用户互动需求和知识点特性选择：选择题/填空题/拖拽排序/数字输入/操作模拟等",
-        "题目描述": "将{subject}知识点包装成具体的谜题或机关操作",
+        "题目描述": "将学科知识点包装成具体的谜题或机关操作",
         "具体题目": "明确的问题表述，结合剧情情境",
         "选项设置": "如果是选择题，提供3-4个选项；如果是填空题，说明填空位置；如果是拖拽题，说明拖拽元素",
         "正确答案": "标准答案或正确操作步骤",
-        "答案解析": "为什么这个答案正确，与{subject}知识的关联"
+        "答案解析": "为什么这个答案正确，与学科知识的关联"
       }},
       "反馈机制": {{
         "完全正确": {{
@@ -1230,15 +1187,56 @@ STORYBOARD_PROMPT = """你是一名"剧情驱动教育游戏分镜设计师"。
 - 字符串内的特殊字符必须正确转义
 - 不要在JSON之外添加任何说明文字
 
-**重要**：只返回JSON内容，不要添加markdown代码块标记或任何其他文字！
+**重要**：只返回JSON内容，不要添加markdown代码块标记或任何其他文字！"""
+
+STORYBOARD_SHARED_CONTEXT = """【RPG框架】
+- 学科：{subject}
+- 年级：{grade}
+- 标题：{title}
+- 世界观：{worldview}
+- 主线剧情：{main_plot}
+- 游戏风格：{game_style}
+- 玩家角色：{player_character}
+- NPC角色：{npc_character}
+
+【角色关系发展】
+- 主角姓名：{player_character}
+- NPC姓名：{npc_character}
+- 当前信任度：[基于前几关的交互历史]
+- 默契程度：[共同经历后的配合度]
+- 情感深度：[友谊或师徒关系的深化]
+
+【玩家互动需求】
+- 用户期望的互动方式：{interaction_requirements}
+- 必须在设计中体现用户的互动偏好
+- 互动形式要与剧情自然融合，不能生硬植入"""
+
+STORYBOARD_LEVEL_VARIABLES = """【关卡数据】
+- 关卡名称：{stage_name}
+- 场景名称：{scene_name}
+- 关卡编号：{stage_id}
+- 教学目标：{teaching_goal}
+- 故事情境：{story_context}
+- 知识讲解：{knowledge_explanation}
+- 下一关选项：{next_options}
+  请在"场景转换"中使用格式：目标节点ID: 选项描述
+- 是否结束节点：{is_final}
+
+【本关输出字段】
+- "分镜编号"填写"scene_{stage_id}"
+- "分镜标题"填写"关卡{stage_number}-{scene_name}"
+- "人物档案"中主角"角色名"填写"{player_character}"，NPC"角色名"填写"{npc_character}"
 
 请严格按照上述要求生成分镜脚本。"""
 
+STORYBOARD_PROMPT = assemble_prompt(STORYBOARD_INSTRUCTIONS, STORYBOARD_SHARED_CONTEXT, STORYBOARD_LEVEL_VARIABLES)
+
 
 # 便利函数
-def create_scene_generator(model_name: str = "gpt-4o-mini") -> SceneGenerator:
+def create_scene_generator(model_name: str = "gpt-4o-mini", lazy_images: bool = LAZY_IMAGE_GENERATION,
+                           coalesce_llm_calls: bool = LLM_SINGLE_FLIGHT) -> SceneGenerator:
     """创建场景生成器实例"""
-    return SceneGenerator(model_name)
+    return SceneGenerator(model_name, lazy_images, coalesce_llm_calls)
 
 
 # 测试函数
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+进程内single-flight：相同请求并发时只执行一次，其余调用等待同一个结果
+- do(): 同步函数（线程池、同步接口中调用），等待者阻塞在Event上
+- do_async(): 协程（只在事件循环线程中调用），执行放在独立task中，
+  某个等待者被取消时不影响其他等待者；最后一个等待者也取消时取消执行（停止为没人要的结果付费）
+结果和异常都会交给所有等待者；调用结束后立即移除，不缓存结果
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+# 并发的相同LLM请求（相同模型、参数和提示词）只调用一次
+LLM_SINGLE_FLIGHT = os.getenv("LLM_SINGLE_FLIGHT", "false").lower() in ("1", "true", "yes")
+
+
+def request_key(*parts: Any) -> str:
+    """由请求的各组成部分计算single-flight键"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    """同步调用的执行状态"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _AsyncCall:
+    """异步调用的执行task和当前等待者数"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.abandoned = False
+
+
+class SingleFlight:
+    """按键合并并发的相同调用，统计执行次数和被合并的调用数"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        # 异步调用只在事件循环线程中访问
+        self._tasks: Dict[str, _AsyncCall] = {}
+        self._stats = {
+            "calls": 0,
+            "executions": 0,
+            "coalesced": 0,
+            "failures": 0,
+            "cancelled": 0
+        }
+
+    def in_flight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._calls or key in self._tasks
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        """同一键已有调用在执行时等待它的结果（异常同样抛给等待者）"""
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+                self._stats["executions"] += 1
+            else:
+                self._stats["coalesced"] += 1
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self._stats["failures"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    async def do_async(self, key: str, func: Callable[[], Awaitable[Any]],
+                       cancel_when_abandoned: bool = True) -> Any:
+        """协程版本：同一键已有task在执行时等待它
+        cancel_when_abandoned=False 时所有等待者都取消后仍然执行完（如需要写回结果的图片生成）"""
+        call = self._tasks.get(key)
+        if call is not None and call.abandoned:
+            # 已请求取消但还没结束的task不再复用
+            call = None
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["coalesced" if call is not None else "executions"] += 1
+        if call is None:
+            call = _AsyncCall(asyncio.ensure_future(func()))
+            self._tasks[key] = call
+            call.task.add_done_callback(lambda done: self._finish_task(key, done))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and cancel_when_abandoned and not call.task.done():
+                call.abandoned = True
+                call.task.cancel()
+
+    def _finish_task(self, key: str, task: asyncio.Task) -> None:
+        call = self._tasks.get(key)
+        if call is not None and call.task is task:
+            del self._tasks[key]
+        # 读取异常，所有等待者都已取消时也不会出现未读取异常的告警
+        if task.cancelled():
+            with self._lock:
+                self._stats["cancelled"] += 1
+        elif task.exception() is not None:
+            with self._lock:
+                self._stats["failures"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "inflight": len(self._calls) + len(self._tasks),
+                "coalesced_ratio": round(self._stats["coalesced"] / self._stats["calls"], 4)
+                if self._stats["calls"] else 0.0
+            }
+
+
+_groups: Dict[str, SingleFlight] = {}
+_groups_lock = threading.Lock()
+
+
+def get_single_flight(name: str) -> SingleFlight:
+    """按名称获取（或创建）single-flight分组，/metrics 按分组输出统计"""
+    with _groups_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = SingleFlight(name)
+            _groups[name] = group
+        return group
+
+
+def single_flight_snapshot() -> Dict[str, Dict[str, Any]]:
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {group.name: group.snapshot() for group in groups}
+
+
+# 全局分组
+story_read_flight = get_single_flight("story_read")
+llm_call_flight = get_single_flight("llm_call")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+关卡推测生成的统计
+推测模式下故事框架审核和6个关卡生成同时进行：审核通过时关卡结果直接使用（命中），
+审核不通过时取消未完成的关卡调用、丢弃已完成的结果（未命中），浪费的tokens计入统计：
+- wasted_input_tokens / wasted_output_tokens：已完成调用返回的用量，加上被取消调用的prompt tokens（只计输入）
+- cancelled_input_tokens：其中被取消调用的部分，按prompt用TokenCounter计数（估算值）；被取消调用的输出tokens无法统计
+"""
+
+import threading
+from typing import Any, Dict
+
+
+class SpeculationMetrics:
+    """推测命中率和浪费的tokens（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "speculations": 0,
+            "hits": 0,
+            "misses": 0,
+            "used_input_tokens": 0,
+            "used_output_tokens": 0,
+            "wasted_input_tokens": 0,
+            "wasted_output_tokens": 0,
+            "wasted_calls": 0,      # 已完成但被丢弃的关卡调用
+            "cancelled_calls": 0,   # 审核结束时仍在进行、被取消的关卡调用
+            "cancelled_input_tokens": 0  # 被取消调用的prompt tokens（已计入wasted_input_tokens）
+        }
+
+    def record_hit(self, input_tokens: int, output_tokens: int) -> None:
+        with self._lock:
+            self._stats["speculations"] += 1
+            self._stats["hits"] += 1
+            self._stats["used_input_tokens"] += input_tokens
+            self._stats["used_output_tokens"] += output_tokens
+
+    def record_miss(self, input_tokens: int, output_tokens: int, wasted_calls: int, cancelled_calls: int,
+                    cancelled_input_tokens: int = 0) -> None:
+        with self._lock:
+            self._stats["speculations"] += 1
+            self._stats["misses"] += 1
+            self._stats["wasted_input_tokens"] += input_tokens + cancelled_input_tokens
+            self._stats["cancelled_input_tokens"] += cancelled_input_tokens
+            self._stats["wasted_output_tokens"] += output_tokens
+            self._stats["wasted_calls"] += wasted_calls
+            self._stats["cancelled_calls"] += cancelled_calls
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            speculations = self._stats["speculations"]
+            return {
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / speculations, 4) if speculations else 0.0
+            }
+
+
+# 全局统计实例
+level_speculation_metrics = SpeculationMetrics()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+故事数据的进程内读穿缓存
+- 按字节数限制大小的LRU（故事大小差别很大，按条数限制不可靠）
+- 多个uvicorn worker之间通过 Postgres LISTEN/NOTIFY 失效：
+  save_story/save_storyboard 在写入事务中 pg_notify，各worker的监听线程收到后删除对应缓存
+- 监听连接未建立（或断开）时缓存不启用，避免读到其他worker已经更新过的旧数据
+- 同一个监听连接也转发其他通道的通知（如生成任务进度，见 generation_jobs.py），每个worker只有一个LISTEN连接
+"""
+
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import fast_json
+
+
+# NOTIFY通道名，payload为story_id
+INVALIDATION_CHANNEL = "story_cache_invalidate"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class StoryCache:
+    """按字节数限制的LRU缓存，缓存的data是只读共享对象，调用方不要修改"""
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.enabled = False  # 由监听线程在LISTEN成功后打开
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._latest_story_id: Optional[str] = None
+        self._current_bytes = 0
+        # 每次失效加1；读库前取一次，写缓存时不一致说明读库期间有写入，放弃写缓存
+        self._generation = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "oversized": 0}
+
+    def get(self, story_id: str) -> Optional[Dict[str, Any]]:
+        """读取缓存条目 {'data', 'updated_at'}，未命中返回None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(story_id)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(story_id)
+            self._stats["hits"] += 1
+            return entry
+
+    def generation(self) -> int:
+        """读库之前调用，结果传给put"""
+        with self._lock:
+            return self._generation
+
+    def put(self, story_id: str, data: Any, updated_at: Optional[datetime], generation: int) -> None:
+        """写入缓存，超出字节上限时从最久未使用的条目开始淘汰"""
+        if not self.enabled:
+            return
+        size = len(fast_json.dumps_bytes(data))
+        with self._lock:
+            if generation != self._generation:
+                return
+            if size > self.max_bytes:
+                self._stats["oversized"] += 1
+                return
+            self._remove(story_id)
+            self._entries[story_id] = {"data": data, "updated_at": updated_at, "size": size}
+            self._current_bytes += size
+            while self._current_bytes > self.max_bytes and self._entries:
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+                self._stats["evictions"] += 1
+
+    def get_latest_story_id(self) -> Optional[str]:
+        """最新故事的ID（任何故事写入都会清除）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            return self._latest_story_id
+
+    def set_latest_story_id(self, story_id: str, generation: int) -> None:
+        if self.enabled:
+            with self._lock:
+                if generation == self._generation:
+                    self._latest_story_id = story_id
+
+    def invalidate(self, story_id: Optional[str]) -> None:
+        """删除单个故事的缓存；任何写入都可能改变“最新故事”，所以同时清除latest指针"""
+        with self._lock:
+            if story_id:
+                self._remove(story_id)
+            self._latest_story_id = None
+            self._generation += 1
+            self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+            self._latest_story_id = None
+            self._generation += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": round(self._stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+
+    def _remove(self, story_id: str) -> None:
+        entry = self._entries.pop(story_id, None)
+        if entry is not None:
+            self._current_bytes -= entry["size"]
+
+
+class StoryCacheListener:
+    """后台线程：LISTEN失效通道，收到通知后删除对应缓存；连接断开时停用并清空缓存，重连后再启用
+    subscribe() 的通道在同一个连接上监听，回调在监听线程中执行"""
+
+    def __init__(self, cache: StoryCache, poll_timeout: float = 5.0, retry_delay: float = 5.0):
+        self.cache = cache
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.connected = False
+        self._cache_enabled = True
+        self._subscribers: Dict[str, List[Callable[[Optional[str]], None]]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def subscribe(self, channel: str, callback: Callable[[Optional[str]], None]) -> None:
+        """订阅其他通道的通知，callback(payload)；需要在start()之前订阅"""
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def start(self, connection_string: str, cache_enabled: bool = True) -> None:
+        """cache_enabled=False 时只转发订阅通道的通知，不启用故事缓存"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._cache_enabled = cache_enabled
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(connection_string,),
+                                        name="story-cache-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.cache.enabled = False
+        self.cache.clear()
+
+    def _run(self, connection_string: str) -> None:
+        import psycopg2
+        import psycopg2.extensions
+
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(connection_string)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {INVALIDATION_CHANNEL};")
+                    for channel in self._subscribers:
+                        cursor.execute(f"LISTEN {channel};")
+                self.connected = True
+
+                # 开始监听之前的缓存可能已过期
+                self.cache.clear()
+                if self._cache_enabled:
+                    self.cache.enabled = True
+                    print(f"故事缓存已启用，监听通道: {INVALIDATION_CHANNEL}")
+
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        if notify.channel == INVALIDATION_CHANNEL:
+                            self.cache.invalidate(notify.payload or None)
+                            continue
+                        for callback in self._subscribers.get(notify.channel, ()):
+                            try:
+                                callback(notify.payload or None)
+                            except Exception as e:
+                                print(f"⚠️ 处理通知失败 {notify.channel}: {e}")
+            except Exception as e:
+                print(f"故事缓存监听连接异常，暂停缓存: {e}")
+            finally:
+                # 断开期间可能错过通知，停用并清空缓存
+                self.connected = False
+                self.cache.enabled = False
+                self.cache.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+            if not self._stop.is_set():
+                time.sleep(self.retry_delay)
+
+
+# 全局缓存实例
+story_cache = StoryCache(int(os.getenv("STORY_CACHE_MAX_BYTES", str(DEFAULT_MAX_BYTES))))
+story_cache_listener = StoryCacheListener(story_cache)
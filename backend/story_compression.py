@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+故事数据的zstd压缩存储（可选）
+故事JSON体积大、重复的中文键名很多（分镜基础信息、人物对话、图片生成提示词…），Postgres TOAST的pglz压缩效果差：
+- STORY_COMPRESSION=zstd 时，完整故事用在故事语料上训练的zstd字典压缩后存入 edu_data.data_zstd（bytea）
+- data 列（JSONB）只保存一个小的投影（标题、学科、年级、关卡数等），列表页和索引直接使用，不需要解压
+- 读取完整故事时才解压；字典本身也存在 edu_data 中（data_type='zstd_dictionary'），按dict_id加载
+未安装 zstandard 时不压缩，已压缩的记录也无法读取（会返回错误）
+"""
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# off | zstd
+STORY_COMPRESSION = os.getenv("STORY_COMPRESSION", "off")
+STORY_ZSTD_LEVEL = int(os.getenv("STORY_ZSTD_LEVEL", "9"))
+# 小于该大小的故事直接存JSON
+STORY_COMPRESSION_MIN_BYTES = int(os.getenv("STORY_COMPRESSION_MIN_BYTES", "4096"))
+STORY_DICTIONARY_SIZE = 112 * 1024
+
+DICTIONARY_DATA_TYPE = "zstd_dictionary"
+COMPRESSED_MARKER = "zstd"
+
+
+def dictionary_row_id(dict_id: int) -> str:
+    return f"zstd_dictionary_{dict_id}"
+
+
+def story_projection(story_data: Dict[str, Any], dict_id: int) -> Dict[str, Any]:
+    """data列中保存的投影：列表页和按字段查询需要的少量字段"""
+    storyboards_data = story_data.get("storyboards_data") or {}
+    return {
+        "compressed": COMPRESSED_MARKER,
+        "zstd_dict_id": dict_id,
+        "format_version": story_data.get("format_version"),
+        "requirement_id": story_data.get("requirement_id"),
+        "level_generation_status": story_data.get("level_generation_status"),
+        "storyboards_data": {
+            "story_id": storyboards_data.get("story_id"),
+            "story_title": storyboards_data.get("story_title"),
+            "subject": storyboards_data.get("subject"),
+            "grade": storyboards_data.get("grade")
+        },
+        "storyboard_count": len(storyboards_data.get("storyboards") or story_data.get("stages_data") or [])
+    }
+
+
+def is_compressed_projection(data: Any) -> bool:
+    return isinstance(data, dict) and data.get("compressed") == COMPRESSED_MARKER
+
+
+class StoryCompressor:
+    """zstd字典压缩/解压，已加载的字典按dict_id缓存（线程安全）"""
+
+    def __init__(self, mode: str = STORY_COMPRESSION, level: int = STORY_ZSTD_LEVEL,
+                 min_bytes: int = STORY_COMPRESSION_MIN_BYTES):
+        self.mode = mode
+        self.level = level
+        self.min_bytes = min_bytes
+        self._lock = threading.Lock()
+        self._dictionaries: Dict[int, Any] = {}
+        self._active_dict_id: Optional[int] = None
+        self._stats = {
+            "compressed": 0,
+            "skipped_small": 0,
+            "input_bytes": 0,
+            "output_bytes": 0,
+            "decompressed": 0,
+            "decompress_seconds": 0.0
+        }
+        if mode == "zstd" and zstandard is None:
+            print("⚠️ STORY_COMPRESSION=zstd 但未安装zstandard，故事数据不压缩")
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode == "zstd" and zstandard is not None
+
+    @property
+    def active_dict_id(self) -> Optional[int]:
+        with self._lock:
+            return self._active_dict_id
+
+    def has_dictionary(self, dict_id: int) -> bool:
+        with self._lock:
+            return dict_id in self._dictionaries
+
+    def load_dictionary(self, dict_id: int, dict_bytes: bytes, active: bool = False) -> None:
+        dictionary = zstandard.ZstdCompressionDict(bytes(dict_bytes))
+        with self._lock:
+            self._dictionaries[dict_id] = dictionary
+            if active:
+                self._active_dict_id = dict_id
+
+    @staticmethod
+    def train_dictionary(samples: List[bytes], dict_size: int = STORY_DICTIONARY_SIZE) -> Any:
+        """在故事语料上训练字典，返回 ZstdCompressionDict（dict_id() 为字典ID）"""
+        return zstandard.train_dictionary(dict_size, samples)
+
+    def should_compress(self, payload: bytes) -> bool:
+        if len(payload) >= self.min_bytes:
+            return True
+        with self._lock:
+            self._stats["skipped_small"] += 1
+        return False
+
+    def compress(self, payload: bytes, dict_id: Optional[int]) -> bytes:
+        """dict_id为None时不使用字典"""
+        with self._lock:
+            dictionary = self._dictionaries.get(dict_id) if dict_id is not None else None
+        compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary) if dictionary is not None \
+            else zstandard.ZstdCompressor(level=self.level)
+        blob = compressor.compress(payload)
+        with self._lock:
+            self._stats["compressed"] += 1
+            self._stats["input_bytes"] += len(payload)
+            self._stats["output_bytes"] += len(blob)
+        return blob
+
+    def decompress(self, blob: bytes, dict_id: Optional[int]) -> bytes:
+        if zstandard is None:
+            raise RuntimeError("故事数据已用zstd压缩，需要安装zstandard")
+        with self._lock:
+            dictionary = self._dictionaries.get(dict_id) if dict_id is not None else None
+        if dict_id is not None and dictionary is None:
+            raise RuntimeError(f"zstd字典未加载: {dict_id}")
+
+        started = time.perf_counter()
+        decompressor = zstandard.ZstdDecompressor(dict_data=dictionary) if dictionary is not None \
+            else zstandard.ZstdDecompressor()
+        payload = decompressor.decompress(bytes(blob))
+        with self._lock:
+            self._stats["decompressed"] += 1
+            self._stats["decompress_seconds"] += time.perf_counter() - started
+        return payload
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "enabled": self.enabled,
+                "active_dict_id": self._active_dict_id,
+                "ratio": round(self._stats["input_bytes"] / self._stats["output_bytes"], 2)
+                if self._stats["output_bytes"] else 0.0
+            }
+
+
+# 全局实例
+story_compressor = StoryCompressor()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+故事数据的紧凑存储格式（format_version=2）
+AgentService保存的故事中同一份内容会存两到三次：
+- storyboards_data 里重复了顶层的 story_framework / analysis_report / education_assessment_report
+- level_details 里同时有LLM原始输出 scenes_script、解析结果 parsed_scene_data 和 characters_dialogue（人物对话的副本），
+  而 parsed_scene_data 的主要字段又已经在 storyboards 的 storyboard 中
+紧凑格式每份内容只存一次，读取时用 expand_story_data 还原成接口使用的完整结构；
+没有 format_version 的旧数据原样返回，可以用 migrate_story_storage.py 迁移
+
+关卡分行存储：每个关卡的 storyboard 存在单独的 storyboard_{story_id}_{stage_id} 记录中，
+故事记录里只保留关卡列表（标题、状态、场景转换），读取完整故事时再合并
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import fast_json
+
+
+STORY_FORMAT_VERSION = 2
+FORMAT_VERSION_KEY = "format_version"
+
+# storyboards_data 中与顶层重复的字段
+SHARED_REPORT_FIELDS = ("analysis_report", "story_framework", "education_assessment_report")
+# storyboard字段 -> parsed_scene_data字段
+STORYBOARD_SCENE_FIELDS = {
+    "分镜基础信息": "分镜基础信息",
+    "人物档案": "人物档案",
+    "人物对话": "人物对话",
+    "图片提示词": "图片生成提示词",
+    "剧本": "剧本"
+}
+
+
+def is_compact(story_data: Any) -> bool:
+    return isinstance(story_data, dict) and story_data.get(FORMAT_VERSION_KEY) == STORY_FORMAT_VERSION
+
+
+def _render_scene_output(scene_data: Any) -> str:
+    """由解析结果生成代码块文本，只有与原文中的代码块逐字节相同时才用它代替原文"""
+    return "```json\n" + fast_json.dumps(scene_data) + "\n```"
+
+
+def _scene_data_from_storyboard(storyboard: Dict[str, Any], extra_fields: Dict[str, Any]) -> Dict[str, Any]:
+    scene_data = {scene_field: storyboard[field] for field, scene_field in STORYBOARD_SCENE_FIELDS.items()
+                  if field in storyboard}
+    scene_data.update(extra_fields)
+    return scene_data
+
+
+def _compact_level(level_data: Dict[str, Any], storyboard: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """去掉可以由storyboard还原的内容；只有还原结果与原数据完全一致时才去掉"""
+    compact = dict(level_data)
+    scene_data = level_data.get("parsed_scene_data")
+    if not isinstance(scene_data, dict):
+        return compact
+
+    if storyboard is not None:
+        extra_fields = {key: value for key, value in scene_data.items()
+                        if key not in STORYBOARD_SCENE_FIELDS.values()}
+        if _scene_data_from_storyboard(storyboard, extra_fields) == scene_data:
+            compact.pop("parsed_scene_data")
+            compact["scene_data_in_storyboard"] = True
+            if extra_fields:
+                compact["extra_scene_fields"] = extra_fields
+
+    if "characters_dialogue" in compact and compact["characters_dialogue"] == scene_data.get("人物对话"):
+        compact.pop("characters_dialogue")
+        compact["characters_dialogue_from_scene"] = True
+
+    # 原文必须能逐字节还原：代码块与重新生成的文本完全一致，代码块前后的说明文字单独保存
+    scenes_script = compact.get("scenes_script")
+    rendered = _render_scene_output(scene_data)
+    if isinstance(scenes_script, str) and rendered in scenes_script:
+        prefix, suffix = scenes_script.split(rendered, 1)
+        compact.pop("scenes_script")
+        compact["scenes_script_from_scene"] = True
+        if prefix or suffix:
+            compact["scenes_script_affixes"] = [prefix, suffix]
+    return compact
+
+
+def _expand_level(compact: Dict[str, Any], storyboard: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    level_data = dict(compact)
+    if level_data.pop("scene_data_in_storyboard", False):
+        level_data["parsed_scene_data"] = _scene_data_from_storyboard(storyboard or {},
+                                                                      level_data.pop("extra_scene_fields", {}))
+    scene_data = level_data.get("parsed_scene_data") or {}
+    if level_data.pop("characters_dialogue_from_scene", False):
+        level_data["characters_dialogue"] = scene_data.get("人物对话")
+    if level_data.pop("scenes_script_from_scene", False):
+        prefix, suffix = level_data.pop("scenes_script_affixes", ["", ""])
+        level_data["scenes_script"] = prefix + _render_scene_output(scene_data) + suffix
+    return level_data
+
+
+def _storyboards_by_stage(storyboards_data: Any) -> Dict[str, Dict[str, Any]]:
+    if not isinstance(storyboards_data, dict):
+        return {}
+    return {item.get("stage_id"): item.get("storyboard") or {}
+            for item in storyboards_data.get("storyboards") or [] if isinstance(item, dict)}
+
+
+def compact_story_data(story_data: Dict[str, Any]) -> Dict[str, Any]:
+    """转换为紧凑格式（不修改传入的对象），已是紧凑格式时原样返回"""
+    if not isinstance(story_data, dict) or is_compact(story_data):
+        return story_data
+
+    compact = dict(story_data)
+    storyboards_data = story_data.get("storyboards_data")
+    if isinstance(storyboards_data, dict):
+        shared = [field for field in SHARED_REPORT_FIELDS
+                  if field in storyboards_data and field in story_data and storyboards_data[field] == story_data[field]]
+        if shared:
+            compact["storyboards_data"] = {key: value for key, value in storyboards_data.items() if key not in shared}
+            compact["storyboards_data_shared_fields"] = shared
+
+    level_details = story_data.get("level_details")
+    if isinstance(level_details, dict):
+        storyboards = _storyboards_by_stage(storyboards_data)
+        compact["level_details"] = {
+            level_key: _compact_level(level_data, storyboards.get(level_key)) if isinstance(level_data, dict) else level_data
+            for level_key, level_data in level_details.items()
+        }
+
+    compact[FORMAT_VERSION_KEY] = STORY_FORMAT_VERSION
+    return compact
+
+
+def expand_story_data(story_data: Any) -> Any:
+    """还原为接口使用的完整结构；旧格式数据原样返回"""
+    if not is_compact(story_data):
+        return story_data
+
+    expanded = dict(story_data)
+    expanded.pop(FORMAT_VERSION_KEY)
+    shared = expanded.pop("storyboards_data_shared_fields", [])
+    storyboards_data = expanded.get("storyboards_data")
+    if shared and isinstance(storyboards_data, dict):
+        expanded["storyboards_data"] = {**storyboards_data, **{field: expanded.get(field) for field in shared}}
+
+    level_details = expanded.get("level_details")
+    if isinstance(level_details, dict):
+        storyboards = _storyboards_by_stage(storyboards_data)
+        expanded["level_details"] = {
+            level_key: _expand_level(level_data, storyboards.get(level_key)) if isinstance(level_data, dict) else level_data
+            for level_key, level_data in level_details.items()
+        }
+    return expanded
+
+
+def storyboard_row_id(story_id: str, stage_id: str) -> str:
+    """关卡记录ID（与 lazy_images.storyboard_key 一致）"""
+    return f"storyboard_{story_id}_{stage_id}"
+
+
+def storyboard_item_row_id(story_id: str, storyboard_item: Dict[str, Any]) -> str:
+    """接口格式关卡条目对应的关卡记录ID（没有stage_id时按stage_index生成）"""
+    stage_id = storyboard_item.get('stage_id', f"stage_{storyboard_item.get('stage_index', 0)}")
+    return storyboard_row_id(story_id, stage_id)
+
+
+def _scene_transitions(storyboard: Dict[str, Any]) -> Dict[str, Any]:
+    dialogue = (storyboard or {}).get("人物对话")
+    transitions = dialogue.get("场景转换") if isinstance(dialogue, dict) else None
+    return transitions if isinstance(transitions, dict) else {}
+
+
+def build_storyboard_row(story_id: str, storyboard_item: Dict[str, Any], timestamp: str) -> Tuple[str, Dict[str, Any]]:
+    """由接口格式的关卡条目构建关卡记录 (storyboard_id, data)"""
+    stage_id = storyboard_item.get('stage_id', f"stage_{storyboard_item.get('stage_index', 0)}")
+    storyboard_id = storyboard_item_row_id(story_id, storyboard_item)
+    storyboard = storyboard_item.get('storyboard', {})
+    stage_connections = _scene_transitions(storyboard)
+
+    return storyboard_id, {
+        "storyboard_id": storyboard_id,
+        "story_id": story_id,
+        "stage_id": stage_id,
+        "stage_index": storyboard_item.get('stage_index'),
+        "stage_name": storyboard_item.get('stage_name'),
+        "teaching_goal": storyboard_item.get('teachingGoal'),
+        "timestamp": timestamp,
+        
+        # 剧本信息
+        "script": storyboard.get('剧本', {}),
+        
+        # 角色信息
+        "characters": storyboard.get('人物档案', {}),
+        
+        # 对话内容
+        "dialogue_content": storyboard_item.get('generated_dialogue'),
+        
+        # 图像信息
+        "image_data": {
+            "prompt": storyboard.get('图片提示词'),
+            "generated_image": storyboard_item.get('generated_image_data'),
+            "image_format": "base64" if storyboard_item.get('generated_image_data') else None
+        },
+        
+        # 下一关选项（节点名称）
+        "next_stage_options": list(stage_connections.keys()),
+        "stage_connections": stage_connections,
+        
+        # 生成状态
+        "generation_status": storyboard_item.get('generation_status', {}),
+        
+        # 完整的原始故事板数据
+        "full_storyboard": storyboard
+    }
+
+
+def storyboard_item_from_row(row_data: Dict[str, Any]) -> Dict[str, Any]:
+    """关卡记录转换为接口格式的关卡条目（不包含图片数据，图片通过图片接口获取）"""
+    item = {
+        "stage_index": row_data.get("stage_index"),
+        "stage_name": row_data.get("stage_name"),
+        "stage_id": row_data.get("stage_id"),
+        "storyboard": row_data.get("full_storyboard") or {},
+        "generation_status": row_data.get("generation_status") or {}
+    }
+    if row_data.get("teaching_goal") is not None:
+        item["teachingGoal"] = row_data["teaching_goal"]
+    return item
+
+
+def detach_storyboards(story_data: Dict[str, Any], story_id: str) -> Dict[str, Any]:
+    """故事记录中去掉各关卡的storyboard（已单独存储），保留关卡列表"""
+    storyboards_data = story_data.get("storyboards_data")
+    if not isinstance(storyboards_data, dict) or not storyboards_data.get("storyboards"):
+        return story_data
+
+    headers = []
+    for item in storyboards_data["storyboards"]:
+        header = {key: value for key, value in item.items() if key != "storyboard"}
+        header["storyboard_id"] = storyboard_item_row_id(story_id, item)
+        header["scene_transitions"] = _scene_transitions(item.get("storyboard"))
+        headers.append(header)
+    return {**story_data, "storyboards_data": {**storyboards_data, "storyboards": headers, "storyboards_detached": True}}
+
+
+def detached_storyboard_ids(story_data: Dict[str, Any]) -> List[str]:
+    storyboards_data = story_data.get("storyboards_data")
+    if not isinstance(storyboards_data, dict) or not storyboards_data.get("storyboards_detached"):
+        return []
+    return [item["storyboard_id"] for item in storyboards_data.get("storyboards") or []]
+
+
+def attach_storyboards(story_data: Dict[str, Any], rows: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """把关卡记录中的storyboard合并回故事记录（detach_storyboards的逆操作）"""
+    storyboards_data = story_data["storyboards_data"]
+    items = []
+    for header in storyboards_data.get("storyboards") or []:
+        item = {key: value for key, value in header.items() if key not in ("storyboard_id", "scene_transitions")}
+        item["storyboard"] = (rows.get(header["storyboard_id"]) or {}).get("full_storyboard") or {}
+        items.append(item)
+    attached = {key: value for key, value in storyboards_data.items() if key != "storyboards_detached"}
+    attached["storyboards"] = items
+    return {**story_data, "storyboards_data": attached}
+
+
+def story_header(story_data: Dict[str, Any]) -> Dict[str, Any]:
+    """故事头：报告、框架和关卡列表，不包含关卡内容和调试字段"""
+    header = {key: value for key, value in story_data.items() if key != "level_details"}
+    storyboards_data = header.get("storyboards_data")
+    if isinstance(storyboards_data, dict) and storyboards_data.get("storyboards"):
+        levels = []
+        for item in storyboards_data["storyboards"]:
+            level = {key: value for key, value in item.items() if key != "storyboard"}
+            if "storyboard" in item:
+                level["scene_transitions"] = _scene_transitions(item["storyboard"])
+            levels.append(level)
+        header["storyboards_data"] = {key: value for key, value in storyboards_data.items()
+                                      if key != "storyboards_detached"}
+        header["storyboards_data"]["storyboards"] = levels
+    return header
+
+
+def compaction_stats(story_data: Dict[str, Any]) -> Tuple[int, int]:
+    """(原格式字节数, 紧凑格式字节数)，用于迁移报告"""
+    return len(fast_json.dumps_bytes(expand_story_data(story_data))), len(fast_json.dumps_bytes(compact_story_data(story_data)))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+JSON序列化微基准：对比标准库json与orjson（backend/fast_json.py）
+使用仓库中的 storyboards_story_*.json 作为样本数据；
+安装了pydantic时额外对比 APIResponse 校验序列化与跳过校验的耗时
+"""
+
+import glob
+import json
+import os
+import sys
+import timeit
+
+# Add backend directory to path
+sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+
+import fast_json
+
+ROUNDS = 500
+
+
+def load_fixtures():
+    paths = sorted(glob.glob(os.path.join(os.path.dirname(__file__) or ".", "storyboards_story_*.json")))
+    fixtures = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            fixtures.append((os.path.basename(path), json.load(f)))
+    return fixtures
+
+
+def bench(label, func):
+    seconds = timeit.timeit(func, number=ROUNDS)
+    per_call_us = seconds / ROUNDS * 1_000_000
+    print(f"  {label:<40} {per_call_us:>10.1f} µs/次")
+    return per_call_us
+
+
+def bench_fixture(name, data):
+    size = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    print(f"\n{name} ({size / 1024:.1f} KB)")
+
+    # 数据库写入路径
+    stdlib_dumps = bench("json.dumps(ensure_ascii=False)", lambda: json.dumps(data, ensure_ascii=False))
+    fast_dumps = bench("fast_json.dumps", lambda: fast_json.dumps(data))
+
+    # 响应路径
+    stdlib_bytes = bench("json.dumps(...).encode()", lambda: json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    fast_bytes = bench("fast_json.dumps_bytes", lambda: fast_json.dumps_bytes(data))
+
+    # 读取路径
+    text = json.dumps(data, ensure_ascii=False)
+    stdlib_loads = bench("json.loads", lambda: json.loads(text))
+    fast_loads = bench("fast_json.loads", lambda: fast_json.loads(text))
+
+    print(f"  写入加速 {stdlib_dumps / fast_dumps:.1f}x, 响应加速 {stdlib_bytes / fast_bytes:.1f}x, "
+          f"读取加速 {stdlib_loads / fast_loads:.1f}x")
+
+    bench_api_response(data)
+
+
+def bench_api_response(data):
+    """对比 APIResponse 完整校验+序列化 与 跳过校验+fast_json"""
+    try:
+        from pydantic import BaseModel
+        from typing import Any, Dict, List, Union
+    except ImportError:
+        print("  (未安装pydantic，跳过APIResponse对比)")
+        return
+
+    # 与 backend/main.py 中的 APIResponse 相同
+    class APIResponse(BaseModel):
+        success: bool
+        data: Union[Dict[str, Any], List[Any]] = {}
+        message: str = ""
+        error: str = ""
+
+    def validated():
+        return APIResponse(success=True, data=data, message="ok").model_dump_json().encode("utf-8")
+
+    def opaque():
+        response = APIResponse.model_construct(success=True, data=data, message="ok")
+        return fast_json.dumps_bytes({field: getattr(response, field) for field in APIResponse.model_fields})
+
+    validated_us = bench("APIResponse校验 + model_dump_json", validated)
+    opaque_us = bench("model_construct + fast_json", opaque)
+    print(f"  响应构建加速 {validated_us / opaque_us:.1f}x")
+
+
+def main():
+    print("JSON序列化微基准")
+    print("=" * 60)
+    print(f"orjson: {'已安装' if fast_json.orjson is not None else '未安装（fast_json回退到标准库）'}")
+
+    fixtures = load_fixtures()
+    if not fixtures:
+        print("未找到 storyboards_story_*.json 样本")
+        return
+
+    for name, data in fixtures:
+        # 模拟数据库中的故事行：storyboards_data 嵌在故事数据中
+        bench_fixture(name, {"story_id": data.get("story_id"), "storyboards_data": data})
+
+
+if __name__ == "__main__":
+    main()
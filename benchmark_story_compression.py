@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+故事数据压缩基准：压缩率和解压速度
+使用仓库中的 storyboards_story_*.json 和 stage1_completion_result_*.json 构造数据库中的故事记录（紧凑格式），对比：
+- zlib level 1（近似TOAST的pglz：同为LZ类压缩，pglz没有熵编码，实际压缩率还会更低）
+- zstd 不使用字典
+- zstd + 字典（留一法：用其余样本训练字典，避免字典包含被测样本本身）
+未安装zstandard时只输出zlib结果
+"""
+
+import glob
+import os
+import sys
+import timeit
+import zlib
+
+# 添加backend目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+
+import fast_json
+from story_storage import compact_story_data
+from story_compression import STORY_ZSTD_LEVEL, zstandard
+
+ROUNDS = 200
+DICTIONARY_SIZE = 32 * 1024  # 样本很少，字典不宜过大
+
+
+def load_stories():
+    """把样本文件转换为数据库中故事记录的结构"""
+    root = os.path.dirname(__file__) or "."
+    stories = []
+    for path in sorted(glob.glob(os.path.join(root, "storyboards_story_*.json"))):
+        with open(path, "rb") as f:
+            data = fast_json.loads(f.read())
+        stories.append((os.path.basename(path), {"story_id": data.get("story_id"), "storyboards_data": data}))
+
+    for path in sorted(glob.glob(os.path.join(root, "stage1_completion_result_*.json"))):
+        with open(path, "rb") as f:
+            data = fast_json.loads(f.read())
+        extracted = data.get("extracted_data") or {}
+        stories.append((os.path.basename(path), {
+            "requirement_id": (data.get("test_info") or {}).get("requirement_id"),
+            "collected_info": data.get("collected_info"),
+            "story_framework": extracted.get("story_framework"),
+            "analysis_report": extracted.get("analysis_report"),
+            "education_assessment_report": extracted.get("education_assessment_report"),
+            "storyboards_data": (data.get("additional_info") or {}).get("storyboards_data") or {}
+        }))
+    return [(name, fast_json.dumps_bytes(compact_story_data(story))) for name, story in stories]
+
+
+def dictionary_samples(payloads):
+    """整个故事和每个关卡都作为训练样本（与 DatabaseClient.train_story_dictionary 一致）"""
+    samples = []
+    for payload in payloads:
+        samples.append(payload)
+        for storyboard in (fast_json.loads(payload).get("storyboards_data") or {}).get("storyboards") or []:
+            samples.append(fast_json.dumps_bytes(storyboard))
+    return samples
+
+
+def decode_speed(func, size):
+    seconds = timeit.timeit(func, number=ROUNDS) / ROUNDS
+    return size / seconds / (1024 * 1024)
+
+
+def main():
+    print("故事数据压缩基准")
+    print("=" * 72)
+    print(f"zstandard: {'已安装' if zstandard is not None else '未安装（只测试zlib）'}")
+
+    stories = load_stories()
+    if not stories:
+        print("未找到样本文件")
+        return
+
+    totals = {"raw": 0, "zlib": 0, "zstd": 0, "zstd_dict": 0}
+    print(f"\n{'样本':<44}{'原始KB':>8}{'zlib':>8}{'zstd':>8}{'zstd+字典':>10}")
+    for index, (name, payload) in enumerate(stories):
+        size = len(payload)
+        totals["raw"] += size
+        zlib_blob = zlib.compress(payload, 1)
+        totals["zlib"] += len(zlib_blob)
+        row = f"{name:<44}{size / 1024:>8.1f}{size / len(zlib_blob):>7.2f}x"
+
+        if zstandard is not None:
+            plain_blob = zstandard.ZstdCompressor(level=STORY_ZSTD_LEVEL).compress(payload)
+            totals["zstd"] += len(plain_blob)
+            row += f"{size / len(plain_blob):>7.2f}x"
+
+            others = [other for other_index, (_, other) in enumerate(stories) if other_index != index]
+            try:
+                dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, dictionary_samples(others))
+                dict_blob = zstandard.ZstdCompressor(level=STORY_ZSTD_LEVEL, dict_data=dictionary).compress(payload)
+                totals["zstd_dict"] += len(dict_blob)
+                row += f"{size / len(dict_blob):>9.2f}x"
+            except zstandard.ZstdError as e:
+                totals["zstd_dict"] += len(plain_blob)
+                row += f"{'训练失败':>9}"
+                print(f"  字典训练失败: {e}")
+        print(row)
+
+    print("\n合计压缩率:")
+    print(f"  zlib level 1    {totals['raw'] / totals['zlib']:.2f}x")
+    if zstandard is not None:
+        print(f"  zstd level {STORY_ZSTD_LEVEL:<4} {totals['raw'] / totals['zstd']:.2f}x")
+        print(f"  zstd + 字典     {totals['raw'] / totals['zstd_dict']:.2f}x")
+
+    # 解压速度（按解压后的字节数计算），字典在全部样本上训练
+    name, payload = max(stories, key=lambda story: len(story[1]))
+    print(f"\n解压速度（{name}，{len(payload) / 1024:.1f} KB）:")
+    zlib_blob = zlib.compress(payload, 1)
+    print(f"  zlib            {decode_speed(lambda: zlib.decompress(zlib_blob), len(payload)):>8.1f} MB/s")
+    if zstandard is not None:
+        plain_blob = zstandard.ZstdCompressor(level=STORY_ZSTD_LEVEL).compress(payload)
+        plain_decompressor = zstandard.ZstdDecompressor()
+        print(f"  zstd            {decode_speed(lambda: plain_decompressor.decompress(plain_blob), len(payload)):>8.1f} MB/s")
+        try:
+            dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, dictionary_samples([p for _, p in stories]))
+            dict_blob = zstandard.ZstdCompressor(level=STORY_ZSTD_LEVEL, dict_data=dictionary).compress(payload)
+            dict_decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+            print(f"  zstd + 字典     {decode_speed(lambda: dict_decompressor.decompress(dict_blob), len(payload)):>8.1f} MB/s")
+        except zstandard.ZstdError as e:
+            print(f"  字典训练失败: {e}")
+    print(f"  JSON解析        {decode_speed(lambda: fast_json.loads(payload), len(payload)):>8.1f} MB/s（对比）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+把数据库中旧格式的故事记录迁移为紧凑存储格式（backend/story_storage.py）
+迁移只去掉重复内容，读取接口返回的数据结构不变；可以重复执行，已迁移的记录会被跳过
+
+用法：
+  python migrate_story_storage.py --dry-run   # 只统计迁移前后的大小，不写入
+  python migrate_story_storage.py             # 执行迁移
+"""
+
+import argparse
+import os
+import sys
+
+# 添加backend目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+
+from database_client import db_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移故事记录到紧凑存储格式")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不写入数据库")
+    parser.add_argument("--batch-size", type=int, default=50, help="每个事务迁移的记录数")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("故事存储格式迁移" + ("（dry run）" if args.dry_run else ""))
+    print("=" * 60)
+
+    result = db_client.migrate_story_storage(batch_size=args.batch_size, dry_run=args.dry_run)
+    if not result.get("success"):
+        print(f"❌ 迁移失败: {result.get('error')}")
+        sys.exit(1)
+
+    before, after = result["bytes_before"], result["bytes_after"]
+    print(f"{'待迁移' if args.dry_run else '已迁移'}记录: {result['migrated']}")
+    if result["skipped"]:
+        print(f"⚠️ 无法无损转换、保持原样的记录: {result['skipped']}")
+    if before:
+        print(f"数据大小: {before / 1024:.1f} KB -> {after / 1024:.1f} KB（减少 {1 - after / before:.1%}）")
+    print("✅ 完成")
+
+
+if __name__ == "__main__":
+    main()
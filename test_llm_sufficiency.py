@@ -4,9 +4,14 @@
 import asyncio
 import json
 import os
+import sys
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from backend.prompt_templates import PromptTemplates
+
+# 添加backend目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+
+from prompt_templates import PromptTemplates
 
 # 加载环境变量
 load_dotenv()
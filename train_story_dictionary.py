@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+用数据库中的故事训练zstd字典（STORY_COMPRESSION=zstd 时之后写入的故事使用新字典压缩）
+字典保存在 edu_data 中（data_type='zstd_dictionary'），已压缩的记录仍用各自的字典解压
+
+用法：python train_story_dictionary.py [样本故事数]
+"""
+
+import os
+import sys
+
+# 添加backend目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
+
+from database_client import db_client
+from story_compression import zstandard
+
+
+def main():
+    print("=" * 60)
+    print("训练故事zstd字典")
+    print("=" * 60)
+
+    if zstandard is None:
+        print("❌ 未安装zstandard")
+        sys.exit(1)
+
+    schema = db_client.ensure_story_compression_schema()
+    if not schema.get("success"):
+        print(f"❌ 创建压缩存储列失败: {schema.get('error')}")
+        sys.exit(1)
+
+    sample_limit = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    result = db_client.train_story_dictionary(sample_limit=sample_limit)
+    if not result.get("success"):
+        print(f"❌ 训练失败: {result.get('error')}")
+        sys.exit(1)
+
+    print(f"字典ID: {result['dict_id']}")
+    print(f"样本数: {result['sample_count']}")
+    print(f"字典大小: {result['dict_size'] / 1024:.1f} KB")
+    print("✅ 完成")
+
+
+if __name__ == "__main__":
+    main()